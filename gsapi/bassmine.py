@@ -5,13 +5,15 @@ from __future__ import absolute_import, division, print_function
 
 import copy
 import json
+import logging
 import os
-import random
 
 import numpy as np
 
 from . import gsio, gspattern, gsutil
 
+bassmineLog = logging.getLogger("gsapi.bassmine")
+
 def normalize(a):
     """
     Normalize matrix by rows
@@ -47,9 +49,15 @@ def indices(a, func):
     return [i for (i, val) in enumerate(a) if func(val)]
 
 
-def pdf_sampling(n):  # variable argument list
+def pdf_sampling(n, rng):  # variable argument list
+    """
+    Draws an index from a discrete distribution n.
 
-    x = random.random()
+    Args:
+        n: list of probabilities
+        rng: numpy.random.Generator owned by the caller (e.g. MarkovModel.rng)
+    """
+    x = rng.random()
     f = 0
     for i in range(1, len(n)):
         if x < sum(n[0:i]):
@@ -74,15 +82,19 @@ class MarkovModel:
         temporal_model: matrix to store temporal MTM
         interlocking_model: matrix to store interlocking MTM
 
+        rng: numpy.random.Generator used by the generation functions when
+            they are not given one
+
     """
 
-    def __init__(self, model_size, order=1):
+    def __init__(self, model_size, order=1, rng=None):
         """
         Constructor
 
         Args:
             model_size: Dictionary size of the model
             order: default = 1 (not implemented for other orders yet...)
+            rng: numpy.random.Generator or seed (see gsutil.makeRandomGenerator)
         Returns:
             instance of MarkovModel
         """
@@ -110,6 +122,9 @@ class MarkovModel:
         self.interlocking_model = []
         # Pattern dictionary. Used for generation (table index -> onset pattern)
         self.model_dictionary = createMarkovGenerationDictionary()
+        # Compiled rhythm model, rebuilt lazily when counts change
+        self._rhythm_model = None
+        self.rng = gsutil.makeRandomGenerator(rng)
 
     def add_temporal(self, pattern):
         """
@@ -154,6 +169,7 @@ class MarkovModel:
             y: col (bass)
         """
         self.support_interlocking[int(x), int(y)] += 1.
+        self.invalidate()
 
     def update_temporal(self, x, y):
         """
@@ -164,6 +180,7 @@ class MarkovModel:
          y: col (present)
         """
         self.support_temporal[int(x), int(y)] += 1.
+        self.invalidate()
 
     def update_initial(self, x):
         """
@@ -173,15 +190,84 @@ class MarkovModel:
             x: row (probabilities)
         """
         self.support_initial[int(x)] += 1.
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Mark the normalized matrices and the compiled rhythm model as outdated.
+        Called whenever counts change; call it too after editing the support matrices directly.
+        """
+        self.normalized = False
+        self._rhythm_model = None
 
     def normalize_model(self):
         """
         Normalize matrices
+
+        Counts are kept in the support matrices, so the model can still be
+        updated or merged after normalization.
         """
         self.initial_model = self.support_initial / sum(self.support_initial)
-        self.temporal_model = normalize(self.support_temporal)
-        self.interlocking_model = normalize(self.support_interlocking)
+        self.temporal_model = normalize(self.support_temporal.copy())
+        self.interlocking_model = normalize(self.support_interlocking.copy())
         self.normalized = True
+        self._rhythm_model = None
+
+    def merge(self, *others):
+        """
+        Add the counts of other models to this one, e.g. models computed on
+        different shards of a corpus. The model needs to be normalized again.
+
+        Args:
+            others: MarkovModel instances of the same size
+
+        Returns:
+            self
+        """
+        for other in others:
+            if other.model_size != self.model_size:
+                raise ValueError("can't merge models of size %s and %s" % (self.model_size, other.model_size))
+            self.support_initial += other.support_initial
+            self.support_temporal += other.support_temporal
+            self.support_interlocking += other.support_interlocking
+        self.invalidate()
+        return self
+
+    def __add__(self, other):
+        merged = copy.copy(self)
+        merged.rng = gsutil.spawnRandomGenerators(self.rng, 1)[0]
+        merged.support_initial = self.support_initial.copy()
+        merged.support_temporal = self.support_temporal.copy()
+        merged.support_interlocking = self.support_interlocking.copy()
+        return merged.merge(other)
+
+    def toJSONDict(self):
+        """
+        Get a JSON serializable dict with the counts of the model
+
+        Returns:
+            dict
+        """
+        return {'model_size': list(self.model_size),
+                'initial': self.support_initial.tolist(),
+                'temporal': self.support_temporal.tolist(),
+                'interlocking': self.support_interlocking.tolist()}
+
+    def fromJSONDict(self, json_dict):
+        """
+        Load counts from a dict created by toJSONDict
+
+        Args:
+            json_dict: dict
+
+        Returns:
+            self
+        """
+        self.__init__(tuple(json_dict['model_size']))
+        self.support_initial = np.array(json_dict['initial'], dtype=float)
+        self.support_temporal = np.array(json_dict['temporal'], dtype=float)
+        self.support_interlocking = np.array(json_dict['interlocking'], dtype=float)
+        return self
 
     def get_initial(self):
         """
@@ -210,45 +296,60 @@ class MarkovModel:
         """
         return self.interlocking_model
 
-    def rhythm_model(self, _path="output/"):
+    def rhythm_model(self, _path=None):
+        """
+        Get the rhythm model used for unconstrained generation.
 
-        path = _path
+        The model is compiled once from the normalized matrices (normalizing them if needed) and cached until
+        the counts change, so repeated generation does not rebuild it. The returned dictionaries are shared
+        with the cache and should not be modified.
 
-        init_set = markov_tm_2dict(self.initial_model)
-        # print( self.initial_model)
-        init = []
+        Args:
+            _path: if given, also export the model to HModel.json and HModel_init.json in this folder
 
-        init_dict = {}
-        init_dict['initial'] = {}
-        init_dict['initial']['pattern'] = [int(r) for r in init_set]
-        init_dict['initial']['prob'] = [self.initial_model[i] for i in init_dict['initial']['pattern']]
-        # print( "init\n", init_dict)
+        Returns:
+            [init_dict, rhythm_dict]
+        """
+        if self._rhythm_model is None:
+            if not self.normalized:
+                self.normalize_model()
+            initial = np.asarray(self.initial_model)
+            temporal = np.asarray(self.get_temporal())
+
+            init_dict = {'initial': {}}
+            init_dict['initial']['pattern'] = [int(r) for r in np.flatnonzero(initial > 0)]
+            init_dict['initial']['prob'] = [initial[i] for i in init_dict['initial']['pattern']]
+
+            rhythm_dict = dict()
+            for key in np.flatnonzero(temporal.sum(axis=1) > 0):
+                children = np.flatnonzero(temporal[key] > 0)
+                tmp = temporal[key, children]
+                rhythm_dict[int(key)] = {'pattern': [int(r) for r in children],
+                                         'probs': list(tmp / sum(tmp))}
+            self._rhythm_model = [init_dict, rhythm_dict]
+
+        if _path is not None:
+            self.export_rhythm_model(_path)
+        return self._rhythm_model
+
+    def export_rhythm_model(self, _path="output/"):
+        """
+        Write the rhythm model to HModel.json and HModel_init.json
 
-        rhythm_temporal_model = markov_tm_2dict(self.get_temporal())
-        rhythm_dict = dict()
-        # print((pitch_temporal_model))
-        ## Temporal model
-        for key, val in rhythm_temporal_model.items():
-            rhythm_dict[key] = {}
-            # print( key # parent)
-            # print( list(val) # child)
-            tmp = []  # child
-            for v in val:
-                tmp.append(self.get_temporal()[key, int(v)])
-            # print( list(tmp/sum(tmp)))
-            rhythm_dict[key]['pattern'] = [int(r) for r in rhythm_temporal_model[key]]
-            rhythm_dict[key]['probs'] = list(tmp / sum(tmp))
+        Args:
+            _path: folder where the models are stored
 
-        ePath = os.path.abspath(os.path.join(path, 'HModel.json'))
+        Returns:
+            path of the exported HModel.json
+        """
+        init_dict, rhythm_dict = self.rhythm_model()
+        ePath = os.path.abspath(os.path.join(_path, 'HModel.json'))
         with open(ePath, 'w') as outfile:
             json.dump(rhythm_dict, outfile)
-            outfile.close()
 
-        with open(path + 'HModel_init.json', 'w') as outfile:
+        with open(os.path.join(_path, 'HModel_init.json'), 'w') as outfile:
             json.dump(init_dict, outfile)
-            outfile.close()
-        # print( "Rhythm model computed\n", rhythm_dict)
-        return [init_dict, rhythm_dict]
+        return ePath
 
     def pitch_model(self):
         """
@@ -280,9 +381,8 @@ class MarkovModel:
         return pitch_dict
 
 
-def constrainMM(markov_model, target, _path="output/"):
+def constrainMM(markov_model, target, _path=None):
     """
-
     Compute non-homogeneuous markov model (NHMM) based on interlocking constraint.
     Given a target pattern it constraint the original model and ensure arc-consistency
 
@@ -291,142 +391,19 @@ def constrainMM(markov_model, target, _path="output/"):
     Args:
         markov_model: MarkovModel instance (output from GSBassmineUtils.corpus_analysis())
         target: Target pattern for interlocking (kick) represented by its pattern ids.
-        _path: Path to where the Markov models will be stored
+        _path: if given, the model is also exported to NHModel.json and Model_init.json in this folder
 
     Returns:
         Interlocking model as dictionary in JSON format
 
     """
-    path = _path
-
-    b0 = copy.copy(markov_model.get_initial())
-    b = copy.copy(markov_model.get_temporal())
-    inter = copy.copy(markov_model.get_interlocking())
+    NHMM = _nhmmToDict(*_nonHomogeneousModel(markov_model, _interlockingDomains(markov_model, target)))
+    if _path is not None:
+        _exportModel(NHMM, _path, 'NHModel.json', 'Model_init.json')
+    return NHMM
 
-    # b and inter are converted to dictionaries {row>0 : (idx columns>0)}
-    # Domains
-    Dom_init = markov_tm_2dict(b0)
-    Dom_B = markov_tm_2dict(b)
-    Dom_I = markov_tm_2dict(inter)
 
-    # print( "Initial dict ", Dom_init)
-    # print( "Temporal dict ", Dom_B)
-    # print( "Interlocking dict ", Dom_I)
-
-    ## Representation of target kick pattern as variable domain
-    target = translate_rhythm(binaryBeatPattern([e.startTime for e in target.events], target.duration))
-
-    target_setlist = []
-    for t in target:
-        # RELAXATION RULE: if the target kick is not in the model consider metronome pulse as kick
-        if t in Dom_I:
-            target_setlist.append(Dom_I[t])
-        else:
-            target_setlist.append(Dom_I[8])
-            print("Kick pattern mistmatch")
-    # print( target_setlist)
-
-    ## V store the domain of patterns at each step
-    V = []
-
-    filter_init = Dom_init.intersection(target_setlist[0])
-    # print( list(filter_init))
-    ## Look for possible continuations of filter_init in Dom_B, constrained to target_list[1]
-    V.append(dict())
-    tmp = []
-    for f in filter_init:
-        #	print( "Possible intital continuations",f, Dom_B[int(f)])
-        #	print( "Kick constrain", target_setlist[1])
-        #	print( "Intersection", Dom_B[int(f)].intersection(target_setlist[1]))
-
-        if len(Dom_B[int(f)].intersection(target_setlist[1])) > 0:
-            V[0][int(f)] = Dom_B[int(f)].intersection(target_setlist[1])
-            tmp.append(f)
-    # print( "\n\n")
-    # print( "Kick constr", list(target_setlist[0]))
-    # print( "V0", V[0])
-    # print( "V1", V[1].keys()	# Domain for step 1 / rows  of transition matrix)
-    # print( V[1])
-
-    ## Create rest of V
-    ##############################################
-    ## Make backtrack free Non-Homogeneuous Markov Model ordr 1
-    ##############################################
-    for step in range(1, len(target) - 1):
-        V.append(dict())
-        # print( "Kick constr", list(target_setlist[step]))
-        # for each value in V[step] keep continuations that match interlocking with step+1
-        for t in target_setlist[step]:
-            if len(Dom_B[int(t)].intersection(target_setlist[step + 1])):
-                V[step][int(t)] = Dom_B[int(t)].intersection(target_setlist[step + 1])
-                # print( "check\n")
-                # print( "V", step, V[step].keys())
-
-    ## Delete values from each key in V[i] that are not in V[i+1]
-    val_del = dict()
-    ## Font-propagation
-    for step in range(1, len(target) - 1):
-        val_del_temp = []
-        next_key = set([str(x) for x in V[step].keys()])
-        # print( next_key)
-        for key, value in V[step - 1].items():
-            # print( key, value)
-            tmp_int = value.intersection(next_key)
-            # if len(tmp_int) > 0:
-            V[step - 1][key] = tmp_int
-            if len(tmp_int) == 0:
-                val_del_temp.append(key)
-        val_del[step] = val_del_temp
-    #  print( val_del)
-    #  Back-propagation
-    for step, value in val_del.items():
-        if len(value) > 0:
-            for v in value:
-                ## Delete key
-                V[step - 1].pop(v, None)
-            #  Delete in previous continuations
-            # print( V[step-2])
-            for idx in V[step - 2].keys():
-                V[step - 2][idx] = set([str(x) for x in V[step - 1].keys()]).intersection(V[step - 2][idx])
-    # BUILD FINAL DICTIONARY
-    # print( "\nFinal Model:")
-    out_Model = {}
-    init = []
-    init_dict = dict()
-    for key in V[0]:
-        init.append(b0[key])
-    init_dict['initial'] = dict()
-    init_dict['initial']['prob'] = list(init / sum(init))
-    init_dict['initial']['pattern'] = V[0].keys()
-    # print( init_dict)
-    for i in range(len(V)):
-        out_Model[i] = {}
-        # print( "step:",i)
-        for key, val in V[i].items():
-            out_Model[i][key] = {}
-            # print( key # parent)
-            # print( list(val) # child)
-            tmp = []  # child
-            for v in val:
-                tmp.append(b[key, int(v)])
-            # print( list(tmp/sum(tmp)))
-            out_Model[i][key]['pattern'] = [int(x) for x in val]
-            out_Model[i][key]['probs'] = list(tmp / sum(tmp))
-    # print( out_Model)
-    with open(path + 'NHModel.json', 'w') as outfile:
-        json.dump(out_Model, outfile)
-        outfile.close()
-
-    with open(path + 'Model_init.json', 'w') as outfile:
-        json.dump(init_dict, outfile)
-        outfile.close()
-
-    # print(("Interlocking model build!"))
-
-    return [init_dict, out_Model]
-
-
-def variationMM(markov_model, target, _path="output/"):
+def variationMM(markov_model, target, _path=None):
     """
     Compute non-homogeneuous markov model (NHMM) based on variation constraint.
     Given a target Variation Mask(VM) it constraint the original model and ensure arc-consistency
@@ -438,148 +415,175 @@ def variationMM(markov_model, target, _path="output/"):
     Args:
         markov_model: MarkovModel instance (output from GSBassmineUtils.corpus_analysis())
         target: Variation Mask (list with negative numbers indicating variation of that time frame)
-        _path: Path to where the Markov models will be stored
+        _path: if given, the model is also exported to NHModel_var.json and Model_init_var.json in this folder
 
     Returns:
-        Variation model as a dictionary in JSON format
+        Variation model as a dictionary in JSON format. As before, when the first beat is preserved
+        init_dict['initial'] holds its pattern id and probability 1 as scalars; when it varies, it holds
+        lists of pattern ids and probabilities like constrainMM.
 
     """
-    path = _path
+    NHMM = _nhmmToDict(*_nonHomogeneousModel(markov_model, _variationDomains(markov_model, target)))
+    if target[0] >= 0:
+        NHMM[0]['initial'] = {'prob': 1.00, 'pattern': int(target[0])}
+    if _path is not None:
+        _exportModel(NHMM, _path, 'NHModel_var.json', 'Model_init_var.json')
+    return NHMM
+
+
+def _interlockingDomains(markov_model, target):
+    """
+    Domains of the bass patterns allowed at each beat of a target kick pattern.
 
-    b = copy.copy(markov_model.get_temporal())
+    Args:
+        markov_model: MarkovModel instance
+        target: kick Pattern
 
-    ## Domains
-    # Dom_init = markov_tm_2dict(b0)
-    Dom_B = markov_tm_2dict(b)
-    # Dom_I = markov_tm_2dict(inter)
+    Returns:
+        boolean matrix (beats x states), one bitset per beat
+    """
+    interlocking = markov_model.support_interlocking > 0
+    kicks = np.array(translate_rhythm(binaryBeatPattern([e.startTime for e in target.events],
+                                                        int(target.duration))), dtype=int)
+    known = interlocking[kicks].any(axis=1)
+    # RELAXATION RULE: if the target kick is not in the model consider metronome pulse as kick
+    if not known.all():
+        bassmineLog.warning("kick patterns %s are not in the interlocking model, metronome pulse used instead"
+                            % sorted(set(kicks[~known].tolist())))
+    domains = interlocking[np.where(known, kicks, 8)]
+    domains[0] &= markov_model.support_initial > 0
+    return domains
+
+
+def _variationDomains(markov_model, target):
+    """
+    Domains of the patterns allowed at each beat of a variation mask.
 
-    # print( "Initial dict ", Dom_init)
-    # print( "Temporal dict ", Dom_B)
-    # print( "Interlocking dict ", Dom_I)
+    Args:
+        markov_model: MarkovModel instance
+        target: Variation Mask (list with negative numbers indicating variation of that time frame)
 
-    # target
-    # target = [8,8,4,-2,2,0,4,-2,8]
+    Returns:
+        boolean matrix (beats x states), one bitset per beat
+    """
+    target = np.array(target, dtype=int)
+    domains = np.zeros((len(target), markov_model.model_size[1]), dtype=bool)
+    domains[target < 0] = True
+    fixed = np.flatnonzero(target >= 0)
+    domains[fixed, target[fixed]] = True
+    return domains
 
-    # Create V : variable domain for transitions
-    V = []
-    # target
-    # target = [8,8,4,14,4,10,8,2,8]
 
-    V.append(dict())
+def _nonHomogeneousModel(markov_model, domains):
+    """
+    Make the domains arc consistent with the temporal model and compile the resulting NHMM.
 
-    if target[1] >= 0:
-        V[0][target[0]] = {str(target[1])}
-    else:
-        V[0][target[0]] = Dom_B[target[0]]
-
-    for i in range(1, len(target) - 1):
-
-        V.append(dict())
-
-        if target[i] >= 0:  # Current beat don't vary
-
-            for key, value in V[i - 1].items():
-
-                # store keys that match target[i]
-                tmp_key = value.intersection({str(target[i])})
-                if len(tmp_key) > 0:
-                    V[i][int(list(tmp_key)[0])] = Dom_B[int(list(tmp_key)[0])]
-                    # V[i][target[i-1]] = set([str(target[i])])
-
-        else:  # Current beat varies
-
-            # Check possible continuations from V[i-1] as Key candidates in V[i]
-            for key, value in V[i - 1].items():
-
-                for v in value:
-                    V[i][int(v)] = Dom_B[int(v)]
-
-                    # print( "h")
-
-    # V.append(dict())
-
-    # V[len(target)-1][target[len(target)-1]] = set([str(target[len(target)-1])])
-
-    # print( V)
-
-
-    ## Delete values from each key in V[i] that are not in V[i+1]
-    val_del = dict()
-    ## Font-propagation
-    for step in range(1, len(target) - 1):
-        val_del_temp = []
-        next_key = set([str(x) for x in V[step].keys()])
-        # print( next_key)
-        for key, value in V[step - 1].items():
-            # print( key, value)
-            tmp_int = value.intersection(next_key)
-            # if len(tmp_int) > 0:
-            V[step - 1][key] = tmp_int
-            if len(tmp_int) == 0:
-                val_del_temp.append(key)
-        val_del[step] = val_del_temp
-    # print( val_del)
-    ## Back-propagation
-    for step, value in val_del.items():
-        if len(value) > 0:
-            for v in value:
-                ## Delete key
-                V[step - 1].pop(v, None)
-            ## Delete in previous continuations
-            # print( V[step-2])
-            for idx in V[step - 2].keys():
-                V[step - 2][idx] = set([str(x) for x in V[step - 1].keys()]).intersection(V[step - 2][idx])
-    # BUILD FINAL DICTIONARY
-    # print( "\nFinal Model:")
-
-    for key, val in V[len(V) - 1].items():
-        tmp_val = val.intersection({str(target[len(target) - 1])})
-        # print( tmp_val)
-        if len(tmp_val) > 0:
-            V[len(V) - 1][key] = tmp_val
-
-    # for value in V:
-    #	print( value)
-    #	print( "\n")
+    A value is kept at a beat only if it has a continuation at the next beat (backward pass) and can be
+    reached from the previous one (forward pass), so generation never needs to backtrack.
+    Domains are propagated with boolean matrix products on the transition support.
+
+    Args:
+        markov_model: MarkovModel instance
+        domains: boolean matrix (beats x states), modified in place
+
+    Returns:
+        initial: initial probabilities of the model (states)
+        steps: transition probabilities of each beat (beats - 1 x states x states)
+    """
+    temporal = markov_model.support_temporal
+    support = temporal > 0
+    for i in range(len(domains) - 2, -1, -1):
+        domains[i] &= support.dot(domains[i + 1])
+    for i in range(1, len(domains)):
+        domains[i] &= domains[i - 1].dot(support)
+    if not domains[0].any():
+        raise ValueError("no pattern satisfies the constraints of the model")
+
+    initial = np.where(domains[0], markov_model.support_initial, 0.)
+    if not initial.any():
+        # no corpus counts for the allowed initial patterns (e.g. a preserved variation beat)
+        initial = domains[0].astype(float)
+    initial = initial / initial.sum()
+    steps = temporal * (domains[:-1, :, None] & domains[1:, None, :])
+    totals = steps.sum(axis=2, keepdims=True)
+    steps = np.divide(steps, totals, out=np.zeros_like(steps), where=totals > 0)
+    return initial, steps
+
+
+def _nhmmToDict(initial, steps):
+    """
+    Convert a compiled NHMM to its JSON dictionary representation
 
+    Returns:
+        [init_dict, out_Model]
+    """
+    init_dict = {'initial': {}}
+    init_dict['initial']['pattern'] = [int(x) for x in np.flatnonzero(initial)]
+    init_dict['initial']['prob'] = [float(initial[x]) for x in init_dict['initial']['pattern']]
     out_Model = {}
-    # Force last beat
-    # init = []
-    init_dict = dict()
-    # for key in V[0]:
-    #	init.append(b0[key])
-    init_dict['initial'] = dict()
-    init_dict['initial']['prob'] = 1.00
-    init_dict['initial']['pattern'] = target[0]
-    # print( init_dict)
-
-    for i in range(len(V)):
+    for i, step in enumerate(steps):
         out_Model[i] = {}
-        # print( "step:",i)
-        for key, val in V[i].items():
-            out_Model[i][key] = {}
-            # print( key # parent)
-            # print( list(val) # child)
-            tmp = []  # child
-            for v in val:
-                tmp.append(b[key, int(v)])
-            # print( list(tmp/sum(tmp)))
-            # print( tmp)
-            out_Model[i][key]['pattern'] = [int(x) for x in val]
-            out_Model[i][key]['probs'] = list(tmp / sum(tmp))
-    # print( out_Model)
-    with open(path + 'NHModel_var.json', 'w') as outfile:
-        json.dump(out_Model, outfile)
-        outfile.close()
-
-    with open(path + 'Model_init_var.json', 'w') as outfile:
-        json.dump(init_dict, outfile)
-        outfile.close()
-
-    print(("Variation model build!"))
+        for key in np.flatnonzero(step.any(axis=1)):
+            children = np.flatnonzero(step[key])
+            out_Model[i][int(key)] = {'pattern': [int(x) for x in children],
+                                      'probs': [float(x) for x in step[key, children]]}
     return [init_dict, out_Model]
 
 
+def _exportModel(NHMM, path, modelName, initName):
+    with open(os.path.join(path, modelName), 'w') as outfile:
+        json.dump(NHMM[1], outfile)
+
+    with open(os.path.join(path, initName), 'w') as outfile:
+        json.dump(NHMM[0], outfile)
+
+
+def _modelRng(markov_model, rng):
+    """
+    Generator to draw from: the given one (or seed), else the model's own stream
+    """
+    if rng is not None:
+        return gsutil.makeRandomGenerator(rng)
+    if getattr(markov_model, 'rng', None) is None:
+        # models pickled before they owned a generator
+        markov_model.rng = gsutil.makeRandomGenerator()
+    return markov_model.rng
+
+
+def _sampleNonHomogeneous(initial, steps, beat_length, rng):
+    """
+    Draw a sequence of pattern ids from a compiled NHMM
+
+    Args:
+        initial: initial probabilities
+        steps: transition probabilities of each beat
+        beat_length: number of beats to draw (at most len(steps) + 1)
+        rng: numpy.random.Generator
+
+    Returns:
+        list of pattern ids
+    """
+    cdf = np.cumsum(steps[:beat_length - 1], axis=2)
+    draws = rng.random(beat_length)
+    pattern_idx = [int(np.searchsorted(np.cumsum(initial), draws[0], side='right'))]
+    for beat in range(beat_length - 1):
+        row = cdf[beat, pattern_idx[beat]]
+        pattern_idx.append(int(np.searchsorted(row, draws[beat + 1] * row[-1], side='right')))
+    return pattern_idx
+
+
+def _bassPattern(markov_model, pattern_idx):
+    """
+    Build the bassline Pattern of a sequence of pattern ids
+    """
+    bassline = gspattern.Pattern()
+    bassline.duration = len(pattern_idx)
+    for beat_count, idx in enumerate(pattern_idx):
+        for s in markov_model.model_dictionary['patterns'][idx]:
+            bassline.events.append(gspattern.Event(s + beat_count, 0.25, 36, velocity=110, tag="bass"))
+    return bassline
+
+
 def markov_tm_2dict(a):
     """
     Convert markov transition matrix to dictionary of sets.
@@ -658,7 +662,7 @@ def createMarkovGenerationDictionary(toJSON=False, _path="output/"):
     return data
 
 
-def generateBassRhythm(markov_model, beat_length=8, target=[]):
+def generateBassRhythm(markov_model, beat_length=8, target=[], rng=None):
     """
     Function to generate a rhythmic bassline. If no target given the system assume no constraints and uses the regular
     Markov model (computed by MarkovModel.rhythm_model()).
@@ -667,51 +671,34 @@ def generateBassRhythm(markov_model, beat_length=8, target=[]):
         markov_model: output from  MarkovModel.rhythm_model()
         beat_length: desired length of the generated pattern
         target: Pattern used as constraint in Interlocking Model.
+        rng: numpy.random.Generator or seed (see gsutil.makeRandomGenerator), markov_model.rng if None
 
     Returns:
         bassline: Pattern containing bassline onset pattern
 
     """
-    bassline = gspattern.Pattern()
+    rng = _modelRng(markov_model, rng)
     pattern_idx = []
 
     if len(target) == 0:  # no constraints
 
         HMM = markov_model.rhythm_model()
 
-        pattern_idx.append(np.random.choice(HMM[0]['initial']['pattern'], p=HMM[0]['initial']['prob']))
+        pattern_idx.append(rng.choice(HMM[0]['initial']['pattern'], p=HMM[0]['initial']['prob']))
 
         for beat in range(beat_length - 1):
-            pattern_idx.append(np.random.choice(HMM[1][pattern_idx[beat]]['pattern'],
+            pattern_idx.append(rng.choice(HMM[1][pattern_idx[beat]]['pattern'],
                                                 p=HMM[1][pattern_idx[beat]]['probs']))
 
     else:  # use constrained model
 
-        if len(target) < beat_length:
-            beat_length = len(target)
+        initial, steps = _nonHomogeneousModel(markov_model, _interlockingDomains(markov_model, target))
+        pattern_idx = _sampleNonHomogeneous(initial, steps, min(beat_length, len(steps) + 1), rng)
 
-        NHMM = constrainMM(markov_model, target)
-        pattern_idx.append(np.random.choice(NHMM[0]['initial']['pattern'], p=NHMM[0]['initial']['prob']))
+    return _bassPattern(markov_model, pattern_idx)
 
-        for beat in range(beat_length - 1):
-            pattern_idx.append(np.random.choice(NHMM[1][beat][pattern_idx[beat]]['pattern'],
-                                                p=NHMM[1][beat][pattern_idx[beat]]['probs']))
-
-    bassline.duration = len(pattern_idx)
 
-    start_times = []
-    beat_count = 0
-    for idx in pattern_idx:
-        st = markov_model.model_dictionary['patterns'][idx]
-        if len(st) > 0:
-            for s in st:
-                bassline.events.append(gspattern.Event(s + beat_count, 0.25, 36, velocity=110, tag="bass"))
-        beat_count += 1
-
-    return bassline
-
-
-def _generateBassRhythm(markov_model, beat_length=8, target=[]):
+def _generateBassRhythm(markov_model, beat_length=8, target=[], rng=None):
     """
     Function to generate a rhythmic bassline. If no target given the system assume no constraints and uses the regular
     Markov model (computed by MarkovModel.rhythm_model()).
@@ -720,20 +707,22 @@ def _generateBassRhythm(markov_model, beat_length=8, target=[]):
         markov_model: output from  MarkovModel.rhythm_model()
         beat_length: desired length of the generated pattern
         target: Pattern used as constraint in Interlocking Model.
+        rng: numpy.random.Generator or seed (see gsutil.makeRandomGenerator)
 
     Returns:
         bassline: Pattern containing bassline onset pattern
 
     """
+    rng = gsutil.makeRandomGenerator(rng)
     bassline = gspattern.Pattern()
     pattern_idx = []
 
     markovDict = createMarkovGenerationDictionary()
 
-    pattern_idx.append(np.random.choice(markov_model[0]['initial']['pattern'], p=markov_model[0]['initial']['prob']))
+    pattern_idx.append(rng.choice(markov_model[0]['initial']['pattern'], p=markov_model[0]['initial']['prob']))
 
     for beat in range(beat_length - 1):
-        pattern_idx.append(np.random.choice(markov_model[1][beat][pattern_idx[beat]]['pattern'],
+        pattern_idx.append(rng.choice(markov_model[1][beat][pattern_idx[beat]]['pattern'],
                                             p=markov_model[1][beat][pattern_idx[beat]]['probs']))
 
     bassline.duration = len(pattern_idx)
@@ -750,7 +739,7 @@ def _generateBassRhythm(markov_model, beat_length=8, target=[]):
     return bassline
 
 
-def generateBassRhythmVariation(markov_model, target_pattern, variation_mask):
+def generateBassRhythmVariation(markov_model, target_pattern, variation_mask, rng=None):
     """
     Function that implements a variation model given an already generated pattern. Based on the variation mask it creates
     a Markov model that preserve desired beat measures while it models "variation" beats to be stylistically consistent.
@@ -759,45 +748,29 @@ def generateBassRhythmVariation(markov_model, target_pattern, variation_mask):
         target_pattern: Pattern, for instance output from generateBassRhythm()
         variation_mask: List of the same length of the target_pattern(in beats). Positions with value 1 will be preserved,
         those with -1 will vary.
+        rng: numpy.random.Generator or seed (see gsutil.makeRandomGenerator), markov_model.rng if None
 
     Returns:
         bassline: generated Pattern
     """
-
-    bassline = gspattern.Pattern()
-    pattern_idx = []
+    rng = _modelRng(markov_model, rng)
 
     if len(variation_mask) < target_pattern.duration:
-        print("Variation mask must be same length as target_pattern (in beats)")
+        bassmineLog.error("Variation mask must be same length as target_pattern (in beats)")
         return
     else:
         # Convert target pattern to markov dictionary
         onset_target = [x.startTime for x in target_pattern.events]
-        target_rhythm = binaryBeatPattern(onset_target, target_pattern.duration)
+        target_rhythm = binaryBeatPattern(onset_target, int(target_pattern.duration))
         target_id = translate_rhythm(target_rhythm)
         # Mask formatted pattern
-        masked_target = [target_id[i] * variation_mask[i] for i in range(len(variation_mask) - 1)]
-
-        # Build variation model
-        NHMM = variationMM(markov_model, masked_target)
-        # Generate Pattern
-        pattern_idx.append(target_id[0])
-
-        for beat in range(len(masked_target) - 1):
-            pattern_idx.append(np.random.choice(NHMM[1][beat][pattern_idx[beat]]['pattern'],
-                                                p=NHMM[1][beat][pattern_idx[beat]]['probs']))
-
-        bassline.duration = len(pattern_idx)
+        masked_target = [target_id[i] if variation_mask[i] >= 0 else -1 for i in range(len(variation_mask) - 1)]
 
-        beat_count = 0
-        for idx in pattern_idx:
-            st = markov_model.model_dictionary['patterns'][idx]
-            if len(st) > 0:
-                for s in st:
-                    bassline.events.append(gspattern.Event(s + beat_count, 0.25, 36, velocity=110, tag="bass"))
-            beat_count += 1
+        # Build variation model and generate pattern
+        initial, steps = _nonHomogeneousModel(markov_model, _variationDomains(markov_model, masked_target))
+        pattern_idx = _sampleNonHomogeneous(initial, steps, len(masked_target), rng)
 
-        return bassline
+        return _bassPattern(markov_model, pattern_idx)
 
 
 def corpus_analysis(bass_path, drum_path):
@@ -921,7 +894,6 @@ def binaryBeatPattern(aPattern, noBeats_bass, resolution=4):
     """
     # resolution = 4
     # noBeats_bass = uf.numberOfBeats(aPattern)  # Bass files length set the global length of analysis
-    print('\n# of beats: ', noBeats_bass)
     # beat_subdiv = np.arange(start=0, step=0.25, stop=(noBeats_bass * RES) - 1)
     subdiv_aux = np.array([0., 0.25, 0.5, 0.75])
     # Matrix to store the binary representation of the midi files
@@ -70,12 +70,22 @@ class Dataset(object):
 
     def getAllSliceOfDuration(self, desiredDuration, viewpointName=None,
                               supressEmptyPattern=True):
-        res = []
+        return list(self.iterAllSliceOfDuration(desiredDuration, viewpointName=viewpointName,
+                                                supressEmptyPattern=supressEmptyPattern))
+
+    def iterAllSliceOfDuration(self, desiredDuration, viewpointName=None,
+                               supressEmptyPattern=True):
+        """
+        Generator version of getAllSliceOfDuration: slices are produced one
+        pattern at a time instead of being gathered in a list.
+        Useful for streaming slices with gsio.toJSONLinesFile.
+
+        """
         for p in self.patterns:
-            res += p.splitInEqualLengthPatterns(viewpointName=viewpointName,
-                                                desiredLength=desiredDuration,
-                                                supressEmptyPattern=supressEmptyPattern)
-        return res
+            for sliced in p.splitInEqualLengthPatterns(viewpointName=viewpointName,
+                                                       desiredLength=desiredDuration,
+                                                       supressEmptyPattern=supressEmptyPattern):
+                yield sliced
 
     def generateViewpoint(self, name, descriptor=None, sliceType=None):
         for p in self.patterns:
@@ -3,30 +3,144 @@
 """
 The gsio module contains fuctions allowing importing and exporting to and from
 various standards formats (MIDI, JSON and Python's pickle).
+
+JSON and pickle files can be transparently compressed with the gzip, bz2 or
+lzma codecs of the standard library (see `openFile`).
+
+Trained styles can be saved in a binary format holding their numpy arrays as
+raw data, so that they load in milliseconds (see `toStyleFile`).
 """
 
 from __future__ import absolute_import, division, print_function
 
 import copy
-import collections
 import glob
+import io
 import json
 import logging
 import math
 import os
+import struct
 import sys
+import warnings
 
 if sys.version_info >= (3, 0):
     import pickle
 else:
     import cPickle as pickle
 
+try:
+    from collections.abc import Hashable
+except ImportError:
+    from collections import Hashable
+
+import numpy as np
+
 from . import gsdefs, gspattern, gsutil, midiio
 
 
 gsioLog = logging.getLogger("gsapi.gsio")
 gsioLog.setLevel(level=logging.WARNING)
 
+# file extensions and magic numbers of the supported compression codecs
+compressionExtensions = {'gzip': '.gz', 'bz2': '.bz2', 'lzma': '.xz'}
+_extensionToCompression = {'.gz': 'gzip', '.gzip': 'gzip', '.bz2': 'bz2', '.xz': 'lzma', '.lzma': 'lzma'}
+_compressionMagics = [(b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'lzma')]
+
+# binary format: magic number, header length, JSON header and aligned raw arrays
+_binaryMagic = b'GSAPIBIN'
+_binaryAlignment = 64
+
+
+def _compressionModule(compression):
+    if compression == 'gzip':
+        import gzip
+        return gzip
+    elif compression == 'bz2':
+        import bz2
+        return bz2
+    elif compression in ('lzma', 'xz'):
+        import lzma
+        return lzma
+    raise ValueError("unknown compression %s, should be one of %s" % (compression, list(compressionExtensions)))
+
+
+def _inferCompression(filePath, mode):
+    """
+    Guess the compression codec of a file from its extension or, when reading,
+    from its first bytes.
+
+    """
+    if hasattr(filePath, 'read') or hasattr(filePath, 'write'):
+        if 'r' in mode and hasattr(filePath, 'peek'):
+            head = filePath.peek(6)[:6]
+        else:
+            return None
+    else:
+        extension = os.path.splitext(filePath)[1].lower()
+        if extension in _extensionToCompression:
+            return _extensionToCompression[extension]
+        if 'r' not in mode or not os.path.isfile(filePath):
+            return None
+        with open(filePath, 'rb') as f:
+            head = f.read(6)
+    for magic, compression in _compressionMagics:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def addCompressionExtension(filePath, compression):
+    """
+    Appends the extension of the given compression codec (if any) to filePath.
+
+    """
+    if compression:
+        _compressionModule(compression)
+        extension = compressionExtensions['lzma' if compression == 'xz' else compression]
+        if not filePath.endswith(extension):
+            filePath += extension
+    return filePath
+
+
+def openFile(filePath, mode='r', compression=None):
+    """
+    Opens a file, transparently compressing or decompressing it.
+
+    Parameters
+    ----------
+    filePath: path or file object
+        the file to open. An already opened file object (e.g.
+        `sys.stdout.buffer`) can be given: it is then wrapped so that
+        compressed data can be streamed through pipes.
+    mode: str
+        'r', 'w' or 'a', optionally followed by 'b' for binary data.
+    compression: {None, 'gzip', 'bz2', 'lzma'}
+        codec to use. If None, it is inferred from the file extension
+        ('.gz', '.bz2', '.xz', '.lzma') or, when reading, from the first
+        bytes of the file.
+
+    Returns
+    -------
+    A file object. Closing it does not close a given file object.
+
+    """
+    compression = compression or _inferCompression(filePath, mode)
+    isFileObject = hasattr(filePath, 'read') or hasattr(filePath, 'write')
+    if not compression:
+        return filePath if isFileObject else open(filePath, mode)
+
+    module = _compressionModule(compression)
+    binaryMode = mode.replace('t', '').replace('b', '') + 'b'
+    if isFileObject:
+        # compressed streams need the binary buffer of text file objects
+        compressedFile = module.open(getattr(filePath, 'buffer', filePath), binaryMode)
+    else:
+        compressedFile = module.open(filePath, binaryMode)
+    if 'b' in mode:
+        return compressedFile
+    return io.TextIOWrapper(compressedFile)
+
 
 def __keyToMidiFormat(keyString):
     mode = 0
@@ -347,7 +461,7 @@ def toMidiFile(myPattern, midiMap=gsdefs.defaultPitchNames, folderPath="./output
         channel = 1
         if isinstance(midiMap, tuple):
             pitch = midiMap[e.tag[0]]
-        elif isinstance(midiMap, collections.Hashable):
+        elif isinstance(midiMap, Hashable):
             pitch = midiMap[e.tag]
         else:
             pitch = e.pitch
@@ -374,31 +488,37 @@ def toMidiFile(myPattern, midiMap=gsdefs.defaultPitchNames, folderPath="./output
     return exportedPath
 
 
-def fromJSONFile(filePath, conserveTuple=False):
+def _warnConserveTuple(conserveTuple):
+    if conserveTuple is not None:
+        warnings.warn("conserveTuple is deprecated and ignored when reading: tuple tags are always restored",
+                      DeprecationWarning, stacklevel=3)
+
+
+def fromJSONFile(filePath, conserveTuple=None):
     """
     Loads a pattern to the internal JSON Format.
 
     Parameters
     ----------
-    filePath: path
-        filePath where to load it
+    filePath: path or file object
+        file to read from (can be compressed, see `openFile`). A given file
+        object is left open.
     conserveTuple: bool
-        Useful if some tags were tuples, but performs more slowly.
+        deprecated and ignored: tuple tags are always restored (see
+        Pattern.fromJSONDict).
 
     """
-    def hinted_tuple_hook(obj):
-        if isinstance(obj, list): return [hinted_tuple_hook(e) for e in obj]
-        if isinstance(obj, dict):
-            if '__tuple__' in obj: return tuple(obj['items'])
-            return {k: hinted_tuple_hook(e) for k, e in obj.items()}
-        else:
-            return obj
-
-    with open(filePath, 'r') as f:
-        return gspattern.Pattern().fromJSONDict(json.load(f, object_hook=hinted_tuple_hook if conserveTuple else None))
+    _warnConserveTuple(conserveTuple)
+    f = openFile(filePath, 'r')
+    shouldClose = f is not filePath
+    try:
+        return gspattern.Pattern().fromJSONDict(json.load(f))
+    finally:
+        if shouldClose:
+            f.close()
 
 
-def toJSONFile(myPattern, folderPath, useTagIndexing=True, nameSuffix=None, conserveTuple=False):
+def toJSONFile(myPattern, folderPath, useTagIndexing=True, nameSuffix=None, conserveTuple=False, compression=None):
     """
     Saves a pattern to internal JSON Format.
 
@@ -415,36 +535,117 @@ def toJSONFile(myPattern, folderPath, useTagIndexing=True, nameSuffix=None, cons
         if True, tags are stored as indexes from a list of all tags.
         this reduces the size of JSON files.
     conserveTuple: bool
-        useful if some tags were tuples, but performs more slowly.
+        if True, tuple tags are flagged so they can be read back as tuples
+        by older versions (see Pattern.toJSONDict).
+    compression: {None, 'gzip', 'bz2', 'lzma'}
+        if given, the file is compressed and the codec extension is appended
+        to the fileName.
     """
 
     filePath = os.path.join(folderPath, myPattern.name + (nameSuffix or "") + ".json")
+    filePath = addCompressionExtension(filePath, compression)
     if not os.path.exists(folderPath):
         os.makedirs(folderPath)
 
-    class TupleEncoder(json.JSONEncoder):
-        """
-        Encoder conserving tuple type information.
-
-        """
-        def checkTuple(self, item):
-            if isinstance(item, tuple): return {'__tuple__': True, 'items': item}
-            if isinstance(item, list): return [self.checkTuple(e) for e in item]
-            if isinstance(item, dict):
-                return {k: self.checkTuple(e) for k, e in item.items()}
-            else:
-                return item
-
-        def iterencode(self, item):
-            return json.JSONEncoder.iterencode(self, self.checkTuple(item))
-
-    encoderClass = TupleEncoder if conserveTuple else None
-    with open(filePath, 'w') as f:
-        json.dump(myPattern.toJSONDict(useTagIndexing=useTagIndexing), f,
-                  cls=encoderClass, indent=1, separators=(',', ':'))
+    with openFile(filePath, 'w', compression) as f:
+        json.dump(myPattern.toJSONDict(useTagIndexing=useTagIndexing, conserveTuple=conserveTuple), f,
+                  indent=1, separators=(',', ':'))
     return os.path.abspath(filePath)
 
 
+def fromJSONLinesFile(filePath, compression=None, conserveTuple=None):
+    """
+    Iterates over the patterns stored in a JSON Lines file.
+
+    Patterns are parsed one line at a time, so memory usage does not depend
+    on the number of patterns in the file.
+
+    Parameters
+    ----------
+    filePath: path or file object
+        file to read from. An already opened file object (e.g. `sys.stdin`)
+        can be given to read patterns from a pipe. Tuple tags are always
+        restored (see Pattern.fromJSONDict).
+    compression: {None, 'gzip', 'bz2', 'lzma'}
+        codec used to decompress the stream. If None, it is inferred
+        (see `openFile`).
+    conserveTuple: bool
+        deprecated and ignored, as in `fromJSONFile`.
+
+    Returns
+    -------
+    A generator yielding one Pattern per line.
+
+    """
+    _warnConserveTuple(conserveTuple)
+    return _iterJSONLines(filePath, compression)
+
+
+def _iterJSONLines(filePath, compression):
+    f = openFile(filePath, 'r', compression)
+    shouldClose = f is not filePath
+    try:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            yield gspattern.Pattern().fromJSONDict(json.loads(line))
+    finally:
+        if shouldClose:
+            f.close()
+
+
+def toJSONLinesFile(patterns, filePath, useTagIndexing=False, conserveTuple=False, compression=None):
+    """
+    Saves a collection of patterns to a JSON Lines file (one pattern per line).
+
+    Patterns are serialized one at a time, so `patterns` can be any iterable,
+    e.g. a Dataset, a list returned by `Dataset.getAllSliceOfDuration` or a
+    generator such as `Dataset.iterAllSliceOfDuration`.
+
+    Parameters
+    ----------
+    patterns: iterable of Pattern
+        the Patterns to save.
+    filePath: path or file object
+        file to write to. An already opened file object (e.g. `sys.stdout`)
+        can be given to stream patterns to a pipe.
+    useTagIndexing: bool
+        if True, tags are stored as indexes from a list of all tags. Each
+        line holds its own list, so this rarely pays off for short patterns.
+    conserveTuple: bool
+        if True, tuple tags are flagged so they can be read back as tuples
+        by older versions (see Pattern.toJSONDict).
+    compression: {None, 'gzip', 'bz2', 'lzma'}
+        codec used to compress the stream. If None, it is inferred from the
+        file extension (see `openFile`).
+
+    Returns
+    -------
+    The number of patterns written.
+
+    """
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    if not hasattr(filePath, 'write'):
+        folderPath = os.path.dirname(filePath)
+        if folderPath and not os.path.exists(folderPath):
+            os.makedirs(folderPath)
+    f = openFile(filePath, 'w', compression)
+    shouldClose = f is not filePath
+    numPatterns = 0
+    try:
+        for p in patterns:
+            for chunk in encoder.iterencode(p.toJSONDict(useTagIndexing=useTagIndexing,
+                                                         conserveTuple=conserveTuple)):
+                f.write(chunk)
+            f.write('\n')
+            numPatterns += 1
+    finally:
+        if shouldClose:
+            f.close()
+    return numPatterns
+
+
 def fromPickleFile(filePath):
     """
     Loads a pattern from a pickle format.
@@ -452,14 +653,14 @@ def fromPickleFile(filePath):
     Parameters
     ----------
     filePath: path
-        file path where to load it.
+        file path where to load it (can be compressed, see `openFile`).
 
     """
-    with open(filePath, 'rb') as f:
+    with openFile(filePath, 'rb') as f:
         return pickle.load(f)
 
 
-def toPickleFile(myPattern, folderPath, nameSuffix=None):
+def toPickleFile(myPattern, folderPath, nameSuffix=None, compression=None):
     """
     Saves a pattern into python's pickle format.
 
@@ -472,17 +673,21 @@ def toPickleFile(myPattern, folderPath, nameSuffix=None):
         The fileName will be pattern.name + nameSuffix + ".pickle"
     nameSuffix: str
         string to append to the name of the file.
+    compression: {None, 'gzip', 'bz2', 'lzma'}
+        if given, the file is compressed and the codec extension is appended
+        to the fileName.
 
     """
     filePath = os.path.join(folderPath, myPattern.name + (nameSuffix or "") + ".pickle")
+    filePath = addCompressionExtension(filePath, compression)
     if not os.path.exists(folderPath):
         os.makedirs(folderPath)
-    with open(filePath, 'wb') as f:
+    with openFile(filePath, 'wb', compression) as f:
         pickle.dump(myPattern, f)
     return os.path.abspath(filePath)
 
 
-def write2pickle(name, data, path='../models/'):
+def write2pickle(name, data, path='../models/', compression=None):
     """
     Write numpy array in pickle format to the selected location.
 
@@ -494,10 +699,200 @@ def write2pickle(name, data, path='../models/'):
         numpy array to be exported to pickle format
     path: str (optional)
          output folder path
+    compression: {None, 'gzip', 'bz2', 'lzma'}
+        if given, the file is compressed and the codec extension is appended
+        to the file name.
 
     """
     if not os.path.exists(path):
         os.makedirs(path)
-    with open(path + name + '.pickle', 'wb') as f:
+    filePath = addCompressionExtension(path + name + '.pickle', compression)
+    with openFile(filePath, 'wb', compression) as f:
         # Pickle the 'data' dictionary using the highest protocol available.
         pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+
+
+def _alignOffset(offset):
+    return -(-offset // _binaryAlignment) * _binaryAlignment
+
+
+def toBinaryFile(state, filePath, compression=None):
+    """
+    Saves a state in the GS-API binary format.
+
+    The state is a nested structure of dicts, lists and JSON compatible
+    values in which numpy arrays are stored as raw data (aligned on 64 bytes)
+    after a JSON header, so that they can be read without parsing or be
+    memory mapped (see `fromBinaryFile`). Tuples are stored as lists.
+
+    Parameters
+    ----------
+    state: dict
+        the state to save.
+    filePath: path
+        the file to write.
+    compression: {None, 'gzip', 'bz2', 'lzma'}
+        codec used to compress the file. If None, it is inferred from the
+        file extension (see `openFile`). Compressed files can't be memory
+        mapped.
+
+    Returns
+    -------
+    The absolute path of the written file.
+
+    """
+    arrays = []
+
+    def _encode(obj):
+        if isinstance(obj, np.ndarray):
+            if obj.dtype.hasobject:
+                raise ValueError("can't save arrays of objects in a binary file")
+            arrays.append(np.ascontiguousarray(obj))
+            return {'__array__': len(arrays) - 1}
+        elif isinstance(obj, dict):
+            return {k: _encode(v) for k, v in obj.items()}
+        elif isinstance(obj, (list, tuple)):
+            return [_encode(v) for v in obj]
+        elif isinstance(obj, np.generic):
+            return obj.item()
+        return obj
+
+    encodedState = _encode(state)
+    arrayInfos = []
+    offset = 0
+    for array in arrays:
+        arrayInfos += [{'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}]
+        offset = _alignOffset(offset + array.nbytes)
+    header = json.dumps({'arrays': arrayInfos, 'state': encodedState}, separators=(',', ':')).encode('utf-8')
+    headerEnd = len(_binaryMagic) + 8 + len(header)
+
+    folderPath = os.path.dirname(filePath)
+    if folderPath and not os.path.exists(folderPath):
+        os.makedirs(folderPath)
+    with openFile(filePath, 'wb', compression) as f:
+        f.write(_binaryMagic + struct.pack('<Q', len(header)) + header)
+        f.write(b'\0' * (_alignOffset(headerEnd) - headerEnd))
+        for array, info in zip(arrays, arrayInfos):
+            f.write(array.tobytes())
+            f.write(b'\0' * (_alignOffset(array.nbytes) - array.nbytes))
+    return os.path.abspath(filePath)
+
+
+def fromBinaryFile(filePath, mmap=False, compression=None):
+    """
+    Loads a state saved by `toBinaryFile`.
+
+    Parameters
+    ----------
+    filePath: path
+        the file to read.
+    mmap: bool
+        if True, arrays are memory mapped instead of being read: loading
+        time does not depend on their size, and the pages of the file are
+        shared between the processes using it. Only uncompressed files can
+        be memory mapped.
+    compression: {None, 'gzip', 'bz2', 'lzma'}
+        codec used to decompress the file. If None, it is inferred (see
+        `openFile`).
+
+    Returns
+    -------
+    The saved state. Arrays are read-only.
+
+    """
+    compression = compression or _inferCompression(filePath, 'rb')
+    if mmap and compression:
+        raise ValueError("can't memory map %s, compressed with %s: decompress it or load it with mmap=False" % (
+            filePath, compression))
+    with openFile(filePath, 'rb', compression) as f:
+        magic = f.read(len(_binaryMagic))
+        if magic != _binaryMagic:
+            raise IOError("%s is not a GS-API binary file" % filePath)
+        headerLength = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(headerLength).decode('utf-8'))
+        headerEnd = len(_binaryMagic) + 8 + headerLength
+        dataStart = _alignOffset(headerEnd)
+        if mmap:
+            data = np.memmap(filePath, dtype=np.uint8, mode='r')
+        else:
+            # skips the padding by reading it, compressed streams can't seek
+            f.read(dataStart - headerEnd)
+            data = np.frombuffer(f.read(), dtype=np.uint8)
+            dataStart = 0
+
+    arrays = []
+    for info in header['arrays']:
+        dtype = np.dtype(info['dtype'])
+        start = dataStart + info['offset']
+        count = int(np.prod(info['shape'], dtype=np.int64))
+        array = data[start:start + count * dtype.itemsize].view(dtype).reshape(info['shape'])
+        array.flags.writeable = False
+        arrays += [array]
+
+    def _decode(obj):
+        if isinstance(obj, dict):
+            if '__array__' in obj and len(obj) == 1:
+                return arrays[obj['__array__']]
+            return {k: _decode(v) for k, v in obj.items()}
+        elif isinstance(obj, list):
+            return [_decode(v) for v in obj]
+        return obj
+
+    return _decode(header['state'])
+
+
+def toStyleFile(style, filePath, compression=None):
+    """
+    Saves a trained style in the GS-API binary format (see `toBinaryFile`
+    and BaseStyle.getBinaryState).
+
+    Parameters
+    ----------
+    style: BaseStyle
+        the style to save.
+    filePath: path
+        the file to write.
+    compression: {None, 'gzip', 'bz2', 'lzma'}
+        codec used to compress the file. If None, it is inferred from the
+        file extension (see `openFile`).
+
+    Returns
+    -------
+    The absolute path of the written file.
+
+    """
+    return toBinaryFile({'style': type(style).__name__, 'state': style.getBinaryState()}, filePath,
+                        compression=compression)
+
+
+def fromStyleFile(filePath, mmap=False, style=None, compression=None):
+    """
+    Loads a style saved by `toStyleFile`.
+
+    Parameters
+    ----------
+    filePath: path
+        the file to read.
+    mmap: bool
+        if True, arrays are memory mapped (see `fromBinaryFile`).
+    style: BaseStyle
+        if given, the state is loaded in this style (e.g. to keep its
+        constructor arguments), otherwise a new style of the saved class is
+        created.
+    compression: {None, 'gzip', 'bz2', 'lzma'}
+        codec used to decompress the file. If None, it is inferred (see
+        `openFile`).
+
+    Returns
+    -------
+    The loaded style.
+
+    """
+    from . import gsstyles
+    saved = fromBinaryFile(filePath, mmap=mmap, compression=compression)
+    if style is None:
+        style = getattr(gsstyles, saved['style'])()
+    elif type(style).__name__ != saved['style']:
+        raise ValueError("%s holds a %s, can't load it in a %s" % (filePath, saved['style'], type(style).__name__))
+    style.setBinaryState(saved['state'])
+    return style
@@ -8,10 +8,17 @@ and Pattern, which are the main holders of musical symbolic information.
 
 from __future__ import absolute_import, division, print_function
 
-import collections
 import copy
 import logging
 import math
+import numbers
+
+import numpy as np
+
+try:
+    from collections.abc import Hashable
+except ImportError:
+    from collections import Hashable
 
 from . import gsdefs, gsutil
 
@@ -58,7 +65,7 @@ class Event(object):
         if isinstance(tag, list):
             gspatternLog.error("'tag' can't be a list, converting to tuple.")
             self.tag = tuple(tag)
-        elif not isinstance(tag, collections.Hashable):
+        elif not isinstance(tag, Hashable):
             gspatternLog.error("'tag' has to be hashable, trying conversion to tuple.")
             self.tag = (tag,)
         else:
@@ -251,6 +258,29 @@ class Pattern(object):
         self.originPattern = None
         self.resolution = 960
 
+    def __copy__(self):
+        """
+        Shallow copy sharing the events list (the packed state of
+        __getstate__ is only meant for pickle).
+
+        """
+        result = type(self).__new__(type(self))
+        result.__dict__.update(self.__dict__)
+        return result
+
+    def __deepcopy__(self, memo):
+        """
+        Attribute-wise deep copy: events are copied one by one through memo,
+        so an event referenced several times (e.g. by viewpoints) is still
+        shared by the copies and no packing cost is paid.
+
+        """
+        result = type(self).__new__(type(self))
+        memo[id(self)] = result
+        for k, v in self.__dict__.items():
+            result.__dict__[k] = copy.deepcopy(v, memo)
+        return result
+
     def __eq__(self, other):
         if isinstance(other, Pattern):
             return (self.events == other.events) and (
@@ -267,6 +297,38 @@ class Pattern(object):
         """
         return self.events[index]
 
+    def __getstate__(self):
+        """
+        Compact state used by pickle (copies don't use it, see __deepcopy__).
+
+        Events are packed in numpy arrays (times, values and a tag table)
+        instead of being pickled one by one. Origin patterns of events
+        (i.e. the sub-patterns of a viewpoint) are packed the same way, their
+        events being stored as indexes in this pattern's originPattern events
+        when they are shared with it, and their own link to that
+        originPattern as a flag.
+
+        Notes
+        -----
+        With pickle protocol 5, the packed arrays can be sent out-of-band:
+        `pickle.dumps(myPattern, protocol=5, buffer_callback=buffers.append)`
+
+        """
+        state = dict(self.__dict__)
+        events = state.pop('events')
+        hasOriginPatterns = any(e.originPattern is not None for e in events)
+        # packing only pays off from a few events
+        packedEvents = None
+        if hasOriginPatterns or len(events) >= _minPackedEvents:
+            packedEvents = _packEvents(events, allowOriginPattern=True)
+        if packedEvents is None:
+            state['events'] = events
+            return state
+        state['packedEvents'] = packedEvents
+        if hasOriginPatterns:
+            state['packedOrigins'] = _packOriginPatterns(events, self.originPattern)
+        return state
+
     def __len__(self):
         return len(self.events)
 
@@ -306,6 +368,24 @@ class Pattern(object):
     def __setitem__(self, index, item):
         self.events[index] = item
 
+    def __setstate__(self, state):
+        state = dict(state)
+        packedEvents = state.pop('packedEvents', None)
+        packedOrigins = state.pop('packedOrigins', None)
+        pendingViewpoints = self.__dict__.pop('_pendingViewpoints', [])
+        self.__dict__.update(state)
+        if packedEvents is not None:
+            self.events = _unpackEvents(packedEvents)
+        if packedOrigins is not None:
+            origin = self.originPattern
+            if origin is not None and 'events' not in origin.__dict__:
+                # viewpoints are restored before the pattern they originate from
+                origin.__dict__.setdefault('_pendingViewpoints', []).append((self, packedOrigins))
+            else:
+                _unpackOriginPatterns(self.events, packedOrigins, origin)
+        for viewpoint, viewpointOrigins in pendingViewpoints:
+            _unpackOriginPatterns(viewpoint.events, viewpointOrigins, self)
+
     def addEvent(self, myEvent):
         """
         Add an event increasing its duration if needed.
@@ -502,11 +582,17 @@ class Pattern(object):
         json: dict
             a dict created from reading json file with GS-API JSON format.
 
+        Notes
+        -----
+        Tuple tags are restored while reading the tags (tag table entries
+        flagged in 'tupleTags', or inline tags), so no extra pass over the
+        whole dict is needed.
+
         """
         self.name = json['name']
         self.duration = json['timeInfo']['duration']
         self.bpm = json['timeInfo']['bpm']
-        self.timeSignature = tuple(json['timeInfo']['timeSignature'])
+        self.timeSignature = _tagFromJSON(json['timeInfo']['timeSignature'])
         if 'originPattern' in json:
             def findOriginPatternInParent(name):
                 if not name:
@@ -524,14 +610,20 @@ class Pattern(object):
 
         hasIndexedTags = 'eventTags' in json.keys()
         if hasIndexedTags:
-            tags = json['eventTags']
+            tags = list(json['eventTags'])
+            for i in json.get('tupleTags', []):
+                tags[i] = _tagFromJSON(tags[i])
             for e in json['eventList']:
+                if 'tagIdx' in e:
+                    tag = tags[e['tagIdx']]
+                else:
+                    # legacy format: one index per element of a tuple tag
+                    tag = tuple([tags[f] for f in e['tagsIdx']])
                 self.events += [Event(startTime=e['on'],
                                       duration=e['duration'],
                                       pitch=e['pitch'],
                                       velocity=e['velocity'],
-                                      tag=tuple(
-                                              [tags[f] for f in e['tagsIdx']])
+                                      tag=tag
                                       )]
         else:
             for e in json['eventList']:
@@ -539,7 +631,7 @@ class Pattern(object):
                                       duration=e['duration'],
                                       pitch=e['pitch'],
                                       velocity=e['velocity'],
-                                      tag=e['tag']
+                                      tag=_tagFromJSON(e['tag'])
                                       )]
 
         self.viewpoints = {k: Pattern().fromJSONDict(v, parentPattern=self) for
@@ -980,7 +1072,7 @@ class Pattern(object):
         """
         self.events.sort(key=lambda x: x.startTime, reverse=False)
 
-    def toJSONDict(self, useTagIndexing=True):
+    def toJSONDict(self, useTagIndexing=True, conserveTuple=False):
         """
         Gives a standard dict for json output.
 
@@ -988,7 +1080,11 @@ class Pattern(object):
         ----------
         useTagIndexing: bool
             if True, tags are stored as indexes from a list of all tags
-            This reduces the size of the JSON file.
+            This reduces the size of the JSON file. Tuple entries of the tag
+            list are flagged in 'tupleTags'.
+        conserveTuple: bool
+            if True and tags are not indexed, tuple tags are written as
+            {'__tuple__': True, 'items': [...]} hints.
 
         """
         res = {}
@@ -998,30 +1094,36 @@ class Pattern(object):
         res['timeInfo'] = {'duration':      self.duration, 'bpm': self.bpm,
                            'timeSignature': self.timeSignature}
         res['eventList'] = []
-        res['viewpoints'] = {k: v.toJSONDict(useTagIndexing) for k, v in
+        res['viewpoints'] = {k: v.toJSONDict(useTagIndexing, conserveTuple) for k, v in
                              self.viewpoints.items()}
         if useTagIndexing:
-            allTags = self.getAllTags()
-            res['eventTags'] = allTags
-
-            def findIdxforTags(tags, allTags):
-                return [allTags.index(x) for x in tags]
-
+            allTags = []
+            tagIndexes = {}
+            tupleTags = []
             for e in self.events:
+                tagIdx = tagIndexes.get(e.tag)
+                if tagIdx is None:
+                    tagIdx = len(allTags)
+                    tagIndexes[e.tag] = tagIdx
+                    if isinstance(e.tag, tuple):
+                        tupleTags += [tagIdx]
+                    allTags += [_tagToJSON(e.tag, conserveTuple=False)]
                 res['eventList'] += [{'on':       e.startTime,
                                       'duration': e.duration,
                                       'pitch':    e.pitch,
                                       'velocity': e.velocity,
-                                      'tagIdx':   findIdxforTags(e.tag,
-                                                                 allTags)
+                                      'tagIdx':   tagIdx
                                       }]
+            res['eventTags'] = allTags
+            if tupleTags:
+                res['tupleTags'] = tupleTags
         else:
             for e in self.events:
                 res['eventList'] += [{'on':       e.startTime,
                                       'duration': e.duration,
                                       'pitch':    e.pitch,
                                       'velocity': e.velocity,
-                                      'tag':      e.tag
+                                      'tag':      _tagToJSON(e.tag, conserveTuple)
                                       }]
 
         return res
@@ -1178,6 +1280,282 @@ class Pattern(object):
             e.tag = [gsutil.pitch2name(e.pitch, gsdefs.defaultPitchNames)]
 
 
+def _tagToJSON(tag, conserveTuple=True):
+    """
+    Converts a tag to a JSON compatible object, flagging tuples with a
+    {'__tuple__': True, 'items': [...]} hint if conserveTuple is True.
+
+    """
+    if isinstance(tag, tuple):
+        items = [_tagToJSON(t, conserveTuple) for t in tag]
+        return {'__tuple__': True, 'items': items} if conserveTuple else items
+    return tag
+
+
+def _tagFromJSON(obj):
+    """
+    Inverse of _tagToJSON. As tags can't be lists, JSON arrays are
+    converted back to tuples as well.
+
+    """
+    if isinstance(obj, list):
+        return tuple([_tagFromJSON(t) for t in obj])
+    if isinstance(obj, dict) and '__tuple__' in obj:
+        return tuple([_tagFromJSON(t) for t in obj['items']])
+    return obj
+
+
+# Pattern attributes stored as plain tuples for packed origin patterns
+_packedPatternAttributes = ('duration', 'bpm', 'timeSignature', 'key', 'originFilePath', 'name', 'startTime',
+                            'resolution')
+_plainPatternAttributes = frozenset(_packedPatternAttributes + ('events', 'viewpoints', 'originPattern'))
+_minPackedEvents = 8
+_eventAttributes = frozenset(['startTime', 'duration', 'pitch', 'velocity', 'originPattern', 'tag'])
+
+
+def _hasAttributes(obj, attributes):
+    """
+    Checks that obj has exactly the given attributes.
+
+    """
+    return len(obj.__dict__) == len(attributes) and attributes.issuperset(obj.__dict__)
+
+
+def _packEvents(events, refEvents=None, allowOriginPattern=False):
+    """
+    Packs a list of Events in numpy arrays (see Pattern.__getstate__).
+    Origin patterns of events are not packed.
+
+    Parameters
+    ----------
+    events: list of Events
+        events to pack.
+    refEvents: list of Events
+        if given, events that are in this list are stored as an index in it.
+    allowOriginPattern: bool
+        if False, events having an originPattern can't be packed.
+
+    Returns
+    -------
+    A dict of arrays, or None if events can't be packed (Event subclasses or
+    extra attributes, non numeric values or unhashable tags).
+
+    """
+    refIndexes = {id(e): i for i, e in enumerate(refEvents)} if refEvents else {}
+    refs = [refIndexes.get(id(e), -1) for e in events] if refIndexes else []
+    packedEvents = [e for e, ref in zip(events, refs) if ref < 0] if any(r >= 0 for r in refs) else events
+    for e in packedEvents:
+        if type(e) is not Event or not _hasAttributes(e, _eventAttributes):
+            return None
+        if not allowOriginPattern and e.originPattern is not None:
+            return None
+    tags = []
+    tagIndexes = {}
+    tagIdx = []
+    try:
+        for e in packedEvents:
+            tagKey = (type(e.tag), e.tag)
+            idx = tagIndexes.get(tagKey)
+            if idx is None:
+                idx = tagIndexes[tagKey] = len(tags)
+                tags += [e.tag]
+            tagIdx += [idx]
+    except TypeError:
+        # unhashable tag
+        return None
+    timePairs = [(e.startTime, e.duration) for e in packedEvents]
+    times = gsutil.compactArray(timePairs)
+    values = gsutil.compactArray([(e.pitch, e.velocity, i) for e, i in zip(packedEvents, tagIdx)])
+    if times is None or values is None or values.dtype.kind not in 'iu':
+        return None
+    packed = {'times': times.reshape(-1, 2), 'values': values.reshape(-1, 3), 'tags': tags}
+    if times.dtype.kind == 'f':
+        # integer times mixed with float ones are restored as integers
+        intTimes = np.array([[isinstance(t, numbers.Integral) for t in pair] for pair in timePairs], dtype=bool)
+        if intTimes.any():
+            packed['intTimes'] = intTimes.reshape(-1, 2)
+    if packedEvents is not events:
+        packed['refs'] = gsutil.compactArray(refs)
+    return packed
+
+
+def _unpackEvents(packed, refEvents=None):
+    """
+    Inverse of _packEvents.
+
+    """
+    tags = packed['tags']
+    times = packed['times'].tolist()
+    if packed.get('intTimes') is not None:
+        times = [[int(t) if isInt else t for t, isInt in zip(pair, intPair)]
+                 for pair, intPair in zip(times, packed['intTimes'].tolist())]
+    events = []
+    for (startTime, duration), (pitch, velocity, tagIdx) in zip(times, packed['values'].tolist()):
+        e = Event.__new__(Event)
+        e.__dict__ = {'startTime': startTime, 'duration': duration, 'pitch': pitch, 'velocity': velocity,
+                      'originPattern': None, 'tag': tags[tagIdx]}
+        events += [e]
+    if 'refs' in packed:
+        unpacked = iter(events)
+        events = [refEvents[ref] if ref >= 0 else next(unpacked) for ref in packed['refs'].tolist()]
+    return events
+
+
+def _packOriginPatterns(events, parent=None):
+    """
+    Packs the origin patterns of events (see Pattern.__getstate__).
+    Plain origin patterns (no viewpoints, no origin other than parent and
+    packable events) are packed together, others are kept as they are.
+    Their events shared with parent are stored as indexes in parent.events.
+
+    """
+    patternIndexes = {}
+    origins = []
+    eventOrigins = []
+    for e in events:
+        origin = e.originPattern
+        if origin is None:
+            eventOrigins += [-1]
+            continue
+        if id(origin) not in patternIndexes:
+            patternIndexes[id(origin)] = len(origins)
+            origins += [origin]
+        eventOrigins += [patternIndexes[id(origin)]]
+
+    packed = {'eventOrigins': gsutil.compactArray(eventOrigins), 'patterns': origins}
+    patterns = []
+    headers = []
+    offsets = [0]
+    packedEvents = []
+    parentOrigins = []
+    for origin in origins:
+        if type(origin) is Pattern and not origin.viewpoints and \
+                (origin.originPattern is None or origin.originPattern is parent) and \
+                _hasAttributes(origin, _plainPatternAttributes):
+            patterns += [len(headers)]
+            headers += [tuple([origin.__dict__[k] for k in _packedPatternAttributes])]
+            parentOrigins += [origin.originPattern is not None]
+            packedEvents += origin.events
+            offsets += [len(packedEvents)]
+        else:
+            patterns += [origin]
+    if headers:
+        packedEventsDict = _packEvents(packedEvents, parent.events if parent is not None else None)
+        if packedEventsDict is not None:
+            packed['patterns'] = patterns
+            packed['headers'] = headers
+            packed['offsets'] = gsutil.compactArray(offsets)
+            packed['events'] = packedEventsDict
+            if any(parentOrigins):
+                packed['parentOrigins'] = np.array(parentOrigins, dtype=bool)
+    return packed
+
+
+def _unpackOriginPatterns(events, packed, parent=None):
+    """
+    Inverse of _packOriginPatterns, sets the originPattern of given events.
+
+    """
+    patterns = packed['patterns']
+    if 'headers' in packed:
+        allEvents = _unpackEvents(packed['events'], parent.events if parent is not None else None)
+        offsets = packed['offsets'].tolist()
+        headers = packed['headers']
+        parentOrigins = packed['parentOrigins'].tolist() if 'parentOrigins' in packed else [False] * len(headers)
+        patterns = list(patterns)
+        for i, entry in enumerate(patterns):
+            if isinstance(entry, Pattern):
+                continue
+            p = Pattern.__new__(Pattern)
+            p.__dict__ = dict(zip(_packedPatternAttributes, headers[entry]))
+            p.events = allEvents[offsets[entry]:offsets[entry + 1]]
+            p.viewpoints = {}
+            p.originPattern = parent if parentOrigins[entry] else None
+            patterns[i] = p
+    for e, originIdx in zip(events, packed['eventOrigins'].tolist()):
+        e.originPattern = patterns[originIdx] if originIdx >= 0 else None
+
+
+def packPatterns(patterns):
+    """
+    Packs a list of patterns in a few numpy arrays, e.g. to save a pattern
+    database in a binary file (see gsio.toBinaryFile).
+
+    Events of all patterns are concatenated and packed as in
+    Pattern.__getstate__, each pattern keeping a JSON compatible header
+    (name, time info and viewpoints).
+
+    Returns
+    -------
+    A dict {'headers', 'offsets', 'times', 'values', 'tags'} (events of
+    pattern i are the rows offsets[i]:offsets[i + 1] of times and values,
+    and of 'intTimes' flagging integer times if there are some), or None if
+    events can't be packed.
+
+    """
+    headers = []
+    offsets = [0]
+    events = []
+    for p in patterns:
+        header = {'name': p.name,
+                  'timeInfo': {'duration': p.duration, 'bpm': p.bpm,
+                               'timeSignature': _tagToJSON(p.timeSignature, conserveTuple=False)}}
+        if p.viewpoints:
+            header['viewpoints'] = {k: v.toJSONDict() for k, v in p.viewpoints.items()}
+        headers += [header]
+        events += p.events
+        offsets += [len(events)]
+    packed = _packEvents(events)
+    if packed is None:
+        return None
+    packed['tags'] = [_tagToJSON(t, conserveTuple=False) for t in packed['tags']]
+    packed['headers'] = headers
+    packed['offsets'] = np.array(offsets, dtype=np.int64)
+    return packed
+
+
+class PackedPatterns(object):
+    """
+    Read-only sequence of the patterns packed by packPatterns.
+    Patterns are only built when accessed (and then kept), so that large
+    databases can be loaded without creating all their events.
+
+    Parameters
+    ----------
+    packed: dict
+        a dict created by packPatterns (arrays can be memory mapped).
+
+    """
+
+    def __init__(self, packed):
+        self.packed = packed
+        self.tags = [_tagFromJSON(t) for t in packed['tags']]
+        self.offsets = np.asarray(packed['offsets'], dtype=np.int64)
+        self.patterns = [None] * len(packed['headers'])
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if self.patterns[index] is None:
+            header = self.packed['headers'][index]
+            p = Pattern().fromJSONDict(dict(header, eventList=[], viewpoints=header.get('viewpoints', {})))
+            start, end = self.offsets[index], self.offsets[index + 1]
+            intTimes = self.packed.get('intTimes')
+            p.events = _unpackEvents({'times': self.packed['times'][start:end],
+                                      'values': self.packed['values'][start:end], 'tags': self.tags,
+                                      'intTimes': intTimes[start:end] if intTimes is not None else None})
+            p.durationToLastEvent()
+            self.patterns[index] = p
+        return self.patterns[index]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
 def patternToList(myPattern):
     """
     Converts a myPattern to a regular python list.
@@ -1,12 +1,22 @@
 from __future__ import absolute_import, division, print_function
 
+import bisect
+import collections
 import copy
+import itertools
 import logging
-import random
+import multiprocessing
+import numbers
+import os
+import threading
 
+import numpy as np
+
+from . import gsdescriptors, gsio, gspattern, gsutil
 from .gspattern import Pattern
 
 markovLog = logging.getLogger('gsapi.styles.markov_style')
+databaseLog = logging.getLogger('gsapi.styles.database_style')
 # todo change this to fit the new reorganisation!
 
 
@@ -86,6 +96,49 @@ class BaseStyle(object):
         """
         raise NotImplementedError("Not Implemented.")
 
+    def getBinaryState(self):
+        """
+        Returns the state saved by saveToFile: a dict of JSON compatible
+        values and numpy arrays (see gsio.toBinaryFile).
+        Defaults to getInternalState.
+
+        """
+        return self.getInternalState()
+
+    def setBinaryState(self, state):
+        """
+        Loads a state returned by getBinaryState.
+        Arrays may be read-only or memory mapped.
+
+        """
+        self.setInternalState(state)
+
+    def saveToFile(self, filePath, compression=None):
+        """
+        Saves the style in the GS-API binary format (see gsio.toStyleFile),
+        optionally compressed.
+
+        """
+        return gsio.toStyleFile(self, filePath, compression=compression)
+
+    def loadFromFile(self, filePath, mmap=False, compression=None):
+        """
+        Loads a style saved by saveToFile.
+
+        Parameters
+        ----------
+        filePath: path
+            the file to load.
+        mmap: bool
+            if True, arrays are memory mapped instead of being read (only
+            for uncompressed files).
+        compression: {None, 'gzip', 'bz2', 'lzma'}
+            codec used to decompress the file, inferred if None.
+
+        """
+        gsio.fromStyleFile(filePath, mmap=mmap, style=self, compression=compression)
+        return self
+
     def saveToJSON(self, filePath):
         import json
         state = self.getInternalState()
@@ -105,7 +158,8 @@ class BaseStyle(object):
             import pickle
         else:
             import cPickle as pickle
-        pickle.dump(self, filePath)
+        with gsio.openFile(filePath, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
 
     def loadFromPickle(self, filePath):
         import sys
@@ -113,27 +167,86 @@ class BaseStyle(object):
             import pickle
         else:
             import cPickle as pickle
-        self = pickle.load(filePath)
+        with gsio.openFile(filePath, 'rb') as f:
+            loaded = pickle.load(f)
+        if not isinstance(loaded, type(self)):
+            raise ValueError("%s holds a %s, can't load it in a %s" % (filePath, type(loaded).__name__,
+                                                                       type(self).__name__))
+        self.__dict__.update(loaded.__dict__)
+        return self
 
 
 class DatabaseStyle(BaseStyle):
     """
     A database based style. It generates patterns from already existing patterns
 
+    Patterns are indexed by their descriptor values (see DescriptorIndex), so
+    that the closest patterns of the database can be found quickly.
+
     Parameter
     ---------
     generatePatternOrdering: {'indexed', 'increasing', 'random'}
         Defines the generatePattern behaviour.
+    rng: numpy.random.Generator or seed
+        random generator owned by this style (see gsutil.makeRandomGenerator).
+    descriptors: dict
+        {name: descriptor} of numeric descriptors (see gsdescriptors) used as
+        features (default: density, number of tags and syncopation).
+    leafSize: int
+        maximum number of patterns in a leaf of the index.
 
     """
 
-    def __init__(self, generatePatternOrdering="indexed"):
+    def __init__(self, generatePatternOrdering="indexed", rng=None, descriptors=None, leafSize=32):
         self.generatePatternOrdering = generatePatternOrdering
         self.patternList = []
         self.currentIdx = 0
+        self.rng = gsutil.makeRandomGenerator(rng)
+        self.descriptors = descriptors or {"density": gsdescriptors.Density(),
+                                           "numberOfTags": gsdescriptors.NumberOfTags(),
+                                           "syncopation": gsdescriptors.Syncopation()}
+        self.leafSize = leafSize
+        self.index = None
+        self.featureMean = None
+        self.featureScale = None
 
     def generateStyle(self, PatternClasses):
         self.patternList = PatternClasses
+        self.buildIndex()
+
+    def buildIndex(self):
+        """
+        Computes the descriptors of all the patterns and indexes them.
+        Features are standardized so that each descriptor has the same weight.
+
+        """
+        features = self.getFeatures(self.patternList, normalize=False)
+        if len(features):
+            self.featureMean = features.mean(axis=0)
+            scale = features.std(axis=0)
+            self.featureScale = np.where(scale > 0, scale, 1.)
+        else:
+            self.featureMean = np.zeros(len(self.descriptors))
+            self.featureScale = np.ones(len(self.descriptors))
+        self.index = DescriptorIndex((features - self.featureMean) / self.featureScale, leafSize=self.leafSize)
+
+    def getFeatures(self, patterns, normalize=True):
+        """
+        Returns a numpy array (numPatterns, numDescriptors) of descriptor
+        values, standardized as in the index if normalize.
+
+        """
+        names = sorted(self.descriptors)
+        features = np.zeros((len(patterns), len(names)))
+        for i, p in enumerate(patterns):
+            for j, name in enumerate(names):
+                value = self.descriptors[name].getDescriptorForPattern(p)
+                if not isinstance(value, numbers.Number):
+                    raise ValueError("descriptor %s isn't numeric: %s" % (name, value))
+                features[i, j] = value
+        if normalize:
+            features = (features - self.featureMean) / self.featureScale
+        return features
 
     def generatePattern(self, seed=None):
         if self.generatePatternOrdering == 'increasing':
@@ -142,18 +255,55 @@ class DatabaseStyle(BaseStyle):
             print("reading", self.currentIdx)
             return p
         elif self.generatePatternOrdering == 'random':
-            return self.patternList[int(random.random() * len(self.patternList))]
+            rng = self.rng if seed is None else gsutil.makeRandomGenerator(seed)
+            return self.patternList[int(rng.integers(len(self.patternList)))]
         elif self.generatePatternOrdering == 'indexed':
             return self.patternList[self.currentIdx]
 
+    def getNeighbours(self, patterns, k=1):
+        """
+        k nearest patterns of the database in descriptor space.
+
+        Parameters
+        ----------
+        patterns: list of Patterns
+            the patterns to look for.
+        k: int
+            number of neighbours.
+
+        Returns
+        -------
+        A tuple (indexes, distances) of arrays (numPatterns, k): indexes in
+        patternList and distances in standardized descriptor space.
+
+        """
+        return self.index.query(self.getFeatures(patterns), k=k)
+
     def getDistanceFromStyle(self, pattern):
-        raise NotImplementedError("Should have implemented this")
+        """
+        Distance to the closest pattern of the database in descriptor space,
+        mapped to [0, 1).
+
+        """
+        return float(_normalizeDistances(self.getNeighbours([pattern])[1][0, 0]))
 
     def getClosestPattern(self, pattern, seed=0):
-        raise NotImplementedError("Should have implemented this")
+        """
+        Returns the closest pattern of the database in descriptor space.
+
+        """
+        return self.patternList[int(self.getNeighbours([pattern])[0][0, 0])]
 
     def getInterpolated(self, patternA, patternB, distanceFromA, seed=0):
-        raise NotImplementedError("Should have implemented this")
+        """
+        Returns the pattern of the database closest to the point at
+        distanceFromA (between 0 and 1) on the segment from A to B in
+        descriptor space.
+
+        """
+        featuresA, featuresB = self.getFeatures([patternA, patternB])
+        point = featuresA + distanceFromA * (featuresB - featuresA)
+        return self.patternList[int(self.index.query(point[None, :], k=1)[0][0, 0])]
 
     def getInternalState(self):
         res = {"patternList": []}
@@ -167,9 +317,180 @@ class DatabaseStyle(BaseStyle):
             p = Pattern()
             p.fromJSONDict(e)
             self.patternList += [p]
+        self.buildIndex()
+
+    def getBinaryState(self):
+        """
+        Patterns are packed in a few arrays (see gspattern.packPatterns) and
+        the index is saved as well, so that loading does neither parse nor
+        describe the patterns. Falls back to getInternalState if events
+        can't be packed.
+
+        """
+        packed = gspattern.packPatterns(self.patternList)
+        if packed is None:
+            return self.getInternalState()
+        return {"patterns": packed, "descriptors": sorted(self.descriptors),
+                "featureMean": self.featureMean, "featureScale": self.featureScale,
+                "index": self.index.toArrayDict()}
+
+    def setBinaryState(self, state):
+        if "patternList" in state:
+            self.setInternalState(state)
+            return
+        self.patternList = gspattern.PackedPatterns(state["patterns"])
+        self.currentIdx = 0
+        if sorted(self.descriptors) != state["descriptors"]:
+            databaseLog.warning("saved index uses descriptors %s, rebuilding it" % state["descriptors"])
+            self.buildIndex()
+            return
+        self.featureMean = np.asarray(state["featureMean"], dtype=np.float64)
+        self.featureScale = np.asarray(state["featureScale"], dtype=np.float64)
+        self.index = DescriptorIndex.fromArrayDict(state["index"])
 
     def isBuilt(self):
-        self.patternList != []
+        return len(self.patternList) > 0 and self.index is not None
+
+
+class DescriptorIndex(object):
+    """
+    KD-tree over feature vectors for nearest neighbour queries.
+
+    Points are reordered so that each node covers a contiguous range of
+    them; nodes split the points at the median of their widest dimension
+    until they hold at most leafSize points, and keep their bounding box to
+    prune the search.
+
+    Parameters
+    ----------
+    features: numpy array
+        float array (numPoints, numDimensions).
+    leafSize: int
+        maximum number of points in a leaf.
+
+    """
+
+    def __init__(self, features, leafSize=32):
+        features = np.asarray(features, dtype=np.float64)
+        self.leafSize = max(1, leafSize)
+        self.indexes = np.arange(len(features))
+        self.nodeStarts, self.nodeEnds, self.nodeChildren = [], [], []
+        self.lowerBounds, self.upperBounds = [], []
+        if len(features):
+            self._build(features, 0, len(features))
+        self.points = features[self.indexes]
+        self.lowerBounds = np.array(self.lowerBounds).reshape(-1, features.shape[1])
+        self.upperBounds = np.array(self.upperBounds).reshape(-1, features.shape[1])
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def toArrayDict(self):
+        """
+        Gives a dict of arrays describing the tree (see gsio.toBinaryFile).
+
+        """
+        children = [c if c is not None else (-1, -1) for c in self.nodeChildren]
+        return {'leafSize': self.leafSize, 'indexes': self.indexes, 'points': self.points,
+                'nodeStarts': np.array(self.nodeStarts, dtype=np.int64),
+                'nodeEnds': np.array(self.nodeEnds, dtype=np.int64),
+                'nodeChildren': np.array(children, dtype=np.int64).reshape(-1, 2),
+                'lowerBounds': self.lowerBounds, 'upperBounds': self.upperBounds}
+
+    @classmethod
+    def fromArrayDict(cls, arrays):
+        """
+        Creates an index from a dict created by toArrayDict, without
+        rebuilding the tree.
+
+        """
+        index = cls.__new__(cls)
+        index.leafSize = arrays['leafSize']
+        index.indexes = arrays['indexes']
+        index.points = arrays['points']
+        index.nodeStarts = arrays['nodeStarts'].tolist()
+        index.nodeEnds = arrays['nodeEnds'].tolist()
+        index.nodeChildren = [tuple(c) if c[0] >= 0 else None for c in arrays['nodeChildren'].tolist()]
+        index.lowerBounds = arrays['lowerBounds']
+        index.upperBounds = arrays['upperBounds']
+        return index
+
+    def _build(self, features, start, end):
+        node = len(self.nodeStarts)
+        points = features[self.indexes[start:end]]
+        lower, upper = points.min(axis=0), points.max(axis=0)
+        self.nodeStarts += [start]
+        self.nodeEnds += [end]
+        self.nodeChildren += [None]
+        self.lowerBounds += [lower]
+        self.upperBounds += [upper]
+        dimension = int(np.argmax(upper - lower))
+        if end - start <= self.leafSize or upper[dimension] == lower[dimension]:
+            return node
+        middle = (start + end) // 2
+        order = np.argpartition(points[:, dimension], middle - start)
+        self.indexes[start:end] = self.indexes[start:end][order]
+        self.nodeChildren[node] = (self._build(features, start, middle), self._build(features, middle, end))
+        return node
+
+    def query(self, points, k=1):
+        """
+        k nearest neighbours of each point.
+
+        Parameters
+        ----------
+        points: numpy array
+            float array (numPoints, numDimensions).
+        k: int
+            number of neighbours (at most the number of indexed points).
+
+        Returns
+        -------
+        A tuple (indexes, distances) of arrays (numPoints, k), sorted by
+        increasing euclidean distance.
+
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        k = min(k, len(self))
+        indexes = np.zeros((len(points), k), dtype=np.int64)
+        distances = np.zeros((len(points), k))
+        for i, point in enumerate(points):
+            indexes[i], distances[i] = self._queryPoint(point, k)
+        return indexes, np.sqrt(distances)
+
+    def _boxDistance(self, node, point):
+        gaps = np.maximum(self.lowerBounds[node] - point, 0) + np.maximum(point - self.upperBounds[node], 0)
+        return float(np.dot(gaps, gaps))
+
+    def _queryPoint(self, point, k):
+        """
+        Depth first search of the k nearest (squared distances), visiting the
+        closest child first and skipping nodes farther than the k-th best.
+
+        """
+        bestIndexes = np.zeros(0, dtype=np.int64)
+        bestDistances = np.zeros(0)
+        if k == 0:
+            return bestIndexes, bestDistances
+        stack = [(self._boxDistance(0, point), 0)]
+        while stack:
+            boxDistance, node = stack.pop()
+            if len(bestDistances) == k and boxDistance > bestDistances[-1]:
+                continue
+            children = self.nodeChildren[node]
+            if children is None:
+                start, end = self.nodeStarts[node], self.nodeEnds[node]
+                differences = self.points[start:end] - point
+                distances = np.einsum('ij,ij->i', differences, differences)
+                bestDistances = np.concatenate([bestDistances, distances])
+                bestIndexes = np.concatenate([bestIndexes, self.indexes[start:end]])
+                order = np.argsort(bestDistances, kind='mergesort')[:k]
+                bestDistances, bestIndexes = bestDistances[order], bestIndexes[order]
+            else:
+                left, right = [(self._boxDistance(child, point), child) for child in children]
+                # the closest child is visited first
+                stack += [right, left] if left[0] <= right[0] else [left, right]
+        return bestIndexes, bestDistances
 
 
 class MarkovStyle(BaseStyle):
@@ -182,14 +503,21 @@ class MarkovStyle(BaseStyle):
         order used for markov computation.
     numSteps: int
         number of steps to consider (binarization of pattern).
+    rng: numpy.random.Generator or seed
+        random generator owned by this style (see gsutil.makeRandomGenerator).
+    backoff: bool
+        use shorter contexts for unseen combinations (see PatternMarkov).
+    minContextCount: float
+        minimum count of a context to be used with backoff.
 
     """
 
-    def __init__(self, order=2, numSteps=16, loopDuration=4):
+    def __init__(self, order=2, numSteps=16, loopDuration=4, rng=None, backoff=False, minContextCount=1):
         # BaseStyle.__init__(self)
         # self.type = "Style"
         self.markovChain = PatternMarkov(order=order, numSteps=numSteps,
-                                         loopDuration=loopDuration)
+                                         loopDuration=loopDuration, rng=rng,
+                                         backoff=backoff, minContextCount=minContextCount)
 
     def generateStyle(self, listOfPatterns):
         """
@@ -210,18 +538,100 @@ class MarkovStyle(BaseStyle):
         """
         self.markovChain.buildTransitionTable()
 
+    def addPatterns(self, listOfPatterns):
+        """
+        Updates the style with new patterns, without retraining on the
+        previous ones.
+
+        Parameters
+        ----------
+        listOfPatterns: list
+            list of Patterns
+
+        """
+        self.markovChain.addPatterns(listOfPatterns)
+
+    def removePatterns(self, listOfPatterns):
+        """
+        Removes patterns previously used to build the style.
+
+        Parameters
+        ----------
+        listOfPatterns: list
+            list of Patterns
+
+        """
+        self.markovChain.removePatterns(listOfPatterns)
+
+    def compact(self, minCount=0, minProbability=0, quantize=False):
+        """
+        Prunes rare transitions and optionally quantizes probabilities to
+        make the style smaller (see PatternMarkov.compact).
+
+        Returns
+        -------
+        dict {'numTransitions': (before, after), 'numBytes': (before, after)}
+
+        """
+        return self.markovChain.compact(minCount=minCount, minProbability=minProbability, quantize=quantize)
+
     def generatePattern(self, seed=None):
         """Generates a new pattern.
 
         Parameters
         ----------
-        seed: float
-            seed for random initialisation of the pattern.
-            ('None' generates a new one).
+        seed: int
+            seed for random initialisation of the pattern
+            ('None' uses the style's random generator).
 
         """
         return self.markovChain.generatePattern(seed=seed)
 
+    def generatePatterns(self, numPatterns, seed=None, asArray=False):
+        """Generates many patterns at once (see PatternMarkov.generatePatterns).
+
+        Parameters
+        ----------
+        numPatterns: int
+            number of patterns to generate.
+        seed: int or numpy.random.Generator
+            seed for random initialisation ('None' uses the style's random
+            generator).
+        asArray: bool
+            if True returns the generated state ids instead of patterns.
+
+        """
+        return self.markovChain.generatePatterns(numPatterns, seed=seed, asArray=asArray)
+
+    def generateGrid(self, numPatterns=None, seed=None, tags=None, velocity=None, packed=False):
+        """Generates step grids instead of patterns (see PatternMarkov.generateGrid).
+
+        """
+        return self.markovChain.generateGrid(numPatterns, seed=seed, tags=tags, velocity=velocity, packed=packed)
+
+    def generateConstrainedPatterns(self, numPatterns, requiredTags=None, forbiddenTags=None, allowedStates=None,
+                                    seed=None, asArray=False):
+        """Generates patterns satisfying per-step constraints, e.g. to keep the
+        kick on steps 0 and 8 and vary everything else:
+        `generateConstrainedPatterns(10, requiredTags={0: ["Kick"], 8: ["Kick"]})`.
+
+        Parameters
+        ----------
+        numPatterns: int
+            number of patterns to generate.
+        requiredTags, forbiddenTags, allowedStates: dict
+            constraints per step (see PatternMarkov.getConstraintMask).
+        seed: int or numpy.random.Generator
+            seed for random initialisation ('None' uses the style's random
+            generator).
+        asArray: bool
+            if True returns the generated state ids instead of patterns.
+
+        """
+        mask = self.markovChain.getConstraintMask(requiredTags=requiredTags, forbiddenTags=forbiddenTags,
+                                                  allowedStates=allowedStates)
+        return self.markovChain.generateConstrainedPatterns(numPatterns, mask, seed=seed, asArray=asArray)
+
     def formatPattern(self, p):
         # p.quantize(self.loopDuration * 1.0 / self.numSteps, self.numSteps * 1.0/ self.loopDuration)
         p.timeStretch(self.numSteps * 1.0 / self.loopDuration)
@@ -238,11 +648,64 @@ class MarkovStyle(BaseStyle):
             events += [pattern.getStartingEventsAtTime(idx)]
         return events
 
-    def getDistanceFromStyle(self, Pattern):
-        raise NotImplementedError("Not Implemented.")
+    def getDistanceFromStyle(self, pattern, unseenProbability=1e-6):
+        """
+        Mean negative log-likelihood of the steps of a pattern under the
+        style, mapped to [0, 1] (see getDistancesFromStyle).
 
-    def getClosestPattern(self, Pattern, seed=0):
-        raise NotImplementedError("Not Implemented.")
+        """
+        return float(self.getDistancesFromStyle([pattern], unseenProbability=unseenProbability)[0])
+
+    def getDistancesFromStyle(self, patterns, unseenProbability=1e-6):
+        """
+        Scores many patterns at once.
+
+        Parameters
+        ----------
+        patterns: list of Patterns or Dataset
+            patterns to score.
+        unseenProbability: float
+            probability given to unobserved transitions, so that distances
+            stay finite (0 gives infinite distances).
+
+        Returns
+        -------
+        A numpy array with the mean negative log-likelihood per step d of
+        each pattern, mapped to [0, 1] by d / (1 + d) as in DatabaseStyle (0
+        for patterns certain under the style, 1 for impossible ones).
+
+        """
+        markovChain = self.markovChain
+        logLikelihoods = markovChain.getLogLikelihoods(patterns, unseenProbability=unseenProbability)
+        return _normalizeDistances(-logLikelihoods / (markovChain.numSteps - markovChain.order + 1))
+
+    def getClosestPattern(self, pattern, seed=0, editCost=1.):
+        """
+        Returns the most likely pattern of the style close to a given one
+        (see getClosestPatterns). The search is deterministic, seed is
+        unused.
+
+        """
+        return self.getClosestPatterns([pattern], editCost=editCost)[0]
+
+    def getClosestPatterns(self, patterns, editCost=1.):
+        """
+        Finds the closest patterns of the style to many patterns at once.
+
+        Parameters
+        ----------
+        patterns: list of Patterns or Dataset
+            patterns to approach.
+        editCost: float
+            cost of adding or removing a tag at a step, relative to the
+            log-likelihood of the patterns (see PatternMarkov.getClosestPatterns).
+
+        Returns
+        -------
+        A lazy sequence of the closest patterns.
+
+        """
+        return self.markovChain.getClosestPatterns(patterns, editCost=editCost)
 
     def getInterpolated(self, PatternA, PatternB, distanceFromA, seed=0):
         raise NotImplementedError("Not Implemented.")
@@ -254,252 +717,2010 @@ class MarkovStyle(BaseStyle):
     def setInternalState(self, state):
         self.markovChain.setInternalState(state["markovChain"])
 
+    def getBinaryState(self):
+        return {"markovChain": self.markovChain.getBinaryState()}
+
+    def setBinaryState(self, state):
+        self.markovChain.setBinaryState(state["markovChain"])
+
     def isBuilt(self):
         return self.markovChain.isBuilt()
 
 
-class PatternMarkov(object):
+class FactorizedMarkovStyle(BaseStyle):
     """
-    Computes a Markov chain from pattern.
+    Style made of one Markov chain per tag: the chain of a tag models
+    whether it starts at each step, given whether it started at the `order`
+    previous steps (wrapping around the loop) and, optionally, whether an
+    anchor tag (e.g. the kick) starts at the same step.
+
+    Counts are dense arrays (numTags, numSteps, numContexts, 2) with
+    numContexts = 2 ** order (twice as many with an anchor), so tables grow
+    linearly with the number of tags instead of with the number of tag
+    combinations. All the chains are counted in a single vectorized pass
+    and sampled together, step by step, the anchor being sampled first.
+    Contexts unseen at a step fall back to the probability of the tag at
+    this step (given the anchor).
 
     Parameters
     ----------
     order: int
-        order used for markov computation
+        number of previous steps of each chain.
     numSteps: int
-        number of steps to consider (binarization of pattern)
+        number of steps to consider (binarization of pattern).
+    loopDuration: float
+        duration of the patterns.
+    anchorTag: tag
+        if given, other tags are conditioned on this tag.
+    rng: numpy.random.Generator or seed
+        random generator owned by this style (see gsutil.makeRandomGenerator).
 
     """
 
-    def __init__(self, order=1, numSteps=32, loopDuration=4):
+    def __init__(self, order=2, numSteps=16, loopDuration=4, anchorTag=None, rng=None):
         self.order = order
         self.numSteps = numSteps
         self.loopDuration = loopDuration
-        self.transitionTable = {}
+        self.anchorTag = anchorTag
+        self.rng = gsutil.makeRandomGenerator(rng)
+        self.tags = []
+        self.counts = None
+        self.startCounts = None
+        self._probabilities = None
 
-    def generateTransitionTableFromPatternList(self, patternClasses):
-        """Generate style based on list of Pattern
-        Args:
-            patternClasses:  list of GSPatterns
+    def generateStyle(self, PatternClasses):
+        grid, tags = binarizePatterns(PatternClasses, self.numSteps, self.loopDuration)
+        silence = tags.index('silence')
+        self.tags = tags[:silence] + tags[silence + 1:]
+        if self.anchorTag is not None and self.anchorTag not in self.tags:
+            raise ValueError("anchor tag %s isn't in patterns" % (self.anchorTag,))
+        grid = np.delete(grid, silence, axis=2)
+        numTags = len(self.tags)
+        histories = self._getHistories(grid)
+        contexts = self._getContexts(histories, grid)
+        tagIdx = np.broadcast_to(np.arange(numTags), grid.shape)
+        steps = np.broadcast_to(np.arange(self.numSteps)[:, None], grid.shape)
+        numContexts = self._getNumContexts()
+        entries = ((tagIdx * self.numSteps + steps) * numContexts + contexts) * 2 + grid
+        self.counts = np.bincount(entries.ravel(), minlength=numTags * self.numSteps * numContexts * 2).reshape(
+            numTags, self.numSteps, numContexts, 2).astype(np.float64)
+        startEntries = np.arange(numTags) * (1 << self.order) + histories[:, 0]
+        self.startCounts = np.bincount(startEntries.ravel(), minlength=numTags << self.order).reshape(
+            numTags, 1 << self.order).astype(np.float64)
+        self._probabilities = None
+
+    def _getNumContexts(self):
+        return (1 << self.order) * (2 if self.anchorTag is not None else 1)
+
+    def _getHistories(self, grid):
         """
-        if not isinstance(patternClasses, list):
-            markovLog.error("PatternMarkov needs a list of patterns")
-            return False
-        else:
-            self.originPatterns = patternClasses
-            self.buildTransitionTable()
+        Int array (numPatterns, numSteps, numTags) of the previous steps of
+        each tag, the previous step being the lowest bit.
 
-    def getMarkovConfig(self):
-        return "order(%i), loopLength(%f), numSteps(%i)" % (
-            self.order, self.loopDuration, self.numSteps)
+        """
+        histories = np.zeros(grid.shape, dtype=np.int64)
+        for i in range(1, self.order + 1):
+            histories |= np.roll(grid, i, axis=1).astype(np.int64) << (i - 1)
+        return histories
+
+    def _getContexts(self, histories, grid):
+        if self.anchorTag is None:
+            return histories
+        anchor = self.tags.index(self.anchorTag)
+        anchorBits = grid[:, :, anchor:anchor + 1].astype(np.int64) << self.order
+        contexts = histories | anchorBits
+        contexts[:, :, anchor] = histories[:, :, anchor]
+        return contexts
+
+    @property
+    def probabilities(self):
+        """
+        Probability that each tag starts (numTags, numSteps, numContexts),
+        unseen contexts falling back to the probability of the tag at their
+        step (given the anchor).
 
-    def buildTransitionTable(self):
         """
-        Builds a transition table with the previously given list of Patterns.
+        if self._probabilities is None:
+            counts = self.counts
+            stepCounts = counts.sum(axis=2, keepdims=True)
+            fallback = stepCounts[..., 1] / np.maximum(stepCounts.sum(axis=-1), 1)
+            if self.anchorTag is not None:
+                numTags = len(self.tags)
+                anchorCounts = counts.reshape(numTags, self.numSteps, 2, 1 << self.order, 2).sum(axis=3)
+                anchorTotals = anchorCounts.sum(axis=-1)
+                anchorFallback = np.where(anchorTotals > 0, anchorCounts[..., 1] / np.maximum(anchorTotals, 1),
+                                          fallback)
+                fallback = np.repeat(anchorFallback, 1 << self.order, axis=2)
+            totals = counts.sum(axis=-1)
+            self._probabilities = np.where(totals > 0, counts[..., 1] / np.maximum(totals, 1), fallback)
+        return self._probabilities
+
+    def generatePattern(self, seed=None):
+        return self.generatePatterns(1, seed=seed)[0]
 
+    def generatePatterns(self, numPatterns, seed=None, asArray=False):
         """
-        self.transitionTable = [{} for f in range(int(self.numSteps))]
+        Generates many patterns at once, all the chains being sampled
+        together.
 
-        self.binarizedPatterns = copy.deepcopy(self.originPatterns)
-        for p in self.binarizedPatterns:
-            self.formatPattern(p)
-            self.checkSilences(p)
-            if self.numSteps != int(p.duration):
-                markovLog.warning(
-                        "PatternMarkov: quantization to numSteps failed, numSteps=" + str(
-                                self.numSteps) + " duration=" + str(
-                                p.duration) + " cfg : " + self.getMarkovConfig())
-            for step in range(self.numSteps):
-                l = [p.getStartingEventsAtTime(step)]
-                self.checkSilenceInList(l)
-                curEvent = self._buildTupleForEvents(l)[0]
-                combinationName = self._buildTupleForEvents(
-                        self.getLastEvents(p, step, self.order, 1))
+        Parameters
+        ----------
+        numPatterns: int
+            number of patterns to generate.
+        seed: int or numpy.random.Generator
+            seed for random initialisation ('None' uses the style's random
+            generator).
+        asArray: bool
+            if True returns a boolean array (numPatterns, numSteps, numTags)
+            of the tags (see self.tags) starting at each step.
 
-                curDic = self.transitionTable[int(step)]
+        """
+        rng = self.rng if seed is None else gsutil.makeRandomGenerator(seed)
+        probabilities = self.probabilities
+        numTags = len(self.tags)
+        tagIdx = np.arange(numTags)
+        startCumulative = np.cumsum(self.startCounts, axis=1)
+        startCumulative /= startCumulative[:, -1:]
+        r = rng.random((numPatterns, numTags))
+        histories = (r[:, :, None] >= startCumulative[None, :, :-1]).sum(axis=2)
+        anchor = self.tags.index(self.anchorTag) if self.anchorTag is not None else None
+        historyMask = (1 << self.order) - 1
+        grid = np.zeros((numPatterns, self.numSteps, numTags), dtype=bool)
+        for step in range(self.numSteps):
+            r = rng.random((numPatterns, numTags))
+            contexts = histories
+            if anchor is not None:
+                anchorBits = r[:, anchor] < probabilities[anchor, step, histories[:, anchor]]
+                contexts = histories | (anchorBits[:, None].astype(np.int64) << self.order)
+                contexts[:, anchor] = histories[:, anchor]
+            bits = r < probabilities[tagIdx, step, contexts]
+            grid[:, step] = bits
+            histories = ((histories << 1) | bits) & historyMask
+        if asArray:
+            return grid
+        return [patternFromGrid(p, self.tags, self.loopDuration) for p in grid]
+
+    def generateGrid(self, numPatterns=None, seed=None, velocity=None, packed=False):
+        """
+        Generates step grids whose columns are self.tags (see
+        PatternMarkov.generateGrid).
 
-                if combinationName not in curDic:
-                    curDic[combinationName] = {}
+        """
+        grid = self.generatePatterns(1 if numPatterns is None else numPatterns, seed=seed, asArray=True)
+        grid = _formatGrid(grid, velocity=velocity, packed=packed)
+        return grid[0] if numPatterns is None else grid
 
-                if curEvent not in curDic[combinationName]:
-                    curDic[combinationName][curEvent] = 1
-                else:
-                    curDic[combinationName][curEvent] += 1
+    def getDistanceFromStyle(self, pattern, unseenProbability=1e-6):
+        return float(self.getDistancesFromStyle([pattern], unseenProbability=unseenProbability)[0])
 
-        def _normalize():
-            for t in self.transitionTable:
-                for d in t:
-                    sum = 0
-                    for pe in t[d]:
-                        sum += t[d][pe]
-                    for pe in t[d]:
-                        t[d][pe] /= 1.0 * sum
+    def getDistancesFromStyle(self, patterns, unseenProbability=1e-6):
+        """
+        Mean negative log-likelihood per step of each pattern, summed over
+        the chains and mapped to [0, 1] as in MarkovStyle. Tags unknown to the
+        style count as unseen transitions.
 
-        _normalize()
+        """
+        grid, tags = binarizePatterns(patterns, self.numSteps, self.loopDuration, tags=list(self.tags))
+        knownGrid = grid[:, :, :len(self.tags)]
+        contexts = self._getContexts(self._getHistories(knownGrid), knownGrid)
+        onProbabilities = self.probabilities[np.arange(len(self.tags)), np.arange(self.numSteps)[:, None], contexts]
+        likelihoods = np.where(knownGrid, onProbabilities, 1 - onProbabilities)
+        with np.errstate(divide='ignore'):
+            logLikelihoods = np.log(np.maximum(likelihoods, unseenProbability)).sum(axis=(1, 2))
+            logUnseen = np.log(unseenProbability)
+        unknownTags = [t for t in range(len(self.tags), len(tags)) if tags[t] != 'silence']
+        numUnknown = grid[:, :, unknownTags].sum(axis=(1, 2))
+        logLikelihoods[numUnknown > 0] += numUnknown[numUnknown > 0] * logUnseen
+        return _normalizeDistances(-logLikelihoods / self.numSteps)
+
+    def _getStateHeader(self):
+        return {"order": self.order, "numSteps": self.numSteps, "loopDuration": self.loopDuration,
+                "anchorTag": self.anchorTag, "tags": self.tags, "counts": None, "startCounts": None}
 
-    def getStringTransitionTable(self, reduceTuples=True, jsonStyle=True):
-        import copy
-        stringTable = copy.deepcopy(self.transitionTable)
+    def getInternalState(self):
+        state = self._getStateHeader()
+        # an untrained style has no counts
+        if self.counts is not None:
+            state.update(counts=self.counts.tolist(), startCounts=self.startCounts.tolist())
+        return state
 
-        def _tupleToString(d):
-            if isinstance(d, dict):
-                for k, v in d.items():
-                    if isinstance(k, tuple):
-                        d[str(_tupleToString(k))] = d.pop(k)
-                    _tupleToString(v)
-            elif isinstance(d, list):
-                for v in d:
-                    _tupleToString(v)
-            elif isinstance(d, tuple):
-                newTuple = ()
-                for v in d:
-                    newTuple += (_tupleToString(v),)
-                if reduceTuples and len(newTuple) == 1:
-                    newTuple = newTuple[0]
-                d = newTuple
-            return d
+    def setInternalState(self, state):
+        self.order = state["order"]
+        self.numSteps = state["numSteps"]
+        self.loopDuration = state["loopDuration"]
+        self.anchorTag = _stateFromJSON(state["anchorTag"])
+        self.tags = [_stateFromJSON(t) for t in state["tags"]]
+        self.counts = None
+        self.startCounts = None
+        if state["counts"] is not None:
+            self.counts = np.array(state["counts"], dtype=np.float64).reshape(
+                len(self.tags), self.numSteps, self._getNumContexts(), 2)
+            self.startCounts = np.array(state["startCounts"], dtype=np.float64).reshape(
+                len(self.tags), 1 << self.order)
+        self._probabilities = None
+
+    def getBinaryState(self):
+        # counts are saved as arrays, never converted to lists
+        state = self._getStateHeader()
+        if self.counts is not None:
+            state.update(counts=gsutil.compactArray(self.counts.astype(np.int64)),
+                         startCounts=gsutil.compactArray(self.startCounts.astype(np.int64)))
+        return state
 
-        for t in stringTable:
-            t = _tupleToString(stringTable)
+    def isBuilt(self):
+        return self.counts is not None and len(self.tags) > 0
 
-        if jsonStyle:
-            import json
 
-            for i in range(len(stringTable)):
-                stringTable[i] = json.dumps(stringTable[i], indent=1)
+# versions of MarkovTable counts, unique across tables so that a cache key is never reused
+_tableVersions = itertools.count(1)
 
-        return stringTable
 
-    def __repr__(self):
-        res = "Markov Transition Table\n"
-        st = self.getStringTransitionTable(reduceTuples=True, jsonStyle=True)
-        i = 0
-        for t in st:
-            res += "step %d\n%s\n" % (i, t)
-            i += 1
-        return res
+class MarkovTable(object):
+    """
+    Sparse table of Markov transition counts for each step of a pattern.
 
-    def generatePattern(self, seed=None):
-        """Generate a new pattern from current transitionTable.
+    States (tuples of tags) and contexts (tuples of `order` state ids) are
+    interned to integer ids. Transitions are stored in CSR-like numpy
+    arrays: each row is a (step, context) pair, rows are sorted, and a row
+    holds the states observed after its context with their counts.
+    Probabilities are computed lazily from the counts.
 
-        Args:
-            seed: seed used for random initialisation of pattern (value of None generates a new one)
+    Parameters
+    ----------
+    numSteps: int
+        number of steps of the table.
+
+    """
+
+    def __init__(self, numSteps=0):
+        self.numSteps = numSteps
+        self.states = []
+        self.stateIds = {}
+        self.contexts = []
+        self.contextIds = {}
+        self.rowSteps = np.zeros(0, dtype=np.int32)
+        self.rowContexts = np.zeros(0, dtype=np.int32)
+        self.rowPtr = np.zeros(1, dtype=np.int64)
+        self.nextStates = np.zeros(0, dtype=np.int32)
+        self.counts = np.zeros(0, dtype=np.float64)
+        # changed each time counts change, used to invalidate caches
+        self.version = next(_tableVersions)
+        self._probabilities = None
+        # rows whose probabilities are outdated (see addCounts)
+        self._dirtyRows = []
+        self._rowKeys = None
+        self._entryKeys = None
+        self._sampler = None
+
+    def __len__(self):
         """
-        random.seed(seed)
-        potentialStartEvent = []
+        Number of rows, i.e. of observed (step, context) pairs.
 
-        def _getAvailableAtStep(step):
-            res = []
-            if step < 0:
-                step += len(self.transitionTable)
-            for n in self.transitionTable[step]:
-                for t in self.transitionTable[step][n]:
-                    res += [t]
-            return res
+        """
+        return len(self.rowSteps)
 
-        def _isValidState(step, previousTags):
-            d = self.transitionTable[step]
-            # print(d)
-            # print(previousTags)
-            return previousTags in d
+    def __getstate__(self):
+        # cached values are rebuilt on demand
+        state = self.__dict__.copy()
+        state.update(_probabilities=None, _dirtyRows=[], _rowKeys=None, _entryKeys=None, _sampler=None)
+        return state
 
-        def _generateEventAtStep(step, previousTags):
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # versions of another process may collide with the ones of this process
+        self.version = next(_tableVersions)
 
-            if previousTags not in self.transitionTable[step]:
-                markovLog.error(
-                        "wrong transition table, zero state for " + str(
-                                previousTags))
-                markovLog.error(str(self.transitionTable[step]))
-                return None
-            d = self.transitionTable[step][previousTags]
-            chosenIdx = 0
-            if len(d) > 1:
-                tSum = 0
-                bins = []
-                for x in d.values():
-                    tSum += x
-                    bins += [tSum]
-                r = random.random()
-                for i in range(1, len(bins)):
-                    if bins[i - 1] <= r and bins[i] > r:
-                        chosenIdx = i - 1
-                        break
-
-            return list(d.keys())[chosenIdx]
-
-        cIdx = self.order
-        startHypothesis = tuple()
-        maxNumtries = 30
-        while not _isValidState(cIdx, startHypothesis):
-            startHypothesis = tuple()
-            for n in range(self.order):
-                startHypothesis += (random.choice(_getAvailableAtStep(n)),)
-            maxNumtries -= 1
-            if maxNumtries == 0:
-                raise Exception("Can't find start hypothesis in markov")
-
-        events = list(startHypothesis)
-        i = self.order
-        maxNumtries = 10
-        maxTries = maxNumtries
-        while i < self.numSteps and maxTries > 0:
-            newPast = tuple(events[i - self.order:i])
-            newEv = _generateEventAtStep(i, newPast)
-            if newEv:
-                events += [newEv]
-                maxTries = maxNumtries
-                i += 1
-            else:
-                maxTries -= 1
-                if maxTries == 0:
-                    markovLog.error(
-                            "not found combination %s at step %i \n transitions\n %s" % (
-                                ','.join(newPast), i, self.transitionTable[i]))
-                    raise Exception(" can't find combination in markov")
-                else:
-                    markovLog.warning(
-                            "not found combination %s " % (','.join(newPast)))
+    def __add__(self, other):
+        return self.copy().merge(other)
 
-        pattern = gspattern.Pattern()
-        idx = 0
+    def __iadd__(self, other):
+        return self.merge(other)
 
-        stepSize = 1.0 * self.loopDuration / self.numSteps
+    def copy(self):
+        """
+        Returns a copy of this table.
 
-        for el in events:
-            for tagElem in el:
-                if tagElem != 'silence':
-                    pattern.events += [
-                        gspattern.Event(idx * stepSize, stepSize, 100, 127,
-                                        tag=tagElem)]
+        """
+        table = copy.copy(self)
+        table.states = list(self.states)
+        table.stateIds = dict(self.stateIds)
+        table.contexts = list(self.contexts)
+        table.contextIds = dict(self.contextIds)
+        table.invalidate()
+        return table
+
+    def getOrder(self):
+        """
+        Length of the contexts, None for an empty table.
 
-            idx += 1
-        pattern.duration = self.loopDuration
+        """
+        return len(self.contexts[0]) if self.contexts else None
 
-        return pattern
+    def merge(self, *others):
+        """
+        Adds the counts of other tables to this one, e.g. tables counted on
+        different shards of a corpus. States and contexts of the other tables
+        are interned in this one.
 
-    def checkSilences(self, p):
-        for i in range(int(p.duration)):
-            c = p.getStartingEventsAtTime(i)
-            if len(c) > 1 and ("silence" in c):
-                markovLog.error("wrong silence")
+        Parameters
+        ----------
+        others: MarkovTable
+            tables to merge, of the same order.
 
-    def checkSilenceInList(self, c):
-        if len(c) > 1 and ('silence' in c):
-            markovLog.error("wrong silence")
+        Returns
+        -------
+        This table.
 
-    def _buildTupleForEvents(self, events):
-        """Build a tuple from list of lists of events:
-        If list is [[a1, a2], [b1, b2, b3]] (where an and bn are tags of listed events)
-        this function returns "a1/a2, b1/b2/b3"
         """
-        res = tuple()
-        for evAtStep in events:
+        steps, contexts, nextStates, counts = [], [], [], []
+        for other in others:
+            if other.getOrder() is not None and self.getOrder() not in (None, other.getOrder()):
+                raise ValueError("can't merge Markov tables of order %i and %i" % (self.getOrder(), other.getOrder()))
+            self.numSteps = max(self.numSteps, other.numSteps)
+            stateMap = [self.getStateId(state) for state in other.states]
+            contextMap = np.array([self.getContextId(tuple([stateMap[s] for s in context]))
+                                   for context in other.contexts], dtype=np.int64)
+            steps += [other.getEntrySteps()]
+            contexts += [contextMap[other.getEntryContexts()]]
+            nextStates += [np.array(stateMap, dtype=np.int64)[other.nextStates]]
+            counts += [other.counts]
+        if steps:
+            self.addCounts(np.concatenate(steps), np.concatenate(contexts), np.concatenate(nextStates),
+                           np.concatenate(counts))
+        return self
+
+    def getStateId(self, state):
+        """
+        Returns the id of a state (tuple of tags), interning it if needed.
+
+        """
+        stateId = self.stateIds.get(state)
+        if stateId is None:
+            stateId = self.stateIds[state] = len(self.states)
+            self.states += [state]
+        return stateId
+
+    def getContextId(self, context):
+        """
+        Returns the id of a context (tuple of state ids), interning it if needed.
+
+        """
+        contextId = self.contextIds.get(context)
+        if contextId is None:
+            contextId = self.contextIds[context] = len(self.contexts)
+            self.contexts += [context]
+        return contextId
+
+    def getContextLabel(self, contextId):
+        """
+        Returns the context as a tuple of states.
+
+        """
+        return tuple([self.states[s] for s in self.contexts[contextId]])
+
+    @property
+    def probabilities(self):
+        """
+        Transition probabilities, aligned with nextStates.
+        Only the rows whose counts changed since the last access are
+        renormalized.
+
+        """
+        if self._probabilities is None:
+            self._probabilities = self.counts / np.repeat(self.getRowTotals(), np.diff(self.rowPtr))
+        elif self._dirtyRows:
+            rows = np.unique(np.concatenate(self._dirtyRows))
+            starts = self.rowPtr[rows]
+            lengths = self.rowPtr[rows + 1] - starts
+            rowOffsets = np.cumsum(lengths) - lengths
+            entries = np.repeat(starts - rowOffsets, lengths) + np.arange(lengths.sum())
+            totals = np.add.reduceat(self.counts[entries], rowOffsets)
+            self._probabilities[entries] = self.counts[entries] / np.repeat(totals, lengths)
+        self._dirtyRows = []
+        return self._probabilities
+
+    def getRowTotals(self):
+        if len(self.rowSteps) == 0:
+            return np.zeros(0, dtype=np.float64)
+        return np.add.reduceat(self.counts, self.rowPtr[:-1], dtype=np.float64)
+
+    def getEntrySteps(self):
+        """
+        Step of each transition, aligned with nextStates.
+
+        """
+        return np.repeat(self.rowSteps, np.diff(self.rowPtr))
+
+    def getEntryContexts(self):
+        """
+        Context id of each transition, aligned with nextStates.
+
+        """
+        return np.repeat(self.rowContexts, np.diff(self.rowPtr))
+
+    def getRowsAtStep(self, step):
+        """
+        Returns the (start, end) range of rows of a given step.
+
+        """
+        return (int(np.searchsorted(self.rowSteps, step, side='left')),
+                int(np.searchsorted(self.rowSteps, step, side='right')))
+
+    def findRow(self, step, contextId):
+        """
+        Returns the row index of a (step, context) pair, -1 if not observed.
+
+        """
+        if contextId is None or len(self.rowSteps) == 0:
+            return -1
+        if self._rowKeys is None:
+            self._rowKeys = _rowKeys(self.rowSteps, self.rowContexts)
+        key = _rowKeys(step, contextId)
+        row = int(np.searchsorted(self._rowKeys, key))
+        if row < len(self._rowKeys) and self._rowKeys[row] == key:
+            return row
+        return -1
+
+    def findEntries(self, rows, nextStates):
+        """
+        Vectorized lookup of the transitions from rows to next states.
+
+        Returns
+        -------
+        An int array of indexes in nextStates, -1 for unobserved transitions.
+
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        nextStates = np.asarray(nextStates, dtype=np.int64)
+        if len(self.nextStates) == 0:
+            return np.full(np.broadcast(rows, nextStates).shape, -1, dtype=np.int64)
+        if self._entryKeys is None:
+            self._entryKeys = _rowKeys(np.repeat(np.arange(len(self.rowSteps)), np.diff(self.rowPtr)),
+                                       self.nextStates)
+        entryKeys = _rowKeys(np.maximum(rows, 0), np.maximum(nextStates, 0))
+        entries = np.minimum(np.searchsorted(self._entryKeys, entryKeys), len(self._entryKeys) - 1)
+        return np.where((self._entryKeys[entries] == entryKeys) & (rows >= 0) & (nextStates >= 0), entries, -1)
+
+    def addCounts(self, steps, contexts, nextStates, counts=None):
+        """
+        Adds transition counts (negative counts remove transitions).
+
+        Parameters
+        ----------
+        steps, contexts, nextStates: array-like of ints
+            step, context id and next state id of each transition.
+        counts: array-like of floats
+            count of each transition (default: 1).
+
+        """
+        steps = np.asarray(steps, dtype=np.int64).ravel()
+        if len(steps) == 0:
+            return
+        contexts = np.asarray(contexts, dtype=np.int64).ravel()
+        nextStates = np.asarray(nextStates, dtype=np.int64).ravel()
+        counts = np.ones(len(steps)) if counts is None else np.asarray(counts, dtype=np.float64).ravel()
+        if self._updateCounts(steps, contexts, nextStates, counts):
+            return
+
+        allSteps = np.concatenate([self.getEntrySteps(), steps])
+        allContexts = np.concatenate([self.getEntryContexts(), contexts])
+        allNextStates = np.concatenate([self.nextStates, nextStates])
+        allCounts = np.concatenate([self.counts, counts])
+        order = np.lexsort((allNextStates, allContexts, allSteps))
+        allSteps, allContexts = allSteps[order], allContexts[order]
+        allNextStates, allCounts = allNextStates[order], allCounts[order]
+
+        isNewEntry = np.ones(len(allSteps), dtype=bool)
+        isNewEntry[1:] = (allSteps[1:] != allSteps[:-1]) | (allContexts[1:] != allContexts[:-1]) | (
+            allNextStates[1:] != allNextStates[:-1])
+        entryStarts = np.flatnonzero(isNewEntry)
+        allCounts = np.add.reduceat(allCounts, entryStarts)
+        kept = entryStarts[allCounts > 1e-9]
+        allCounts = allCounts[allCounts > 1e-9]
+        self._setEntries(allSteps[kept], allContexts[kept], allNextStates[kept], allCounts)
+
+    def _updateCounts(self, steps, contexts, nextStates, counts):
+        """
+        Adds counts in place when all transitions are already in the table
+        and none of them is removed, so that the rows don't need to be
+        rebuilt. Returns False when a full merge is needed.
+
+        """
+        if len(self.rowSteps) == 0:
+            return False
+        if self._rowKeys is None:
+            self._rowKeys = _rowKeys(self.rowSteps, self.rowContexts)
+        rowKeys = _rowKeys(steps, contexts)
+        rows = np.minimum(np.searchsorted(self._rowKeys, rowKeys), len(self._rowKeys) - 1)
+        if not np.all(self._rowKeys[rows] == rowKeys):
+            return False
+        entries = self.findEntries(rows, nextStates)
+        if np.any(entries < 0):
+            return False
+        newCounts = self.counts.astype(np.float64)
+        np.add.at(newCounts, entries, counts)
+        if np.any(newCounts[entries] <= 1e-9):
+            return False
+        self.counts = newCounts
+        self.version = next(_tableVersions)
+        self._sampler = None
+        if self._probabilities is not None:
+            self._dirtyRows += [rows]
+        return True
+
+    def _setEntries(self, steps, contexts, nextStates, counts):
+        """
+        Sets sorted and unique transitions, grouping them in rows.
+
+        """
+        isNewRow = np.ones(len(steps), dtype=bool)
+        isNewRow[1:] = (steps[1:] != steps[:-1]) | (contexts[1:] != contexts[:-1])
+        rowStarts = np.flatnonzero(isNewRow)
+        self.rowSteps = steps[rowStarts].astype(np.int32)
+        self.rowContexts = contexts[rowStarts].astype(np.int32)
+        self.rowPtr = np.append(rowStarts, len(steps)).astype(np.int64)
+        self.nextStates = nextStates.astype(np.int32)
+        self.counts = np.asarray(counts, dtype=np.float64)
+        self.invalidate()
+
+    def prune(self, minCount=0, minProbability=0):
+        """
+        Removes rare transitions, the remaining ones of each row being
+        renormalized. The most probable transition of each row is always
+        kept so that no context becomes a dead end.
+
+        Parameters
+        ----------
+        minCount: float
+            transitions counted less than minCount are removed.
+        minProbability: float
+            transitions less probable than minProbability are removed.
+
+        Returns
+        -------
+        The number of removed transitions.
+
+        """
+        if len(self.nextStates) == 0:
+            return 0
+        probabilities = self.probabilities
+        kept = (self.counts >= minCount) & (probabilities >= minProbability)
+        entryRows = np.repeat(np.arange(len(self)), np.diff(self.rowPtr))
+        kept[np.lexsort((probabilities, entryRows))[self.rowPtr[1:] - 1]] = True
+        numRemoved = int(len(kept) - kept.sum())
+        if numRemoved:
+            self._setEntries(self.getEntrySteps()[kept], self.getEntryContexts()[kept], self.nextStates[kept],
+                             self.counts[kept])
+        return numRemoved
+
+    def quantize(self, numLevels=65535):
+        """
+        Replaces counts by probabilities quantized to integers in
+        [1, numLevels], so that they are saved as uint16 values (see
+        toArrayDict). Counts are lost: further training mixes pseudo counts
+        with actual ones.
+
+        """
+        self.counts = np.maximum(1., np.round(self.probabilities * numLevels))
+        self.invalidate()
+
+    def getNumBytes(self):
+        """
+        Size of the arrays of this table as saved in binary files (see
+        toArrayDict).
+
+        """
+        return sum(a.nbytes for a in self.toArrayDict(includeStates=False).values() if isinstance(a, np.ndarray))
+
+    def invalidate(self):
+        """
+        Clears cached values derived from counts.
+
+        """
+        self.version = next(_tableVersions)
+        self._probabilities = None
+        self._dirtyRows = []
+        self._rowKeys = None
+        self._entryKeys = None
+        self._sampler = None
+
+    def getSampler(self):
+        """
+        Returns a MarkovSampler compiled from the current counts (cached
+        until counts change).
+
+        """
+        if self._sampler is None:
+            self._sampler = MarkovSampler(self)
+        return self._sampler
+
+    def toJSONDict(self):
+        """
+        Gives a JSON serializable dict of this table.
+
+        """
+        return {'numSteps': self.numSteps,
+                'states': [list(s) for s in self.states],
+                'contexts': [list(c) for c in self.contexts],
+                'rowSteps': self.rowSteps.tolist(),
+                'rowContexts': self.rowContexts.tolist(),
+                'rowPtr': self.rowPtr.tolist(),
+                'nextStates': self.nextStates.tolist(),
+                'counts': self.counts.tolist()}
+
+    def fromJSONDict(self, json):
+        """
+        Loads a dict created by toJSONDict.
+
+        """
+        self.__init__(json['numSteps'])
+        for s in json['states']:
+            self.getStateId(_stateFromJSON(s))
+        for c in json['contexts']:
+            self.getContextId(tuple(c))
+        self.rowSteps = np.array(json['rowSteps'], dtype=np.int32)
+        self.rowContexts = np.array(json['rowContexts'], dtype=np.int32)
+        self.rowPtr = np.array(json['rowPtr'], dtype=np.int64)
+        self.nextStates = np.array(json['nextStates'], dtype=np.int32)
+        self.counts = np.array(json['counts'], dtype=np.float64)
+        return self
+
+    def toArrayDict(self, includeStates=True):
+        """
+        Gives a dict of numpy arrays (and JSON compatible states) of this
+        table, to be saved with gsio.toBinaryFile. Contexts are stored as an
+        int array (numContexts, order), and arrays in the smallest dtype
+        holding them without loss (see gsutil.compactArray).
+
+        Parameters
+        ----------
+        includeStates: bool
+            if False, states are not saved (e.g. for tables sharing the
+            states of another one).
+
+        """
+        counts = self.counts
+        if np.array_equal(counts, np.round(counts)):
+            counts = counts.astype(np.int64)
+        contexts = gsutil.compactArray(self.contexts).reshape(len(self.contexts), self.getOrder() or 0)
+        res = {'numSteps': self.numSteps,
+               'contexts': contexts,
+               'rowSteps': gsutil.compactArray(self.rowSteps),
+               'rowContexts': gsutil.compactArray(self.rowContexts),
+               'rowPtr': gsutil.compactArray(self.rowPtr),
+               'nextStates': gsutil.compactArray(self.nextStates),
+               'counts': gsutil.compactArray(counts)}
+        if includeStates:
+            res['states'] = [list(s) for s in self.states]
+        return res
+
+    def fromArrayDict(self, arrays, states=None):
+        """
+        Loads a dict created by toArrayDict. Packed arrays are converted to
+        the dtypes of the table, except counts which are used as they are.
+
+        Parameters
+        ----------
+        arrays: dict
+            the dict to load.
+        states: MarkovTable
+            table whose states are shared, if they were not saved.
+
+        """
+        self.__init__(arrays['numSteps'])
+        if states is not None:
+            self.states = states.states
+            self.stateIds = states.stateIds
+        else:
+            for s in arrays['states']:
+                self.getStateId(_stateFromJSON(s))
+        self.contexts = [tuple(c) for c in arrays['contexts'].tolist()]
+        self.contextIds = {c: i for i, c in enumerate(self.contexts)}
+        self.rowSteps = np.asarray(arrays['rowSteps'], dtype=np.int32)
+        self.rowContexts = np.asarray(arrays['rowContexts'], dtype=np.int32)
+        self.rowPtr = np.asarray(arrays['rowPtr'], dtype=np.int64)
+        self.nextStates = np.asarray(arrays['nextStates'], dtype=np.int32)
+        self.counts = np.asarray(arrays['counts'])
+        return self
+
+    def fromTransitionTable(self, transitionTable):
+        """
+        Loads a legacy transition table: a list (one element per step) of
+        dicts {previousStates: {state: probability}}.
+        Probabilities are used as counts.
+
+        """
+        self.__init__(len(transitionTable))
+        steps, contexts, nextStates, counts = [], [], [], []
+        for step, d in enumerate(transitionTable):
+            for previousStates, nextDict in d.items():
+                contextId = self.getContextId(tuple([self.getStateId(_stateFromJSON(s)) for s in previousStates]))
+                for state, value in nextDict.items():
+                    steps += [step]
+                    contexts += [contextId]
+                    nextStates += [self.getStateId(_stateFromJSON(state))]
+                    counts += [value]
+        self.addCounts(steps, contexts, nextStates, counts)
+        return self
+
+
+class MarkovSampler(object):
+    """
+    Samplers of next states compiled once from a MarkovTable.
+
+    Rows are found with a dict lookup and next states are drawn by bisection
+    on per-row cumulative probabilities, so each generated step is
+    O(log k) for k possible next states.
+
+    Parameters
+    ----------
+    table: MarkovTable
+        the table to sample from.
+
+    """
+
+    def __init__(self, table):
+        self.rows = {key: row for row, key in enumerate(zip(table.rowSteps.tolist(), table.rowContexts.tolist()))}
+        self.rowPtr = table.rowPtr.tolist()
+        self.nextStates = table.nextStates.tolist()
+        # per-row cumulative probabilities, the last one of each row being exactly 1
+        cumulative = _cumulativeProbabilities(table.counts, table.rowPtr)
+        rowLengths = np.diff(table.rowPtr)
+        self.cumulativeArray = cumulative
+        self.cumulative = cumulative.tolist()
+
+        # arrays used to sample chains in lockstep (see sampleChains)
+        self.order = table.getOrder() or 0
+        # rows of the contexts observed at the first generated step, drawn
+        # according to their frequency to start new chains
+        startRow, endRow = table.getRowsAtStep(self.order)
+        self.startRows = np.arange(startRow, endRow, dtype=np.int64)
+        startTotals = np.cumsum(table.getRowTotals()[startRow:endRow])
+        self.startCumulative = startTotals / startTotals[-1] if len(startTotals) else startTotals
+        self.startCumulative[-1:] = 1.
+        self.startContexts = table.rowContexts[startRow:endRow].astype(np.int64)
+        self.rowKeys = _rowKeys(table.rowSteps, table.rowContexts)
+        self.rowTotals = table.getRowTotals()
+        # cumulative probabilities offset by row index, increasing over the whole table
+        self.offsetCumulative = cumulative + np.repeat(np.arange(len(rowLengths), dtype=np.float64), rowLengths)
+        self.nextStateArray = table.nextStates.astype(np.int64)
+        contextArray = np.array(table.contexts, dtype=np.int64).reshape(len(table.contexts), self.order)
+        self._contextArray = contextArray
+        self._contextKeys = _voidRows(contextArray)
+        self._contextOrder = np.argsort(self._contextKeys)
+        self._contextKeys = self._contextKeys[self._contextOrder]
+        # context reached after each transition: its context shifted by the next state
+        nextContexts = np.concatenate([contextArray[table.getEntryContexts(), 1:], self.nextStateArray[:, None]],
+                                      axis=1)
+        self.entryNextContexts = self.lookupContexts(nextContexts[:, nextContexts.shape[1] - self.order:])
+
+    def lookupContexts(self, contexts):
+        """
+        Vectorized context interning lookup.
+
+        Parameters
+        ----------
+        contexts: numpy array
+            int array (n, order) of state ids.
+
+        Returns
+        -------
+        An int array of n context ids, -1 for unknown contexts.
+
+        """
+        keys = _voidRows(contexts)
+        if len(self._contextKeys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._contextKeys, keys), len(self._contextKeys) - 1)
+        return np.where(self._contextKeys[positions] == keys, self._contextOrder[positions], -1)
+
+    def lookupRows(self, step, contextIds):
+        """
+        Vectorized findRow for a given step, -1 for unobserved contexts.
+
+        """
+        keys = _rowKeys(step, np.maximum(contextIds, 0))
+        if len(self.rowKeys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.rowKeys, keys), len(self.rowKeys) - 1)
+        return np.where((self.rowKeys[positions] == keys) & (contextIds >= 0), positions, -1)
+
+    def sampleChains(self, numChains, numSteps, rng):
+        """
+        Samples chains in lockstep.
+
+        Start contexts are drawn among the contexts observed at the first
+        generated step (see sampleStart), then each step draws the next
+        states of all chains at once.
+
+        Parameters
+        ----------
+        numChains: int
+            number of chains to sample.
+        numSteps: int
+            length of the chains.
+        rng: numpy.random.Generator
+            random generator used.
+
+        Returns
+        -------
+        A tuple (stateIds, valid): stateIds is an int array (numChains,
+        numSteps) and valid is False for chains that couldn't be completed.
+
+        """
+        order = self.order
+        stateIds = np.zeros((numChains, numSteps), dtype=np.int64)
+        if len(self.startRows) == 0:
+            return stateIds, np.zeros(numChains, dtype=bool)
+        starts = np.searchsorted(self.startCumulative, rng.random(numChains), side='right')
+        rows = self.startRows[starts]
+        contextIds = self.startContexts[starts]
+        if order > 0:
+            stateIds[:, :order] = self._contextArray[contextIds]
+
+        valid = np.ones(numChains, dtype=bool)
+        for step in range(order, numSteps):
+            if step > order:
+                rows = self.lookupRows(step, contextIds)
+                valid &= rows >= 0
+            rows = np.where(valid, rows, 0)
+            entries = np.searchsorted(self.offsetCumulative, rows + rng.random(numChains), side='right')
+            stateIds[:, step] = self.nextStateArray[entries]
+            contextIds = np.where(valid, self.entryNextContexts[entries], -1)
+        return stateIds, valid
+
+    def sampleStart(self, r):
+        """
+        Draws the row of a start context given a uniform number r in [0, 1),
+        -1 if the table is empty.
+
+        """
+        if len(self.startRows) == 0:
+            return -1
+        return int(self.startRows[min(np.searchsorted(self.startCumulative, r, side='right'), len(self.startRows) - 1)])
+
+    def findRow(self, step, contextId):
+        """
+        Returns the row of a (step, context) pair, -1 if not observed.
+
+        """
+        return self.rows.get((step, contextId), -1)
+
+    def sample(self, row, r):
+        """
+        Draws a next state id from a row given a uniform number r in [0, 1).
+
+        """
+        return self.nextStates[bisect.bisect_right(self.cumulative, r, self.rowPtr[row], self.rowPtr[row + 1] - 1)]
+
+
+class ConstrainedSampler(object):
+    """
+    Markov chain conditioned on per-step masks of allowed states.
+
+    The table is pruned once by a backward pass: each (step, context) gets
+    the probability of completing the chain while satisfying the masks, and
+    transitions are reweighted by the value of the context they lead to.
+    This gives a non-homogeneous model where only transitions able to
+    complete a valid chain remain, so sampling never reaches a dead end and
+    follows the original model conditioned on the constraints.
+
+    Parameters
+    ----------
+    table: MarkovTable
+        the table to sample from.
+    numSteps: int
+        length of the chains.
+    mask: numpy array
+        bool array (numSteps, numStates), True for allowed states.
+
+    """
+
+    def __init__(self, table, numSteps, mask):
+        sampler = table.getSampler()
+        self.sampler = sampler
+        self.numSteps = numSteps
+        self.table = table
+        order = sampler.order
+        mask = np.asarray(mask, dtype=bool)
+        rowLengths = np.diff(table.rowPtr)
+        weights = np.zeros(len(table.nextStates))
+        # (scaled) probability of completing a chain from each context
+        completion = np.ones(len(table.contexts))
+        for step in reversed(range(order, numSteps)):
+            startRow, endRow = table.getRowsAtStep(step)
+            entries = np.arange(table.rowPtr[startRow], table.rowPtr[endRow])
+            stepWeights = table.probabilities[entries] * mask[step, table.nextStates[entries]]
+            if step < numSteps - 1:
+                nextContexts = sampler.entryNextContexts[entries]
+                stepWeights *= np.where(nextContexts >= 0, completion[np.maximum(nextContexts, 0)], 0)
+            weights[entries] = stepWeights
+            completion = np.zeros(len(table.contexts))
+            if len(entries):
+                rowStarts = table.rowPtr[startRow:endRow] - table.rowPtr[startRow]
+                completion[table.rowContexts[startRow:endRow]] = np.add.reduceat(stepWeights, rowStarts)
+            # rescaling by step avoids underflows and doesn't change conditional probabilities
+            if completion.max() > 0:
+                completion /= completion.max()
+
+        startStates = sampler._contextArray[sampler.startContexts]
+        startWeights = sampler.rowTotals[sampler.startRows] * completion[sampler.startContexts]
+        for n in range(order):
+            startWeights *= mask[n, startStates[:, n]]
+        if not startWeights.sum() > 0:
+            raise ValueError("constraints can't be satisfied by the Markov model")
+        self.startCumulative = _cumulativeProbabilities(startWeights, np.array([0, len(startWeights)]))
+
+        # cumulative weights of each row, offset by row index
+        self.offsetCumulative = _cumulativeProbabilities(weights, table.rowPtr) + np.repeat(
+            np.arange(len(rowLengths), dtype=np.float64), rowLengths)
+
+    def sampleChains(self, numChains, rng):
+        """
+        Samples chains satisfying the constraints, in lockstep.
+
+        Returns
+        -------
+        An int array (numChains, numSteps) of state ids.
+
+        """
+        sampler = self.sampler
+        order = sampler.order
+        stateIds = np.zeros((numChains, self.numSteps), dtype=np.int64)
+        starts = np.searchsorted(self.startCumulative, rng.random(numChains), side='right')
+        contextIds = sampler.startContexts[starts]
+        stateIds[:, :order] = sampler._contextArray[contextIds]
+        for step in range(order, self.numSteps):
+            rows = sampler.lookupRows(step, contextIds)
+            entries = np.searchsorted(self.offsetCumulative, rows + rng.random(numChains), side='right')
+            stateIds[:, step] = sampler.nextStateArray[entries]
+            contextIds = sampler.entryNextContexts[entries]
+        return stateIds
+
+
+def _normalizeDistances(distances):
+    """
+    Maps distances in [0, inf] to [0, 1] with d / (1 + d).
+
+    """
+    distances = np.asarray(distances, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        return np.where(np.isinf(distances), 1., distances / (1. + distances))
+
+
+def _cumulativeProbabilities(weights, rowPtr):
+    """
+    Per-row cumulative probabilities of weights. Entries after the last
+    positive weight of a row are set to 1, so that zero weights are never
+    drawn.
+
+    """
+    rowLengths = np.diff(rowPtr)
+    if len(weights) == 0:
+        return np.zeros(0)
+    cumulative = np.cumsum(weights)
+    rowOffsets = np.concatenate([[0.], cumulative])[rowPtr[:-1]]
+    totals = np.add.reduceat(weights, rowPtr[:-1])
+    cumulative = (cumulative - np.repeat(rowOffsets, rowLengths)) / np.repeat(np.where(totals > 0, totals, 1),
+                                                                              rowLengths)
+    positions = np.arange(len(weights))
+    lastPositive = np.maximum.reduceat(np.where(weights > 0, positions, -1), rowPtr[:-1])
+    cumulative[positions >= np.repeat(lastPositive, rowLengths)] = 1.
+    return cumulative
+
+
+def binarizePatterns(patterns, numSteps, loopDuration, tags=None):
+    """
+    Binarizes patterns on a grid of numSteps steps per loopDuration, without
+    copying nor modifying them.
+
+    This gives the same steps as PatternMarkov.formatPattern: event start
+    times are rounded to the nearest step, and the empty steps of a pattern
+    are filled with 'silence'.
+
+    Parameters
+    ----------
+    patterns: list of Patterns
+        patterns to binarize.
+    numSteps: int
+        number of steps of the grid.
+    loopDuration: float
+        duration covered by the grid.
+    tags: list
+        tag vocabulary, extended with unknown tags (a new list if None).
+
+    Returns
+    -------
+    A tuple (grid, tags) where grid is a boolean numpy array of shape
+    (numPatterns, numSteps, numTags), True when tags[t] starts at a step.
+
+    """
+    tags = [] if tags is None else tags
+    tagIds = {t: i for i, t in enumerate(tags)}
+    stretchRatio = numSteps * 1.0 / loopDuration
+    patternIndexes, startTimes, tagIndexes = [], [], []
+    for i, p in enumerate(patterns):
+        for e in p.events:
+            tagId = tagIds.get(e.tag)
+            if tagId is None:
+                tagId = tagIds[e.tag] = len(tags)
+                tags += [e.tag]
+            patternIndexes += [i]
+            startTimes += [e.startTime]
+            tagIndexes += [tagId]
+    if 'silence' not in tagIds:
+        tagIds['silence'] = len(tags)
+        tags += ['silence']
+
+    durations = np.array([p.duration for p in patterns], dtype=np.float64) * stretchRatio
+    grid = np.zeros((len(patterns), numSteps, len(tags)), dtype=bool)
+    patternIndexes = np.array(patternIndexes, dtype=np.int64)
+    steps = np.trunc(np.array(startTimes, dtype=np.float64) * stretchRatio + 0.5).astype(np.int64)
+    # events rounded out of the pattern or of the grid are dropped
+    valid = (steps >= 0) & (steps < numSteps) & (steps < durations[patternIndexes])
+    grid[patternIndexes[valid], steps[valid], np.array(tagIndexes, dtype=np.int64)[valid]] = True
+
+    isEmpty = ~grid.any(axis=2) & (np.arange(numSteps)[None, :] < durations[:, None])
+    grid[:, :, tagIds['silence']] |= isEmpty
+    return grid, tags
+
+
+def poolGrid(grid, tags, factor):
+    """
+    Derives a coarser grid from a binarized one (see binarizePatterns): each
+    step of the new grid holds the tags of the fine steps rounded to it.
+
+    This gives the same grid as binarizing at numSteps / factor steps for
+    events lying on the fine grid. Off-grid events halfway between two
+    coarse steps may be rounded differently.
+
+    Parameters
+    ----------
+    grid: numpy array
+        boolean grid (numPatterns, numSteps, numTags), numSteps being a
+        multiple of factor.
+    tags: list
+        tags of the grid.
+    factor: int
+        number of fine steps per coarse step.
+
+    Returns
+    -------
+    A boolean grid (numPatterns, numSteps // factor, numTags).
+
+    """
+    if factor == 1:
+        return grid
+    numSteps = grid.shape[1] // factor
+    silence = tags.index('silence')
+    active = grid.copy()
+    active[:, :, silence] = False
+    coarseSteps = (np.arange(grid.shape[1]) + factor // 2) // factor
+    starts = np.searchsorted(coarseSteps, np.arange(numSteps))
+    valid = coarseSteps < numSteps
+    pooled = np.logical_or.reduceat(active[:, valid], starts, axis=1)
+    # a coarse step is inside its pattern if the fine step at the same time is
+    inside = grid[:, ::factor].any(axis=2)
+    pooled[:, :, silence] = ~pooled.any(axis=2) & inside
+    return pooled
+
+
+def internGridStates(grid, tags, table):
+    """
+    Interns the states of a binarized grid in a MarkovTable.
+
+    Parameters
+    ----------
+    grid: numpy array
+        boolean grid (numPatterns, numSteps, numTags) (see binarizePatterns).
+    tags: list
+        tags of the grid.
+    table: MarkovTable
+        table where states are interned.
+
+    Returns
+    -------
+    An int array (numPatterns, numSteps) of state ids.
+
+    """
+    states, inverse = _uniqueGridStates(grid, tags)
+    return np.array([table.getStateId(state) for state in states], dtype=np.int64)[inverse]
+
+
+def lookupGridStates(grid, tags, table):
+    """
+    Same as internGridStates but states unknown to the table are not
+    interned: their id is -1.
+
+    """
+    states, inverse = _uniqueGridStates(grid, tags)
+    return np.array([table.stateIds.get(state, -1) for state in states], dtype=np.int64)[inverse]
+
+
+def _uniqueGridStates(grid, tags):
+    """
+    Returns the distinct states of a grid and the index of the state of each
+    (pattern, step) among them.
+
+    """
+    rows = grid.reshape(-1, grid.shape[-1])
+    if rows.shape[1] == 0:
+        return [()], np.zeros(grid.shape[:2], dtype=np.int64)
+    packedRows = np.ascontiguousarray(np.packbits(rows, axis=1))
+    packedRows = packedRows.view(np.dtype((np.void, packedRows.shape[1]))).ravel()
+    _, firstIndexes, inverse = np.unique(packedRows, return_index=True, return_inverse=True)
+    states = [tuple(sorted([tags[t] for t in np.flatnonzero(rows[i])], key=repr)) for i in firstIndexes.tolist()]
+    return states, inverse.reshape(grid.shape[:2])
+
+
+def internGridContexts(stateGrid, order, table):
+    """
+    Interns the contexts of each step of a state grid (the `order` previous
+    states, wrapping around the loop) in a MarkovTable.
+
+    Returns
+    -------
+    An int array (numPatterns, numSteps) of context ids.
+
+    """
+    numPatterns, numSteps = stateGrid.shape
+    if order == 0:
+        return np.full(stateGrid.shape, table.getContextId(()), dtype=np.int64)
+    windows = (np.arange(numSteps)[:, None] - order + np.arange(order)[None, :]) % numSteps
+    contexts = stateGrid[:, windows].reshape(-1, order)
+    uniqueContexts, inverse = np.unique(contexts, axis=0, return_inverse=True)
+    contextIds = np.array([table.getContextId(tuple(c)) for c in uniqueContexts.tolist()], dtype=np.int64)
+    return contextIds[inverse.reshape(-1)].reshape(numPatterns, numSteps)
+
+
+def patternFromStates(states, loopDuration):
+    """
+    Builds a pattern from a list of states (one tuple of tags per step),
+    'silence' tags being skipped.
+
+    """
+    pattern = gspattern.Pattern()
+    stepSize = 1.0 * loopDuration / len(states)
+    for idx, state in enumerate(states):
+        for tagElem in state:
+            if tagElem != 'silence':
+                pattern.events += [
+                    gspattern.Event(idx * stepSize, stepSize, 100, 127,
+                                    tag=tagElem)]
+    pattern.duration = loopDuration
+    return pattern
+
+
+def patternFromGrid(grid, tags, loopDuration):
+    """
+    Builds a pattern from a step grid (see PatternMarkov.generateGrid).
+
+    Parameters
+    ----------
+    grid: numpy array
+        boolean or velocity array (numSteps, numTags), or int array
+        (numSteps,) of bitmasks (bit i for tags[i]).
+    tags: list
+        tags of the grid columns.
+    loopDuration: float
+        duration of the pattern.
+
+    """
+    grid = np.asarray(grid)
+    if grid.ndim == 1:
+        grid = (grid[:, None].astype(np.uint64) >> np.arange(len(tags), dtype=np.uint64)) & np.uint64(1) > 0
+    steps, tagIdx = np.nonzero(grid)
+    velocities = grid[steps, tagIdx].tolist() if grid.dtype != bool else [127] * len(steps)
+    stepSize = 1.0 * loopDuration / len(grid)
+    pattern = gspattern.Pattern()
+    pattern.events = [gspattern.Event(step * stepSize, stepSize, 100, velocity, tag=tags[t])
+                      for step, t, velocity in zip(steps.tolist(), tagIdx.tolist(), velocities)]
+    pattern.duration = loopDuration
+    return pattern
+
+
+def _formatGrid(grid, velocity=None, packed=False):
+    """
+    Converts a boolean grid (..., numTags) to velocities or bitmasks (see
+    PatternMarkov.generateGrid).
+
+    """
+    if packed:
+        numTags = grid.shape[-1]
+        if numTags > 64:
+            raise ValueError("can't pack %i tags in 64 bits" % numTags)
+        dtype = next(d for d in (np.uint8, np.uint16, np.uint32, np.uint64) if numTags <= 8 * np.dtype(d).itemsize)
+        return np.dot(grid, np.uint64(1) << np.arange(numTags, dtype=np.uint64)).astype(dtype)
+    if velocity is not None:
+        return grid.astype(np.uint8) * np.uint8(velocity)
+    return grid
+
+
+class GeneratedPatterns(object):
+    """
+    Lazy sequence of the patterns generated by PatternMarkov.generatePatterns:
+    patterns are only built when accessed.
+
+    Parameters
+    ----------
+    stateIds: numpy array
+        int array (numPatterns, numSteps) of generated state ids.
+    states: list
+        states (tuples of tags) indexed by their ids.
+    loopDuration: float
+        duration of the generated patterns.
+
+    """
+
+    def __init__(self, stateIds, states, loopDuration):
+        self.stateIds = stateIds
+        self.states = states
+        self.loopDuration = loopDuration
+
+    def __len__(self):
+        return len(self.stateIds)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return patternFromStates([self.states[s] for s in self.stateIds[index].tolist()], self.loopDuration)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def _buildMatrix(rows, columns, values, shape, matrix=None, sparse=False):
+    """
+    Builds a dense or scipy.sparse CSR matrix from coordinates, summing
+    duplicates. A given dense matrix is updated in place instead.
+
+    """
+    if sparse and matrix is None:
+        import scipy.sparse
+        return scipy.sparse.coo_matrix((values, (rows, columns)), shape=shape).tocsr()
+    if matrix is None:
+        matrix = np.zeros(shape)
+    else:
+        matrix = np.asarray(matrix, dtype=np.float64)
+    np.add.at(matrix, (rows, columns), values)
+    return matrix
+
+
+def _voidRows(array):
+    """
+    Views the rows of a 2D int array as single comparable (void) items.
+
+    """
+    array = np.ascontiguousarray(array, dtype=np.int64)
+    if array.shape[1] == 0:
+        # all empty rows are equal
+        return np.zeros(len(array), dtype=np.dtype((np.void, 8)))
+    return array.view(np.dtype((np.void, array.shape[1] * 8))).reshape(-1)
+
+
+def _rowKeys(steps, contexts):
+    """
+    Sortable int64 key of (step, context) pairs.
+
+    """
+    return (np.asarray(steps, dtype=np.int64) << 32) | np.asarray(contexts, dtype=np.int64)
+
+
+def _stateFromJSON(obj):
+    """
+    States and tags can't be lists, so JSON arrays are converted back to tuples.
+
+    """
+    if isinstance(obj, list):
+        return tuple([_stateFromJSON(t) for t in obj])
+    return obj
+
+
+class PatternMarkov(object):
+    """
+    Computes a Markov chain from pattern.
+
+    Parameters
+    ----------
+    order: int
+        order used for markov computation
+    numSteps: int
+        number of steps to consider (binarization of pattern)
+    rng: numpy.random.Generator or seed
+        random generator owned by this chain (see gsutil.makeRandomGenerator),
+        used when no seed is given to the generation functions.
+    backoff: bool
+        if True, transitions are also counted for all the shorter contexts
+        and generation backs off to the longest observed context, so that
+        high orders can be used without failing on unseen combinations.
+    minContextCount: float
+        with backoff, contexts (except the empty one) observed less than
+        minContextCount times at a step are backed off.
+
+    Notes
+    -----
+    Transitions are stored in a MarkovTable (see `table`). The former
+    `transitionTable` (list of dicts per step) is still available as a
+    read-only view.
+    With backoff, `backoffTables[k]` holds the transitions of the contexts
+    made of the k previous states. All tables share the same states.
+
+    """
+
+    def __init__(self, order=1, numSteps=32, loopDuration=4, rng=None, backoff=False, minContextCount=1):
+        self.order = order
+        self.numSteps = numSteps
+        self.loopDuration = loopDuration
+        self.rng = gsutil.makeRandomGenerator(rng)
+        self.backoff = backoff
+        self.minContextCount = minContextCount
+        self._newTables()
+        self.originPatterns = []
+        self._transitionTable = None
+        self._transitionTableVersion = None
+        self._matrixCache = {}
+        self._matrixCacheVersion = None
+
+    @property
+    def transitionTable(self):
+        """
+        List (one element per step) of dicts {previousStates: {state: probability}},
+        built from the table.
+
+        """
+        if self._transitionTable is None or self._transitionTableVersion != self.table.version:
+            table = self.table
+            transitionTable = [{} for f in range(int(table.numSteps))]
+            probabilities = table.probabilities.tolist()
+            nextStates = table.nextStates.tolist()
+            rowPtr = table.rowPtr.tolist()
+            for row, (step, contextId) in enumerate(zip(table.rowSteps.tolist(), table.rowContexts.tolist())):
+                transitionTable[step][table.getContextLabel(contextId)] = {
+                    table.states[nextStates[i]]: probabilities[i] for i in range(rowPtr[row], rowPtr[row + 1])}
+            self._transitionTable = transitionTable
+            self._transitionTableVersion = self.table.version
+        return self._transitionTable
+
+    def generateTransitionTableFromPatternList(self, patternClasses):
+        """Generate style based on list of Pattern
+        Args:
+            patternClasses:  list of GSPatterns
+        """
+        if not isinstance(patternClasses, list):
+            markovLog.error("PatternMarkov needs a list of patterns")
+            return False
+        else:
+            self.originPatterns = patternClasses
+            self.buildTransitionTable()
+
+    def getMarkovConfig(self):
+        return "order(%i), loopLength(%f), numSteps(%i)" % (
+            self.order, self.loopDuration, self.numSteps)
+
+    def buildTransitionTable(self):
+        """
+        Builds a transition table with the previously given list of Patterns.
+
+        Patterns are binarized on the step grid (see binarizePatterns) and
+        transitions are counted from the grid, patterns are left untouched.
+
+        """
+        self._newTables()
+        self._countPatterns(self.originPatterns, 1)
+
+    def _newTables(self):
+        self.table = MarkovTable(self.numSteps)
+        self.backoffTables = [MarkovTable(self.numSteps) for k in range(self.order)] if self.backoff else []
+        self._shareStates()
+
+    def _shareStates(self):
+        """
+        Backoff tables use the states interned by the main table.
+
+        """
+        for table in self.backoffTables:
+            table.states = self.table.states
+            table.stateIds = self.table.stateIds
+
+    def addPatterns(self, patterns):
+        """
+        Adds the transitions of new patterns to the current table, without
+        retraining on the previous ones.
+
+        Args:
+            patterns: list (or any iterable) of Patterns
+        """
+        patterns = list(patterns)
+        self.originPatterns = self.originPatterns + patterns
+        self._countPatterns(patterns, 1)
+
+    def removePatterns(self, patterns):
+        """
+        Removes the transitions of patterns previously given to the table.
+        Transitions that are no longer observed are dropped.
+
+        Args:
+            patterns: list of Patterns (the same objects given at training)
+        Raises:
+            ValueError: if a pattern was not given at training, in which case
+                the table is left unchanged
+        """
+        patterns = list(patterns)
+        originPatterns = list(self.originPatterns)
+        for p in patterns:
+            for i, originPattern in enumerate(originPatterns):
+                if originPattern is p:
+                    del originPatterns[i]
+                    break
+            else:
+                raise ValueError("can't remove pattern %s that was not used to train the chain" % p.name)
+        self.originPatterns = originPatterns
+        self._countPatterns(patterns, -1)
+
+    def merge(self, *others):
+        """
+        Adds the transitions counted by other chains (or MarkovTables) to
+        this one, e.g. chains trained on different shards of a corpus.
+
+        Args:
+            others: PatternMarkov or MarkovTable with the same configuration
+        Returns:
+            this chain
+        """
+        tables = []
+        backoffTables = []
+        for other in others:
+            if isinstance(other, PatternMarkov):
+                if (other.order, other.numSteps, other.backoff) != (self.order, self.numSteps, self.backoff):
+                    raise ValueError("can't merge PatternMarkov %s with %s" % (
+                        self.getMarkovConfig(), other.getMarkovConfig()))
+                self.originPatterns = self.originPatterns + other.originPatterns
+                backoffTables += [other.backoffTables]
+                other = other.table
+            elif self.backoff:
+                raise ValueError("PatternMarkov with backoff can only be merged with other chains")
+            tables += [other]
+        self.table.merge(*tables)
+        for k, table in enumerate(self.backoffTables):
+            table.merge(*[otherTables[k] for otherTables in backoffTables])
+        return self
+
+    def __add__(self, other):
+        merged = copy.copy(self)
+        merged.table = self.table.copy()
+        merged.backoffTables = [table.copy() for table in self.backoffTables]
+        merged._shareStates()
+        merged._transitionTable = None
+        return merged.merge(other)
+
+    def compact(self, minCount=0, minProbability=0, quantize=False):
+        """
+        Makes the chain smaller: prunes rare transitions (see
+        MarkovTable.prune) and optionally quantizes probabilities to uint16
+        (see MarkovTable.quantize). Should be done once training is over.
+
+        Args:
+            minCount: transitions counted less than minCount are removed
+            minProbability: transitions less probable than minProbability are removed
+            quantize: if True, probabilities are quantized to 1 / 65535
+        Returns:
+            dict {'numTransitions': (before, after), 'numBytes': (before, after)}
+            where numBytes is the size of the tables saved in binary files
+        """
+        tables = [self.table] + self.backoffTables
+        numTransitions = [sum(len(table.nextStates) for table in tables)]
+        numBytes = [sum(table.getNumBytes() for table in tables)]
+        for table in tables:
+            table.prune(minCount, minProbability)
+            if quantize:
+                table.quantize()
+        numTransitions += [sum(len(table.nextStates) for table in tables)]
+        numBytes += [sum(table.getNumBytes() for table in tables)]
+        markovLog.info("compacted %s: %i -> %i transitions, %i -> %i bytes" % (
+            self.getMarkovConfig(), numTransitions[0], numTransitions[1], numBytes[0], numBytes[1]))
+        return {'numTransitions': tuple(numTransitions), 'numBytes': tuple(numBytes)}
+
+    def _countPatterns(self, patterns, weight):
+        """
+        Binarizes patterns and adds their transitions to the table with a
+        given weight (-1 to remove them).
+
+        """
+        if len(patterns) == 0:
+            return
+        stretchRatio = self.numSteps * 1.0 / self.loopDuration
+        for p in patterns:
+            if self.numSteps != int(p.duration * stretchRatio):
+                markovLog.warning(
+                        "PatternMarkov: quantization to numSteps failed, numSteps=" + str(
+                                self.numSteps) + " duration=" + str(
+                                p.duration * stretchRatio) + " cfg : " + self.getMarkovConfig())
+        grid, tags = binarizePatterns(patterns, self.numSteps, self.loopDuration)
+        self.addGrid(grid, tags, weight)
+
+    def addGrid(self, grid, tags, weight=1):
+        """
+        Adds the transitions of already binarized patterns (see
+        binarizePatterns), e.g. to train several chains on a same grid.
+        Patterns are not added to originPatterns.
+
+        Args:
+            grid: boolean array (numPatterns, numSteps, numTags)
+            tags: tags of the grid
+            weight: count of each transition (-1 to remove them)
+        """
+        stateGrid = internGridStates(grid, tags, self.table)
+        steps = np.broadcast_to(np.arange(self.numSteps), stateGrid.shape)
+        counts = np.full(stateGrid.shape, weight, dtype=np.float64)
+        orders = list(range(len(self.backoffTables))) + [self.order]
+        for order, table in zip(orders, self.backoffTables + [self.table]):
+            table.addCounts(steps, internGridContexts(stateGrid, order, table), stateGrid, counts)
+
+    def getStringTransitionTable(self, reduceTuples=True, jsonStyle=True):
+        import copy
+        stringTable = copy.deepcopy(self.transitionTable)
+
+        def _tupleToString(d):
+            if isinstance(d, dict):
+                for k, v in list(d.items()):
+                    if isinstance(k, tuple):
+                        d[str(_tupleToString(k))] = d.pop(k)
+                    _tupleToString(v)
+            elif isinstance(d, list):
+                for v in d:
+                    _tupleToString(v)
+            elif isinstance(d, tuple):
+                newTuple = ()
+                for v in d:
+                    newTuple += (_tupleToString(v),)
+                if reduceTuples and len(newTuple) == 1:
+                    newTuple = newTuple[0]
+                d = newTuple
+            return d
+
+        for t in stringTable:
+            t = _tupleToString(stringTable)
+
+        if jsonStyle:
+            import json
+
+            for i in range(len(stringTable)):
+                stringTable[i] = json.dumps(stringTable[i], indent=1)
+
+        return stringTable
+
+    def __repr__(self):
+        res = "Markov Transition Table\n"
+        st = self.getStringTransitionTable(reduceTuples=True, jsonStyle=True)
+        i = 0
+        for t in st:
+            res += "step %d\n%s\n" % (i, t)
+            i += 1
+        return res
+
+    def generatePattern(self, seed=None):
+        """Generate a new pattern from current transition table.
+
+        Args:
+            seed: seed used for random initialisation of pattern (value of None uses the chain's random generator)
+        """
+        stateIds = self._sampleStateIds(self._getRandomGenerator(seed))
+        return patternFromStates([self.table.states[s] for s in stateIds], self.loopDuration)
+
+    def _sampleStateIds(self, rng):
+        """
+        Samples a single chain, returns the list of its state ids.
+
+        """
+        table = self.table
+        if self.backoff:
+            stateIds, valid = self._sampleChainsWithBackoff(1, rng)
+            if not valid[0]:
+                raise Exception(" can't find combination in markov")
+            return stateIds[0].tolist()
+        sampler = table.getSampler()
+
+        # start states are drawn among the contexts observed at step `order`
+        startRow = sampler.sampleStart(rng.random())
+        if startRow < 0:
+            raise Exception("Can't find start hypothesis in markov")
+        events = list(table.contexts[int(table.rowContexts[startRow])])
+        for i in range(self.order, self.numSteps):
+            newPast = tuple(events[i - self.order:i])
+            row = sampler.findRow(i, table.contextIds.get(newPast))
+            if row < 0:
+                markovLog.error(
+                        "not found combination %s at step %i \n transitions\n %s" % (
+                            [table.states[s] for s in newPast], i, self.transitionTable[i]))
+                raise Exception(" can't find combination in markov")
+            events += [sampler.sample(row, rng.random())]
+        return events
+
+    def generatePatterns(self, numPatterns, seed=None, asArray=False, maxNumTries=100):
+        """
+        Generates many patterns at once, all chains being sampled in
+        lockstep with a numpy random Generator.
+
+        Parameters
+        ----------
+        numPatterns: int
+            number of patterns to generate.
+        seed: int or numpy.random.Generator
+            seed used for random initialisation (None uses the chain's
+            random generator).
+        asArray: bool
+            if True returns the generated state ids instead of patterns.
+        maxNumTries: int
+            maximum number of batches drawn to replace chains that reached
+            an unobserved context.
+
+        Returns
+        -------
+        An int array (numPatterns, numSteps) of state ids (see
+        `table.states`) if asArray, else a GeneratedPatterns lazy sequence.
+
+        """
+        rng = self._getRandomGenerator(seed)
+        sampler = self.table.getSampler()
+        batches = []
+        numGenerated = 0
+        for i in range(maxNumTries):
+            if self.backoff:
+                stateIds, valid = self._sampleChainsWithBackoff(numPatterns - numGenerated, rng)
+            else:
+                stateIds, valid = sampler.sampleChains(numPatterns - numGenerated, self.numSteps, rng)
+            batches += [stateIds[valid]]
+            numGenerated += int(valid.sum())
+            if numGenerated == numPatterns:
+                break
+        else:
+            raise Exception("can't find combination in markov")
+        stateIds = np.concatenate(batches)
+        if asArray:
+            return stateIds
+        return GeneratedPatterns(stateIds, self.table.states, self.loopDuration)
+
+    def generateGrid(self, numPatterns=None, seed=None, tags=None, velocity=None, packed=False):
+        """
+        Generates patterns as step grids, without building events (see
+        patternFromGrid to get a Pattern from a grid).
+
+        Args:
+            numPatterns: number of grids, None for a single one
+            seed: int or numpy.random.Generator (None uses the chain's generator)
+            tags: tags of the grid columns (default: getGridTags())
+            velocity: if given, grids hold this velocity (uint8) instead of booleans
+            packed: if True, each step is a bitmask of its tags (bit i for tags[i])
+        Returns:
+            array (numPatterns, numSteps, numTags), or (numPatterns, numSteps)
+            if packed, without the first axis if numPatterns is None
+        """
+        if numPatterns is None:
+            stateIds = self._sampleStateIds(self._getRandomGenerator(seed))
+        else:
+            stateIds = self.generatePatterns(numPatterns, seed=seed, asArray=True)
+        return _formatGrid(self.getStateTags(tags)[stateIds], velocity=velocity, packed=packed)
+
+    def getGridTags(self):
+        """
+        Tags of the states of the table ('silence' excluded), in the order
+        of the columns of generated grids.
+        """
+        cache = self._getMatrixCache()
+        if 'gridTags' not in cache:
+            tags = []
+            for state in self.table.states:
+                tags += [t for t in state if t != 'silence' and t not in tags]
+            cache['gridTags'] = tags
+        return cache['gridTags']
+
+    def getStateTags(self, tags=None):
+        """
+        Boolean array (numStates, numTags): tags of each state of the table.
+
+        Args:
+            tags: tags of the columns (default: getGridTags())
+        """
+        cache = self._getMatrixCache()
+        key = ('stateTags', None if tags is None else tuple(tags))
+        if key not in cache:
+            tags = self.getGridTags() if tags is None else tags
+            tagIdx = {t: i for i, t in enumerate(tags)}
+            stateTags = np.zeros((len(self.table.states), len(tags)), dtype=bool)
+            for s, state in enumerate(self.table.states):
+                stateTags[s, [tagIdx[t] for t in state if t in tagIdx]] = True
+            stateTags.flags.writeable = False
+            cache[key] = stateTags
+        return cache[key]
+
+    def _sampleChainsWithBackoff(self, numChains, rng):
+        """
+        Samples chains in lockstep, each step using the longest context of
+        each chain observed at least minContextCount times.
+
+        Returns
+        -------
+        A tuple (stateIds, valid) (see MarkovSampler.sampleChains).
+
+        """
+        samplers = [table.getSampler() for table in self.backoffTables] + [self.table.getSampler()]
+        order = self.order
+        topSampler = samplers[order]
+        stateIds = np.zeros((numChains, self.numSteps), dtype=np.int64)
+        if len(topSampler.startRows) == 0:
+            return stateIds, np.zeros(numChains, dtype=bool)
+        starts = np.searchsorted(topSampler.startCumulative, rng.random(numChains), side='right')
+        stateIds[:, :order] = topSampler._contextArray[topSampler.startContexts[starts]]
+        valid = np.ones(numChains, dtype=bool)
+        for step in range(order, self.numSteps):
+            r = rng.random(numChains)
+            toDraw = np.arange(numChains)
+            for k in reversed(range(order + 1)):
+                sampler = samplers[k]
+                rows = sampler.lookupRows(step, sampler.lookupContexts(stateIds[toDraw, step - k:step]))
+                found = rows >= 0
+                if k > 0:
+                    found &= sampler.rowTotals[np.maximum(rows, 0)] >= self.minContextCount
+                entries = np.searchsorted(sampler.offsetCumulative, rows[found] + r[toDraw[found]], side='right')
+                stateIds[toDraw[found], step] = sampler.nextStateArray[entries]
+                toDraw = toDraw[~found]
+                if len(toDraw) == 0:
+                    break
+            valid[toDraw] = False
+        return stateIds, valid
+
+    def getConstraintMask(self, requiredTags=None, forbiddenTags=None, allowedStates=None):
+        """
+        Builds a mask of the states allowed at each step.
+
+        Args:
+            requiredTags: dict {step: list of tags} of tags that must be
+                played at a step (e.g. {0: ["Kick"], 8: ["Kick"]})
+            forbiddenTags: dict {step: list of tags} of tags that can't be
+                played at a step
+            allowedStates: dict {step: list of states} restricting a step to
+                some states (tuples of tags)
+        Returns:
+            bool numpy array (numSteps, numStates), to be used with
+            compileConstraints or generateConstrainedPatterns
+        """
+        states = self.table.states
+        mask = np.ones((self.numSteps, len(states)), dtype=bool)
+        for step, tags in (requiredTags or {}).items():
+            mask[step] &= [all(t in state for t in tags) for state in states]
+        for step, tags in (forbiddenTags or {}).items():
+            mask[step] &= [not any(t in state for t in tags) for state in states]
+        for step, stepStates in (allowedStates or {}).items():
+            stepStates = set([tuple(sorted(set(state), key=repr)) for state in stepStates])
+            mask[step] &= [state in stepStates for state in states]
+        return mask
+
+    def compileConstraints(self, mask):
+        """
+        Prunes the chain for a constraint mask (see ConstrainedSampler).
+        The last compiled sampler is cached until the table changes.
+
+        Args:
+            mask: bool array (numSteps, numStates) (see getConstraintMask)
+        Returns:
+            ConstrainedSampler
+        """
+        mask = np.asarray(mask, dtype=bool)
+        cacheKey = (self.table.version, mask.shape, mask.tobytes())
+        if getattr(self, '_constrainedSamplerKey', None) != cacheKey:
+            self._constrainedSampler = ConstrainedSampler(self.table, self.numSteps, mask)
+            self._constrainedSamplerKey = cacheKey
+        return self._constrainedSampler
+
+    def generateConstrainedPatterns(self, numPatterns, constraints, seed=None, asArray=False):
+        """
+        Generates patterns satisfying per-step constraints, without retries.
+
+        Args:
+            numPatterns: number of patterns to generate
+            constraints: constraint mask (see getConstraintMask) or
+                ConstrainedSampler (see compileConstraints)
+            seed: seed used for random initialisation (None uses the chain's
+                random generator)
+            asArray: if True returns the generated state ids instead of patterns
+        Returns:
+            int array (numPatterns, numSteps) of state ids if asArray, else a
+            GeneratedPatterns lazy sequence
+        """
+        if not isinstance(constraints, ConstrainedSampler):
+            constraints = self.compileConstraints(constraints)
+        stateIds = constraints.sampleChains(numPatterns, self._getRandomGenerator(seed))
+        if asArray:
+            return stateIds
+        return GeneratedPatterns(stateIds, self.table.states, self.loopDuration)
+
+    def getLogLikelihoods(self, patterns, unseenProbability=0):
+        """
+        Log-likelihood of patterns under the chain: log frequency of their
+        first `order` states (start context), plus the log probabilities of
+        all the following transitions.
+
+        Args:
+            patterns: list of Patterns (or a Dataset), binarized on the step grid
+            unseenProbability: probability given to unobserved transitions
+                (0 gives -inf log-likelihoods)
+        Returns:
+            numpy array of log-likelihoods
+        """
+        patterns = list(patterns)
+        table = self.table
+        sampler = table.getSampler()
+        order = self.order
+        grid, tags = binarizePatterns(patterns, self.numSteps, self.loopDuration)
+        stateGrid = lookupGridStates(grid, tags, table)
+        logUnseen = np.log(unseenProbability) if unseenProbability > 0 else -np.inf
+
+        # start contexts
+        startRows = sampler.lookupRows(order, sampler.lookupContexts(stateGrid[:, :order]))
+        startTotal = sampler.rowTotals[sampler.startRows].sum()
+        with np.errstate(divide='ignore'):
+            logLikelihoods = np.where(startRows >= 0, np.log(sampler.rowTotals[np.maximum(startRows, 0)] / max(
+                startTotal, 1e-300)), logUnseen)
+
+        # transitions of all steps at once
+        steps = np.arange(order, self.numSteps)
+        if len(steps) and len(patterns):
+            windows = steps[:, None] - order + np.arange(order)[None, :]
+            contexts = sampler.lookupContexts(stateGrid[:, windows].reshape(len(patterns) * len(steps), order))
+            contexts = contexts.reshape(len(patterns), len(steps))
+            rows = sampler.lookupRows(steps[None, :], contexts)
+            entries = table.findEntries(rows, stateGrid[:, order:])
+            with np.errstate(divide='ignore'):
+                logProbabilities = np.log(table.probabilities)
+            if len(logProbabilities):
+                logProbabilities = np.where(entries >= 0, logProbabilities[np.maximum(entries, 0)], logUnseen)
+            else:
+                logProbabilities = np.full(entries.shape, logUnseen)
+            logLikelihoods = logLikelihoods + logProbabilities.sum(axis=1)
+        return logLikelihoods
+
+    def getClosestPatterns(self, patterns, editCost=1., asArray=False, batchSize=256):
+        """
+        Most likely patterns of the chain under an edit cost, found by
+        dynamic programming (Viterbi) over the transitions of each step.
+
+        The score of a generated state sequence is its log-likelihood (see
+        getLogLikelihoods) minus editCost times the number of tags added or
+        removed at each step to go from the given pattern to it.
+
+        Args:
+            patterns: list of Patterns (or a Dataset)
+            editCost: cost of a tag insertion or deletion, in log-probability
+                units (high costs stay close to the patterns, low costs give
+                more likely patterns)
+            asArray: if True returns the state ids instead of patterns
+            batchSize: number of patterns decoded at once
+        Returns:
+            int array (numPatterns, numSteps) of state ids if asArray, else a
+            GeneratedPatterns lazy sequence
+        """
+        patterns = list(patterns)
+        table = self.table
+        # tags of the states, to compare them with the pattern steps
+        stateTags = []
+        for state in table.states:
+            stateTags += [t for t in state if t not in stateTags]
+        grid, tags = binarizePatterns(patterns, self.numSteps, self.loopDuration, tags=list(stateTags))
+        tagIds = {t: i for i, t in enumerate(tags)}
+        stateGrid = np.zeros((len(table.states), len(tags)), dtype=np.float64)
+        for stateId, state in enumerate(table.states):
+            stateGrid[stateId, [tagIds[t] for t in state]] = 1
+
+        stateIds = np.zeros((len(patterns), self.numSteps), dtype=np.int64)
+        for start in range(0, len(patterns), batchSize):
+            patternGrid = grid[start:start + batchSize].astype(np.float64)
+            # number of tags differing between each step of the patterns and each state
+            costs = patternGrid.sum(axis=2)[:, :, None] + stateGrid.sum(axis=1)[None, None, :] - 2 * np.dot(
+                patternGrid, stateGrid.T)
+            stateIds[start:start + batchSize] = self._viterbi(costs * editCost)
+        if asArray:
+            return stateIds
+        return GeneratedPatterns(stateIds, table.states, self.loopDuration)
+
+    def _viterbi(self, costs):
+        """
+        Decodes the best state sequences given costs (numPatterns, numSteps,
+        numStates) of each state at each step.
+
+        """
+        table = self.table
+        sampler = table.getSampler()
+        order = self.order
+        numPatterns = costs.shape[0]
+        if len(sampler.startRows) == 0:
+            raise Exception("Can't find start hypothesis in markov")
+        patternIndexes = np.arange(numPatterns)
+        with np.errstate(divide='ignore'):
+            logProbabilities = np.log(table.probabilities)
+        entryContexts = table.getEntryContexts().astype(np.int64)
+
+        # scores of the contexts reached at step `order`, plus one column for
+        # the unknown contexts (-1, see lookupContexts): no row continues them,
+        # so they only score chains ending at the last step
+        unknownContext = len(table.contexts)
+        startTotals = sampler.rowTotals[sampler.startRows]
+        scores = np.full((numPatterns, unknownContext + 1), -np.inf)
+        startStates = sampler._contextArray[sampler.startContexts]
+        startCosts = np.zeros((numPatterns, len(startStates)))
+        for n in range(order):
+            startCosts += costs[:, n, startStates[:, n]]
+        scores[:, sampler.startContexts] = np.log(startTotals / startTotals.sum()) - startCosts
+
+        # for each step, best transition leading to each reached context
+        backPointers = []
+        for step in range(order, self.numSteps):
+            startRow, endRow = table.getRowsAtStep(step)
+            entries = np.arange(table.rowPtr[startRow], table.rowPtr[endRow])
+            nextContexts = sampler.entryNextContexts[entries]
+            nextContexts = np.where(nextContexts < 0, unknownContext, nextContexts)
+            sortedIndexes = np.argsort(nextContexts, kind='mergesort')
+            entries, nextContexts = entries[sortedIndexes], nextContexts[sortedIndexes]
+            groupStarts = np.flatnonzero(np.concatenate([[True], nextContexts[1:] != nextContexts[:-1]]))
+            reachedContexts = nextContexts[groupStarts]
+            newScores = np.full(scores.shape, -np.inf)
+            if len(entries) == 0:
+                backPointers += [(reachedContexts, np.zeros((numPatterns, 0), dtype=np.int64))]
+                scores = newScores
+                continue
+            entryScores = scores[:, entryContexts[entries]] + logProbabilities[entries] - costs[
+                :, step, sampler.nextStateArray[entries]]
+            bestScores = np.maximum.reduceat(entryScores, groupStarts, axis=1)
+            isBest = entryScores == np.repeat(bestScores, np.diff(np.append(groupStarts, len(entries))), axis=1)
+            bestPositions = np.minimum.reduceat(np.where(isBest, np.arange(len(entries)), len(entries)),
+                                                groupStarts, axis=1)
+            newScores[:, reachedContexts] = bestScores
+            backPointers += [(reachedContexts, entries[bestPositions])]
+            scores = newScores
+
+        contexts = np.argmax(scores, axis=1)
+        if np.any(np.isinf(scores[patternIndexes, contexts])):
+            raise Exception(" can't find combination in markov")
+        stateIds = np.zeros((numPatterns, self.numSteps), dtype=np.int64)
+        for step in reversed(range(order, self.numSteps)):
+            reachedContexts, bestEntries = backPointers[step - order]
+            entries = bestEntries[patternIndexes, np.searchsorted(reachedContexts, contexts)]
+            stateIds[:, step] = sampler.nextStateArray[entries]
+            contexts = entryContexts[entries]
+        stateIds[:, :order] = sampler._contextArray[contexts]
+        return stateIds
+
+    def _getRandomGenerator(self, seed=None):
+        """
+        A new generator for a given seed, so that the same seed leads to the
+        same result, else the chain's own generator.
+
+        """
+        return self.rng if seed is None else gsutil.makeRandomGenerator(seed)
+
+    def checkSilences(self, p):
+        for i in range(int(p.duration)):
+            c = p.getStartingEventsAtTime(i)
+            if len(c) > 1 and ("silence" in c):
+                markovLog.error("wrong silence")
+
+    def checkSilenceInList(self, c):
+        if len(c) > 1 and ('silence' in c):
+            markovLog.error("wrong silence")
+
+    def _buildTupleForEvents(self, events):
+        """Build a tuple from list of lists of events:
+        If list is [[a1, a2], [b1, b2, b3]] (where an and bn are tags of listed events)
+        this function returns "a1/a2, b1/b2/b3"
+        """
+        res = tuple()
+        for evAtStep in events:
             curL = list()
             for e in evAtStep:
                 curL += [e.tag]
 
-            # set allow for having consistent ordering, and remove step-wise overlapping events
-            res += (tuple(set(curL)),)
+            # sorted set allow for having consistent ordering, and remove step-wise overlapping events
+            res += (tuple(sorted(set(curL), key=repr)),)
         return res
 
     def formatPattern(self, p):
@@ -523,30 +2744,64 @@ class PatternMarkov(object):
     def getInternalState(self):
         """utility function to save current state
         """
-        res = {"transitionTable": self.transitionTable, "order": self.order,
+        res = {"table": self.table.toJSONDict(), "order": self.order,
                "numSteps":        self.numSteps,
                "loopDuration":    self.loopDuration}
+        if self.backoff:
+            res["backoffTables"] = [table.toJSONDict() for table in self.backoffTables]
+            res["minContextCount"] = self.minContextCount
         return res
 
     def setInternalState(self, state):
         """
         Utility function to load the current state.
+        Legacy states holding a "transitionTable" are converted.
+        """
+        if "table" in state:
+            self.table = MarkovTable().fromJSONDict(state["table"])
+        else:
+            self.table = MarkovTable().fromTransitionTable(state["transitionTable"])
+        self.order = state["order"]
+        self.numSteps = state["numSteps"]
+        self.loopDuration = state["loopDuration"]
+        self.backoff = "backoffTables" in state
+        self.minContextCount = state.get("minContextCount", 1)
+        self.backoffTables = [MarkovTable().fromJSONDict(table) for table in state.get("backoffTables", [])]
+        self._shareStates()
+
+    def getBinaryState(self):
+        """
+        State saved in binary style files: same as getInternalState, with
+        tables stored as numpy arrays (see MarkovTable.toArrayDict).
+        """
+        res = {"table": self.table.toArrayDict(), "order": self.order,
+               "numSteps":        self.numSteps,
+               "loopDuration":    self.loopDuration}
+        if self.backoff:
+            res["backoffTables"] = [table.toArrayDict(includeStates=False) for table in self.backoffTables]
+            res["minContextCount"] = self.minContextCount
+        return res
+
+    def setBinaryState(self, state):
+        """
+        Loads a state returned by getBinaryState.
         """
-        self.transitionTable = state["transitionTable"]
+        self.table = MarkovTable().fromArrayDict(state["table"])
         self.order = state["order"]
         self.numSteps = state["numSteps"]
         self.loopDuration = state["loopDuration"]
+        self.backoff = "backoffTables" in state
+        self.minContextCount = state.get("minContextCount", 1)
+        self.backoffTables = [MarkovTable().fromArrayDict(table, states=self.table)
+                              for table in state.get("backoffTables", [])]
 
     def isBuilt(self):
-        return self.transitionTable != {}
+        return len(self.table) > 0
 
     def getAllPossibleStates(self):
-        possibleStates = []
-        for d in self.transitionTable:
-            possibleStates += list(d.keys())
-            for v in d.values():
-                for state in v.keys():
-                    possibleStates += [state]
+        table = self.table
+        possibleStates = [table.getContextLabel(c) for c in set(table.rowContexts.tolist())]
+        possibleStates += [table.states[s] for s in set(table.nextStates.tolist())]
         possibleStates = list(set(possibleStates))
         return possibleStates
 
@@ -554,41 +2809,157 @@ class PatternMarkov(object):
         return list(set(self.getPossibleInStatesAtStep(
                 step) + self.getPossibleOutStatesAtStep(step)))
 
+    def _getStepRange(self, step):
+        if step < 0: step += self.numSteps
+        step %= self.numSteps
+        return self.table.getRowsAtStep(step)
+
     def getPossibleOutStatesAtStep(self, step):
-        if step < 0: step += len(self.transitionTable)
-        step %= len(self.transitionTable)
-        d = self.transitionTable[step]
-        possibleStates = []
-        for v in d.values():
-            for state in v.keys():
-                possibleStates += [state]
-        possibleStates = list(set(possibleStates))
-        return possibleStates
+        start, end = self._getStepRange(step)
+        table = self.table
+        stateIds = np.unique(table.nextStates[table.rowPtr[start]:table.rowPtr[end]])
+        return [table.states[s] for s in stateIds.tolist()]
 
     def getPossibleInStatesAtStep(self, step):
-        if step < 0: step += len(self.transitionTable)
-        step %= len(self.transitionTable)
-        d = self.transitionTable[step]
-        return list(d.keys())
+        start, end = self._getStepRange(step)
+        return [self.table.getContextLabel(c) for c in self.table.rowContexts[start:end].tolist()]
+
+    def _getMatrixCache(self):
+        """
+        Cache of matrices and index maps, cleared when the table changes.
+
+        """
+        version = self.table.version
+        if self._matrixCacheVersion != version:
+            self._matrixCache = {}
+            self._matrixCacheVersion = version
+        return self._matrixCache
+
+    def getStateIndexMaps(self):
+        """
+        Index maps of the global transition matrix (see getGlobalMatrix).
+
+        Returns
+        -------
+        A tuple (possibleStatesIn, possibleStatesOut, inIndexes, outIndexes):
+        the labels of the rows (previous states) and columns (next states),
+        and dicts from these labels to their index.
+
+        """
+        cache = self._getMatrixCache()
+        if 'indexMaps' not in cache:
+            table = self.table
+            inIds = np.unique(table.rowContexts)
+            outIds = np.unique(table.nextStates)
+            possibleStatesIn = [table.getContextLabel(c) for c in inIds.tolist()]
+            possibleStatesOut = [table.states[s] for s in outIds.tolist()]
+            cache['indexMaps'] = (possibleStatesIn, possibleStatesOut,
+                                  {label: i for i, label in enumerate(possibleStatesIn)},
+                                  {state: i for i, state in enumerate(possibleStatesOut)})
+            cache['indexIds'] = (inIds, outIds)
+        return cache['indexMaps']
 
     def getMatrixAtStep(self, step, possibleStatesIn=None,
-                        possibleStatesOut=None, matrix=None):
-        if step < 0: step += len(self.transitionTable)
-        possibleStatesIn = possibleStatesIn or self.getPossibleInStatesAtStep(
-                step)
-        possibleStatesOut = possibleStatesOut or self.getPossibleOutStatesAtStep(
-                step)
-        sizeIn = len(possibleStatesIn)
-        sizeOut = len(possibleStatesOut)
-        matrix = matrix or [[0] * sizeOut for i in range(sizeIn)]
-        d = self.transitionTable[step]
-        for k, v in d.items():
-            colIdx = possibleStatesIn.index(k)
-            for evt, p in v.items():
-                rowIdx = possibleStatesOut.index(evt)
-                matrix[colIdx][rowIdx] += p
-
-        return matrix, possibleStatesIn, possibleStatesOut
+                        possibleStatesOut=None, matrix=None, sparse=False):
+        """
+        Transition matrix at a given step.
+
+        Parameters
+        ----------
+        step: int
+            step of the matrix (negative steps count from the end).
+        possibleStatesIn, possibleStatesOut: list
+            labels of the rows and columns (default: the states observed at
+            this step).
+        matrix: numpy array
+            if given, probabilities are added to it (in place).
+        sparse: bool
+            if True and no matrix is given, returns a scipy.sparse CSR
+            matrix (requires scipy).
+
+        Returns
+        -------
+        A tuple (matrix, possibleStatesIn, possibleStatesOut) where matrix
+        holds probabilities (rows: previous states, columns: next states).
+        Matrices of default labels are cached until the table changes and
+        shouldn't be modified.
+
+        """
+        if step < 0: step += self.numSteps
+        table = self.table
+        cacheKey = ('step', step, sparse)
+        isDefault = possibleStatesIn is None and possibleStatesOut is None and matrix is None
+        cache = self._getMatrixCache()
+        if isDefault and cacheKey in cache:
+            return cache[cacheKey]
+
+        start, end = table.getRowsAtStep(step)
+        entries = slice(table.rowPtr[start], table.rowPtr[end])
+        entryContexts = np.repeat(table.rowContexts[start:end], np.diff(table.rowPtr[start:end + 1]))
+        if possibleStatesIn is None and possibleStatesOut is None:
+            # rows and columns are the sorted interned ids observed at this step
+            inIds = table.rowContexts[start:end]
+            outIds = np.unique(table.nextStates[entries])
+            possibleStatesIn = [table.getContextLabel(c) for c in inIds.tolist()]
+            possibleStatesOut = [table.states[s] for s in outIds.tolist()]
+            rows = np.searchsorted(inIds, entryContexts)
+            columns = np.searchsorted(outIds, table.nextStates[entries])
+        else:
+            possibleStatesIn = possibleStatesIn or self.getPossibleInStatesAtStep(step)
+            possibleStatesOut = possibleStatesOut or self.getPossibleOutStatesAtStep(step)
+            # lookup tables from interned ids to matrix indexes
+            inIndexes = np.full(len(table.contexts), -1, dtype=np.int64)
+            for i, label in enumerate(possibleStatesIn):
+                contextId = table.contextIds.get(tuple([table.stateIds.get(s) for s in label]))
+                if contextId is not None:
+                    inIndexes[contextId] = i
+            outIndexes = np.full(len(table.states), -1, dtype=np.int64)
+            for i, state in enumerate(possibleStatesOut):
+                if state in table.stateIds:
+                    outIndexes[table.stateIds[state]] = i
+            rows = inIndexes[entryContexts]
+            columns = outIndexes[table.nextStates[entries]]
+
+        valid = (rows >= 0) & (columns >= 0)
+        shape = (len(possibleStatesIn), len(possibleStatesOut))
+        matrix = _buildMatrix(rows[valid], columns[valid], table.probabilities[entries][valid], shape, matrix, sparse)
+        result = (matrix, possibleStatesIn, possibleStatesOut)
+        if isDefault:
+            if not sparse:
+                matrix.flags.writeable = False
+            cache[cacheKey] = result
+        return result
+
+    def getGlobalMatrix(self, sparse=False):
+        """
+        Sum of the transition matrices of all steps, over all the states of
+        the table (see getStateIndexMaps).
+
+        Parameters
+        ----------
+        sparse: bool
+            if True returns a scipy.sparse CSR matrix (requires scipy).
+
+        Returns
+        -------
+        A tuple (matrix, possibleStatesIn, possibleStatesOut), cached until
+        the table changes.
+
+        """
+        cache = self._getMatrixCache()
+        cacheKey = ('global', sparse)
+        if cacheKey not in cache:
+            possibleStatesIn, possibleStatesOut = self.getStateIndexMaps()[:2]
+            inIds, outIds = cache['indexIds']
+            table = self.table
+            rows = np.searchsorted(inIds, table.getEntryContexts())
+            columns = np.searchsorted(outIds, table.nextStates)
+            shape = (len(possibleStatesIn), len(possibleStatesOut))
+            matrix = _buildMatrix(rows, columns, table.probabilities, shape, None, sparse)
+            if not sparse:
+                matrix.flags.writeable = False
+            cache[cacheKey] = (matrix, possibleStatesIn, possibleStatesOut)
+        return cache[cacheKey]
 
     def __plotMatrix(self, m, labelsIn, labelsOut):
         import matplotlib.pyplot as plt
@@ -605,28 +2976,415 @@ class PatternMarkov(object):
         plt.show()
 
     def plotMatrixAtStep(self, step):
-        if step < 0: step += len(self.transitionTable)
+        if step < 0: step += self.numSteps
         mat, labelsIn, labelsOut = self.getMatrixAtStep(
                 step)  # ,possibleStates = allTags)
         self.__plotMatrix(mat, labelsIn, labelsOut)
 
     def plotGlobalMatrix(self):
-        numSteps = len(self.transitionTable)
-        possibleStatesIn = list(set(
-                [item for step in range(numSteps) for item in
-                 self.getPossibleInStatesAtStep(step)]))
-        possibleStatesOut = list(set(
-                [item for step in range(numSteps) for item in
-                 self.getPossibleOutStatesAtStep(step)]))
-        sizeIn = len(possibleStatesIn)
-        sizeOut = len(possibleStatesOut)
-        matrix = [[0] * sizeOut for i in range(sizeIn)]
-        for step in range(numSteps):
-            self.getMatrixAtStep(step, possibleStatesIn=possibleStatesIn,
-                                 possibleStatesOut=possibleStatesOut,
-                                 matrix=matrix)
+        matrix, possibleStatesIn, possibleStatesOut = self.getGlobalMatrix()
         self.__plotMatrix(matrix, possibleStatesIn, possibleStatesOut)
 
 
+def trainParallel(paths, workers=None, order=1, numSteps=32, loopDuration=4, noteToTagMap="pitchName", backoff=False):
+    """
+    Trains a PatternMarkov on pattern files with a pool of processes.
+
+    Files are split in shards, each worker parses its shard, slices the
+    patterns in loops of loopDuration, binarizes them and counts their
+    transitions in a MarkovTable. The tables are then merged.
+
+    Parameters
+    ----------
+    paths: list of str
+        MIDI, JSON, JSON Lines or pickle files (can be compressed, see
+        gsio.openFile).
+    workers: int
+        number of processes (default: number of CPUs), 1 counts in the
+        calling process.
+    order, numSteps, loopDuration, backoff:
+        configuration of the PatternMarkov.
+    noteToTagMap:
+        mapping used to read MIDI files (see gsio.fromMidiFile).
+
+    Returns
+    -------
+    A trained PatternMarkov. Its originPatterns are left empty as patterns
+    are only loaded by the workers.
+
+    """
+    paths = list(paths)
+    workers = workers or multiprocessing.cpu_count()
+    # a few shards per worker balances the load between files of different sizes
+    numShards = max(1, min(len(paths), workers * 4))
+    tasks = [(paths[i::numShards], order, numSteps, loopDuration, noteToTagMap, backoff) for i in range(numShards)]
+    if workers == 1:
+        shardChains = [_countShard(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            shardChains = pool.map(_countShard, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    markovChain = PatternMarkov(order=order, numSteps=numSteps, loopDuration=loopDuration, backoff=backoff)
+    markovChain.merge(*shardChains)
+    return markovChain
+
+
+def trainConfigurations(patterns, orders=(1,), numSteps=(32,), loopDurations=(4,), **chainArgs):
+    """
+    Trains a family of PatternMarkov chains on a same corpus, one per
+    (order, numSteps, loopDuration) configuration, sharing the work between
+    them.
+
+    For each loopDuration, patterns are sliced and binarized once, at the
+    least common multiple of numSteps, coarser grids being derived by
+    pooling (see poolGrid). Pooling rounds off-grid events twice, so when
+    some events don't start on the finest grid the coarser grids are
+    binarized directly instead: tables are always the same as training each
+    configuration separately. For each grid, states are interned once and
+    the contexts of all orders (backoff tables included) are taken from a
+    single window of the highest order.
+
+    Parameters
+    ----------
+    patterns: list of Patterns
+        the corpus, sliced in loops of each loopDuration.
+    orders, numSteps, loopDurations: lists
+        values of each parameter, all their combinations are trained.
+    **chainArgs:
+        other arguments of PatternMarkov (rng, backoff, minContextCount).
+
+    Returns
+    -------
+    A dict {(order, numSteps, loopDuration): PatternMarkov}.
+
+    """
+    orders = sorted(set(orders))
+    numSteps = sorted(set(numSteps))
+    finestNumSteps = int(np.lcm.reduce(numSteps))
+    chains = {}
+    for loopDuration in loopDurations:
+        slices = []
+        for p in patterns:
+            slices += p.splitInEqualLengthPatterns(loopDuration)
+        fineGrid, tags = binarizePatterns(slices, finestNumSteps, loopDuration)
+        onFineGrid = _startOnGrid(slices, finestNumSteps, loopDuration)
+        for gridNumSteps in numSteps:
+            family = [PatternMarkov(order=order, numSteps=gridNumSteps, loopDuration=loopDuration, **chainArgs)
+                      for order in orders]
+            for markovChain in family:
+                markovChain.originPatterns = list(slices)
+            if onFineGrid:
+                grid = poolGrid(fineGrid, tags, finestNumSteps // gridNumSteps)
+            else:
+                grid = binarizePatterns(slices, gridNumSteps, loopDuration, tags=list(tags))[0]
+            _countFamily(family, grid, tags)
+            for markovChain in family:
+                chains[(markovChain.order, gridNumSteps, loopDuration)] = markovChain
+    return chains
+
+
+def _startOnGrid(patterns, numSteps, loopDuration):
+    """
+    Checks that all events of patterns start on one of numSteps steps per
+    loopDuration, i.e. that poolGrid gives the same grids as binarizePatterns.
+
+    """
+    stretchRatio = numSteps * 1.0 / loopDuration
+    steps = np.array([e.startTime for p in patterns for e in p.events], dtype=np.float64) * stretchRatio
+    return bool((np.abs(steps - np.round(steps)) < 1e-6).all())
+
+
+def _countFamily(chains, grid, tags):
+    """
+    Counts the transitions of a grid in the tables of chains of different
+    orders (see trainConfigurations).
+
+    """
+    localStates, localGrid = _uniqueGridStates(grid, tags)
+    numSteps = grid.shape[1]
+    steps = np.broadcast_to(np.arange(numSteps), localGrid.shape)
+    maxOrder = max(chain.order for chain in chains)
+    windows = (np.arange(numSteps)[:, None] - maxOrder + np.arange(maxOrder)[None, :]) % numSteps
+    allContexts = localGrid[:, windows]
+    orderContexts = {}
+    for chain in chains:
+        stateIds = np.array([chain.table.getStateId(state) for state in localStates], dtype=np.int64)
+        stateGrid = stateIds[localGrid]
+        orders = list(range(len(chain.backoffTables))) + [chain.order]
+        for order, table in zip(orders, chain.backoffTables + [chain.table]):
+            if order not in orderContexts:
+                if order == 0:
+                    orderContexts[order] = (np.zeros((1, 0), dtype=np.int64), np.zeros(localGrid.size, dtype=np.int64))
+                else:
+                    uniqueContexts, inverse = np.unique(allContexts[:, :, maxOrder - order:].reshape(-1, order),
+                                                        axis=0, return_inverse=True)
+                    orderContexts[order] = (uniqueContexts, inverse.reshape(-1))
+            uniqueContexts, inverse = orderContexts[order]
+            contextIds = np.array([table.getContextId(tuple(c)) for c in stateIds[uniqueContexts].tolist()],
+                                  dtype=np.int64)
+            table.addCounts(steps, contextIds[inverse], stateGrid)
+
+
+def _countShard(task):
+    """
+    Worker of trainParallel: counts the transitions of a shard of files in
+    a PatternMarkov without origin patterns.
+
+    """
+    paths, order, numSteps, loopDuration, noteToTagMap, backoff = task
+    markovChain = PatternMarkov(order=order, numSteps=numSteps, loopDuration=loopDuration, backoff=backoff)
+    for path in paths:
+        slices = []
+        for p in _loadPatternFile(path, noteToTagMap):
+            slices += p.splitInEqualLengthPatterns(loopDuration, makeCopy=False)
+        markovChain._countPatterns(slices, 1)
+    return markovChain
+
+
+def _loadPatternFile(path, noteToTagMap):
+    """
+    Loads the patterns of a file, guessing its format from the extension.
+
+    """
+    root, extension = os.path.splitext(path.lower())
+    if extension in gsio._extensionToCompression:
+        extension = os.path.splitext(root)[1]
+    if extension in ('.mid', '.midi'):
+        return [gsio.fromMidiFile(path, noteToTagMap)]
+    elif extension == '.json':
+        return [gsio.fromJSONFile(path)]
+    elif extension == '.jsonl':
+        return gsio.fromJSONLinesFile(path)
+    elif extension in ('.pickle', '.pkl'):
+        patterns = gsio.fromPickleFile(path)
+        return patterns if isinstance(patterns, list) else [patterns]
+    raise ValueError("unknown pattern file format: %s" % path)
+
+
+class StyleManager(object):
+    """
+    Cache of MarkovStyles trained on a same corpus for several
+    configurations (order, numSteps, loopDuration), e.g. to follow the
+    parameters of a plugin without retraining on each change.
+
+    The corpus is sliced once per loopDuration and binarized once per
+    (numSteps, loopDuration), slices and grids being shared by the styles
+    of all orders. A grid is derived from a cached finer grid of the same
+    loopDuration when possible (see poolGrid) instead of binarizing the
+    slices again. Beyond maxNumStyles, the least recently used styles (and
+    grids) are evicted. Styles can be trained in a background thread (see
+    requestStyle) so that the caller never waits for training.
+
+    Each configuration gets its own random generator, derived from the
+    manager's one and the configuration, so that styles are reproducible
+    whichever thread trains them and in whatever order they are requested.
+
+    Parameters
+    ----------
+    patterns: list of Patterns
+        the corpus, sliced in loops of each loopDuration.
+    maxNumStyles: int
+        maximum number of trained styles (and of grids) kept.
+    rng: numpy.random.Generator or seed
+        generator from which the generators of the styles are derived (see
+        gsutil.makeRandomGenerator).
+    **styleArgs:
+        other arguments of MarkovStyle (backoff, minContextCount).
+
+    """
+
+    def __init__(self, patterns=(), maxNumStyles=8, rng=None, **styleArgs):
+        self.maxNumStyles = maxNumStyles
+        self.styleArgs = styleArgs
+        self.rng = gsutil.makeRandomGenerator(rng)
+        self._rootSeed = int(self.rng.integers(1 << 62))
+        self._lock = threading.RLock()
+        self._requests = collections.deque()
+        self._worker = None
+        self._generation = 0
+        self.setPatterns(patterns)
+
+    def setPatterns(self, patterns):
+        """
+        Changes the corpus, clearing all cached styles.
+
+        """
+        with self._lock:
+            self.patterns = list(patterns)
+            self._generation += 1
+            self._styles = collections.OrderedDict()
+            self._grids = collections.OrderedDict()
+            self._slices = {}
+            # waiters of previous requests train the style themselves
+            for generation, event in getattr(self, '_pending', {}).values():
+                event.set()
+            self._pending = {}
+
+    def getConfigs(self):
+        """
+        Configurations of the trained styles, from the least to the most
+        recently used.
+
+        """
+        with self._lock:
+            return list(self._styles)
+
+    def getSlices(self, loopDuration):
+        """
+        Loops of loopDuration of the corpus (cached).
+
+        """
+        with self._lock:
+            slices = self._slices.get(loopDuration)
+        if slices is None:
+            slices = []
+            for p in self.patterns:
+                slices += p.splitInEqualLengthPatterns(loopDuration)
+            with self._lock:
+                slices = self._slices.setdefault(loopDuration, slices)
+        return slices
+
+    def getGrid(self, numSteps, loopDuration):
+        """
+        Binarized loops of the corpus (see binarizePatterns), cached. The
+        grid is pooled from a cached grid of the same loopDuration with a
+        multiple of numSteps if there is one.
+
+        Returns
+        -------
+        A tuple (grid, tags).
+
+        """
+        key = (numSteps, loopDuration)
+        with self._lock:
+            grid = self._touch(self._grids, key)
+            if grid is not None:
+                return grid
+            finerKeys = [k for k in self._grids if k[1] == loopDuration and k[0] % numSteps == 0]
+            if finerKeys:
+                finerKey = min(finerKeys)
+                finerGrid, tags = self._touch(self._grids, finerKey)
+                grid = (poolGrid(finerGrid, tags, finerKey[0] // numSteps), tags)
+        if grid is None:
+            grid = binarizePatterns(self.getSlices(loopDuration), numSteps, loopDuration)
+        with self._lock:
+            self._grids[key] = grid
+            self._evict(self._grids)
+        return grid
+
+    def getStyle(self, order, numSteps, loopDuration, wait=True):
+        """
+        Returns the style of a configuration, training it if needed.
+
+        Parameters
+        ----------
+        order, numSteps, loopDuration:
+            configuration of the style (see MarkovStyle).
+        wait: bool
+            if False, a style which is not trained yet is requested (see
+            requestStyle) and None is returned instead of waiting for it.
+
+        """
+        config = (order, numSteps, loopDuration)
+        with self._lock:
+            style = self._touch(self._styles, config)
+            if style is not None:
+                return style
+            pending = self._pending.get(config)
+            generation = self._generation
+        if not wait:
+            self.requestStyle(order, numSteps, loopDuration)
+            return None
+        if pending is not None:
+            pending[1].wait()
+            with self._lock:
+                style = self._styles.get(config)
+            if style is not None:
+                return style
+        return self._train(config, generation)
+
+    def requestStyle(self, order, numSteps, loopDuration):
+        """
+        Schedules the training of a style in a background thread and returns
+        immediately. Does nothing if the style is trained or requested.
+
+        """
+        config = (order, numSteps, loopDuration)
+        with self._lock:
+            if config in self._styles or config in self._pending:
+                return
+            self._pending[config] = (self._generation, threading.Event())
+            self._requests.append((config, self._generation))
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._processRequests, name="StyleManager")
+                self._worker.daemon = True
+                self._worker.start()
+
+    def waitForStyles(self):
+        """
+        Waits until all requested styles are trained.
+
+        """
+        with self._lock:
+            events = [event for generation, event in self._pending.values()]
+        for event in events:
+            event.wait()
+
+    def _processRequests(self):
+        while True:
+            with self._lock:
+                if not self._requests:
+                    self._worker = None
+                    return
+                config, generation = self._requests.popleft()
+            try:
+                self._train(config, generation)
+            except Exception:
+                markovLog.exception("StyleManager: training %s failed" % (config,))
+            finally:
+                with self._lock:
+                    pending = self._pending.get(config)
+                    if pending is not None and pending[0] == generation:
+                        del self._pending[config]
+                        pending[1].set()
+
+    def _train(self, config, generation):
+        order, numSteps, loopDuration = config
+        grid, tags = self.getGrid(numSteps, loopDuration)
+        style = MarkovStyle(order=order, numSteps=numSteps, loopDuration=loopDuration, rng=self._getStyleRng(config),
+                            **self.styleArgs)
+        style.markovChain.originPatterns = list(self.getSlices(loopDuration))
+        style.markovChain.addGrid(grid, tags)
+        with self._lock:
+            # the corpus may have changed meanwhile
+            if generation == self._generation:
+                self._styles[config] = style
+                self._evict(self._styles)
+        return style
+
+    def _getStyleRng(self, config):
+        """
+        Random generator of the style of a configuration, derived from the
+        manager's seed and the configuration (nothing is stored per
+        configuration, and a retrained style gets the same stream).
+
+        """
+        return gsutil.makeRandomGenerator(repr((self._rootSeed,) + tuple(float(c) for c in config)))
 
+    def _touch(self, cache, key):
+        """
+        Returns a cached value (None if missing), marking it as the most
+        recently used.
 
+        """
+        value = cache.pop(key, None)
+        if value is not None:
+            cache[key] = value
+        return value
+
+    def _evict(self, cache):
+        while len(cache) > self.maxNumStyles:
+            cache.popitem(last=False)
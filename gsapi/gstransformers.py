@@ -1,6 +1,6 @@
 from __future__ import absolute_import, division, print_function
 
-import random
+from . import gsutil
 from .gsdescriptors import Density
 from .gspattern import Event
 
@@ -67,10 +67,12 @@ class AgnosticDensity(BaseTransformer):
         Densities should be in the same range as globalDensity
     originPattern: pattern
         the origin pattern (e.g: the one given if all densities are equals to 1).
+    rng: numpy.random.Generator or seed
+        random generator owned by this transformer (see gsutil.makeRandomGenerator).
 
     """
 
-    def __init__(self, mode='random', numSteps=32):
+    def __init__(self, mode='random', numSteps=32, rng=None):
         self.globalDensity = 1
         self.normalizedDensities = {}
         self.targetDensities = {}
@@ -84,6 +86,7 @@ class AgnosticDensity(BaseTransformer):
         self.currentDistribution = {}
         self.currentState = {}
         self.originDistribution = {}
+        self.rng = gsutil.makeRandomGenerator(rng)
 
     def configure(self, paramDict):
         if 'inputPattern' in paramDict:
@@ -153,7 +156,7 @@ class AgnosticDensity(BaseTransformer):
 
         idx = 0
         if self.mode == 'hysteresis':
-            idx = random.randint(0, len(availableIdx) - 1)
+            idx = int(self.rng.integers(len(availableIdx)))
 
         idxToAdd = availableIdx[idx]
 
@@ -179,7 +182,7 @@ class AgnosticDensity(BaseTransformer):
 
         idx = 0
         if self.mode == 'hysteresis':
-            idx = random.randint(0, len(availableIdx) - 1)
+            idx = int(self.rng.integers(len(availableIdx)))
 
         idxToRemove = availableIdx[idx]
 
@@ -203,7 +206,7 @@ class AgnosticDensity(BaseTransformer):
     def __shuffleList(self, l):
         for iteration in range(len(l)):
             idx1 = iteration
-            idx2 = random.randint(0, len(l) - 1)
+            idx2 = int(self.rng.integers(len(l)))
             t = l[idx1]
             l[idx1] = l[idx2]
             l[idx2] = t
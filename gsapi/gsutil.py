@@ -3,6 +3,13 @@
 
 from __future__ import absolute_import, division, print_function
 
+import binascii
+import numbers
+import random
+import struct
+
+import numpy as np
+
 from . import gsdefs
 
 
@@ -245,3 +252,81 @@ def pc2base40(pitch_class, alt="#"):
     else:
         raise Exception("alt should be either '#' or 'b'")
     return base40[pitch_class % 12]
+
+
+# tags appended to the entropy of seeds numpy does not accept, so that
+# they can't give the stream of another seed
+_negativeSeedTag, _floatSeedTag, _bytesSeedTag = 1, 2, 3
+
+
+def _bytesToInt(data):
+    return int(binascii.hexlify(data) or b'0', 16)
+
+
+def makeRandomGenerator(seed=None):
+    """
+    Returns a numpy random Generator owned by the caller.
+
+    Parameters
+    ----------
+    seed: None, number, str, numpy.random.SeedSequence, numpy.random.Generator or random.Random
+        a Generator is returned as is, a random.Random is used to seed a new
+        Generator, other values are passed to numpy.random.default_rng
+        (None gives a Generator seeded from OS entropy). Negative integers,
+        floats and strings, that numpy does not accept, are encoded from
+        their value (not their hash) so that distinct seeds give distinct
+        streams on any interpreter.
+
+    """
+    if isinstance(seed, random.Random):
+        seed = seed.getrandbits(128)
+    elif isinstance(seed, numbers.Integral):
+        seed = int(seed) if seed >= 0 else [-int(seed), _negativeSeedTag]
+    elif isinstance(seed, numbers.Real):
+        seed = [_bytesToInt(struct.pack('<d', float(seed))), _floatSeedTag]
+    elif isinstance(seed, (bytes, type(u''))):
+        data = seed if isinstance(seed, bytes) else seed.encode('utf-8')
+        seed = [_bytesToInt(data), len(data), _bytesSeedTag]
+    return np.random.default_rng(seed)
+
+
+def spawnRandomGenerators(rng, num):
+    """
+    Returns num independent child Generators of a Generator, e.g. to give
+    one reproducible stream to each parallel worker.
+
+    Parameters
+    ----------
+    rng: numpy.random.Generator
+        the parent generator (or a seed, see makeRandomGenerator).
+    num: int
+        number of child generators.
+
+    """
+    rng = makeRandomGenerator(rng)
+    if hasattr(rng, 'spawn'):
+        return rng.spawn(num)
+    # numpy < 1.25
+    return [np.random.default_rng(s) for s in rng.bit_generator._seed_seq.spawn(num)]
+
+
+def compactArray(values):
+    """
+    Converts a list of numbers (or of tuples of numbers) to the smallest
+    numpy array holding them without loss, None if they are not numbers.
+
+    """
+    array = np.array(values)
+    if array.size == 0:
+        return array.astype(np.int8)
+    if array.dtype.kind in 'iu':
+        for dtype in (np.int8, np.uint8, np.int16, np.uint16, np.int32):
+            info = np.iinfo(dtype)
+            if info.min <= array.min() and array.max() <= info.max:
+                return array.astype(dtype)
+        return array.astype(np.int64)
+    elif array.dtype.kind == 'f':
+        array = array.astype(np.float64)
+        compact = array.astype(np.float32)
+        return compact if np.array_equal(compact, array) else array
+    return None
@@ -24,6 +24,40 @@ class AgnosticDensityTest(GSTestBase):
                 newP = agnosticDensity.transformPattern(shortPattern, {'normalizedDensities': randomDensity})
                 self.checkPatternValid(newP)
 
+    def test_AgnosticDensity_seeded(self):
+        patterns = generateSyntheticPatterns(numPatterns=4)
+        densities = {'normalizedDensities': {"Kick": 1.5, "Snare": 0.5, "ClosedHH": 1.2}}
+        results = []
+        for i in range(2):
+            agnosticDensity = gstransformers.AgnosticDensity(numSteps=16, rng=12)
+            # draws from the global generator must not alter the transformer's stream
+            random.seed(i)
+            results += [[agnosticDensity.transformPattern(p, densities) for p in patterns]]
+        for p, other in zip(*results):
+            self.checkPatternEquals(p, other)
+        # spawned streams are reproducible but independent from each other
+        streams = gsutil.spawnRandomGenerators(gsutil.makeRandomGenerator(3), 2)
+        sameStreams = gsutil.spawnRandomGenerators(gsutil.makeRandomGenerator(3), 2)
+        self.assertEqual(streams[0].integers(1 << 30), sameStreams[0].integers(1 << 30))
+        self.assertNotEqual(streams[0].integers(1 << 30, size=4).tolist(),
+                            streams[1].integers(1 << 30, size=4).tolist())
+        # seeds numpy does not accept are encoded, not hashed: distinct seeds give distinct streams
+        seeds = [0, 1, -1, -2, 1.5, -1.5, "a", "a\0"]
+        draws = [gsutil.makeRandomGenerator(seed).integers(1 << 62) for seed in seeds]
+        self.assertEqual(len(set(draws)), len(seeds))
+        self.assertEqual(draws, [gsutil.makeRandomGenerator(seed).integers(1 << 62) for seed in seeds])
+        self.assertEqual(gsutil.makeRandomGenerator(b"a").integers(1 << 62), draws[-2])
+        # bassmine generation draws from the model's own stream when not given a generator
+        basslines = []
+        for i in range(2):
+            model = bassmine.MarkovModel(16, rng=4)
+            model.add_temporal([8, 3, 5, 3, 7, 8, 8, 5, 7, 3])
+            random.seed(i)
+            np.random.seed(i)
+            basslines += [[bassmine.generateBassRhythm(model, beat_length=8) for j in range(3)]]
+        for p, other in zip(*basslines):
+            self.checkPatternEquals(p, other)
+
 
 if __name__ == '__main__':
     runTest(profile=True, getStat=False)
@@ -40,6 +40,108 @@ class GsioTest(GSTestBase):
             jsonPattern = gsio.fromJSONFile(filePath=os.path.abspath(exportedPath), conserveTuple=True)
             self.checkPatternEquals(p, jsonPattern, checkViewpoints=True)
 
+    def test_ImportExportJSONLines(self):
+        import json
+        patterns = generateSyntheticPatterns(numPatterns=16)
+        exportedPath = os.path.abspath("../output/synthetic.jsonl")
+        numWritten = gsio.toJSONLinesFile(iter(patterns), exportedPath)
+        self.assertEqual(numWritten, len(patterns))
+        with open(exportedPath) as f:
+            # tags are stored inline by default
+            self.assertTrue(all("tag" in e for e in json.loads(f.readline())["eventList"]))
+        imported = gsio.fromJSONLinesFile(exportedPath)
+        self.assertFalse(isinstance(imported, list))
+        # the readers handle the no-op conserveTuple flag the same way
+        with self.assertWarns(DeprecationWarning):
+            gsio.fromJSONLinesFile(exportedPath, conserveTuple=True)
+        with self.assertWarns(DeprecationWarning):
+            gsio.fromJSONFile(gsio.toJSONFile(patterns[0], "../output/"), conserveTuple=True)
+        imported = list(imported)
+        self.assertEqual(len(imported), len(patterns))
+        for p, jsonPattern in zip(patterns, imported):
+            self.assertEqual(p.name, jsonPattern.name)
+            self.checkPatternEquals(p, jsonPattern)
+
+    def test_ImportExportJSONTupleTags(self):
+        patterns = generateSyntheticPatterns(numPatterns=4)
+        for p in patterns:
+            for e in p.events:
+                e.tag = (e.tag, ("C", "maj")) if e.pitch % 2 else (e.tag,)
+            p.name += "_tuples"
+        for useTagIndexing in [True, False]:
+            for conserveTuple in [True, False]:
+                for p in patterns:
+                    exportedPath = gsio.toJSONFile(p, folderPath="../output/", useTagIndexing=useTagIndexing,
+                                                   conserveTuple=conserveTuple)
+                    jsonPattern = gsio.fromJSONFile(filePath=exportedPath)
+                    self.checkPatternEquals(p, jsonPattern)
+                    for e in jsonPattern.events:
+                        self.assertTrue(isinstance(e.tag, tuple))
+
+    def test_ImportLegacyJSONTuples(self):
+        # written by the former recursive tuple encoder
+        hintedDict = {"name": "hinted",
+                      "timeInfo": {"duration": 4, "bpm": 120, "timeSignature": {"__tuple__": True, "items": [4, 4]}},
+                      "eventList": [{"on": 0, "duration": 1, "pitch": 60, "velocity": 100,
+                                     "tag": {"__tuple__": True, "items": ["C", "maj"]}}],
+                      "viewpoints": {}}
+        p = gspattern.Pattern().fromJSONDict(hintedDict)
+        self.assertEqual(p.timeSignature, (4, 4))
+        self.assertEqual(p.events[0].tag, ("C", "maj"))
+        # one index per element of a tuple tag
+        indexedDict = {"name": "indexed",
+                       "timeInfo": {"duration": 4, "bpm": 120, "timeSignature": [4, 4]},
+                       "eventTags": ["Kick", "Snare"],
+                       "eventList": [{"on": 0, "duration": 1, "pitch": 36, "velocity": 100, "tagsIdx": [0, 1]}],
+                       "viewpoints": {}}
+        p = gspattern.Pattern().fromJSONDict(indexedDict)
+        self.assertEqual(p.events[0].tag, ("Kick", "Snare"))
+
+    def test_ImportExportCompressed(self):
+        patterns = generateSyntheticPatterns(numPatterns=4)
+        for compression in ['gzip', 'bz2', 'lzma']:
+            for p in patterns:
+                exportedPath = gsio.toJSONFile(p, folderPath="../output/", nameSuffix="_compressed",
+                                               compression=compression)
+                self.assertTrue(exportedPath.endswith(gsio.compressionExtensions[compression]))
+                self.checkPatternEquals(p, gsio.fromJSONFile(filePath=exportedPath))
+                exportedPath = gsio.toPickleFile(p, folderPath="../output/", nameSuffix="_compressed",
+                                                 compression=compression)
+                self.checkPatternEquals(p, gsio.fromPickleFile(filePath=exportedPath))
+            # compression inferred from the extension
+            exportedPath = "../output/synthetic.jsonl" + gsio.compressionExtensions[compression]
+            self.assertEqual(gsio.toJSONLinesFile(patterns, exportedPath), len(patterns))
+            for p, jsonPattern in zip(patterns, gsio.fromJSONLinesFile(exportedPath)):
+                self.checkPatternEquals(p, jsonPattern)
+            # binary files
+            state = {'name': compression, 'counts': np.arange(100, dtype=np.uint16).reshape(10, 10)}
+            exportedPath = gsio.toBinaryFile(state, "../output/state.bin", compression=compression)
+            with open(exportedPath, 'rb') as f:
+                self.assertFalse(f.read(len(gsio._binaryMagic)) == gsio._binaryMagic)
+            loaded = gsio.fromBinaryFile(exportedPath)
+            self.assertEqual(loaded['name'], compression)
+            self.assertTrue((loaded['counts'] == state['counts']).all())
+            with self.assertRaises(ValueError):
+                gsio.fromBinaryFile(exportedPath, mmap=True)
+
+    def test_ImportCompressedStream(self):
+        import io
+        import json
+        patterns = generateSyntheticPatterns(numPatterns=4)
+        stream = io.BytesIO()
+        gsio.toJSONLinesFile(patterns, stream, compression='gzip')
+        self.assertFalse(stream.closed)
+        # codec sniffed from the magic number
+        stream = io.BufferedReader(io.BytesIO(stream.getvalue()))
+        imported = list(gsio.fromJSONLinesFile(stream))
+        self.assertEqual(len(imported), len(patterns))
+        for p, jsonPattern in zip(patterns, imported):
+            self.checkPatternEquals(p, jsonPattern)
+        # given file objects are left open
+        stream = io.StringIO(json.dumps(patterns[0].toJSONDict()))
+        self.checkPatternEquals(patterns[0], gsio.fromJSONFile(stream))
+        self.assertFalse(stream.closed)
+
     def test_ImportExportPickle(self):
         for p in self.cachedDataset:
             for name,descriptorClass in getAllDescriptorsClasses():
@@ -49,5 +151,66 @@ class GsioTest(GSTestBase):
             picklePattern = gsio.fromPickleFile(filePath=os.path.abspath(exportedPath))
             self.checkPatternEquals(p, picklePattern, checkViewpoints=True)
 
+    def test_PickleLeanState(self):
+        import pickle
+        patterns = generateSyntheticPatterns(numPatterns=4, duration=16)
+        for p in patterns:
+            p.generateViewpoint("density", gsdescriptors.Density(), sliceType=4)
+            p.generateViewpoint("perEvent", gsdescriptors.Density(), sliceType="perEvent")
+        loadedPatterns = [pickle.loads(pickle.dumps(patterns, protocol=pickle.HIGHEST_PROTOCOL))]
+        if pickle.HIGHEST_PROTOCOL >= 5:
+            # packed events can be sent out-of-band
+            buffers = []
+            data = pickle.dumps(patterns, protocol=5, buffer_callback=buffers.append)
+            self.assertTrue(len(buffers) > 0)
+            loadedPatterns += [pickle.loads(data, buffers=buffers)]
+
+        for loaded in loadedPatterns:
+            for p, pickled in zip(patterns, loaded):
+                self.checkPatternEquals(p, pickled, checkViewpoints=True)
+                for name, viewpoint in pickled.viewpoints.items():
+                    self.assertTrue(viewpoint.originPattern is pickled)
+                    for e, pickledEvent in zip(p.viewpoints[name].events, viewpoint.events):
+                        self.checkPatternEquals(e.originPattern, pickledEvent.originPattern)
+                # per event slices still share the events of their origin pattern
+                for e in pickled.viewpoints["perEvent"].events:
+                    for subEvent in e.originPattern.events:
+                        self.assertTrue(any(subEvent is originEvent for originEvent in pickled.events))
+
+        # integer times mixed with float ones keep their type
+        mixed = gspattern.Pattern(duration=16, events=[gspattern.Event(i if i % 2 else i * 0.5, 1 if i % 3 else 0.25,
+                                                                       36, 100, "Kick") for i in range(10)])
+        pickled = pickle.loads(pickle.dumps(mixed))
+        self.assertEqual([(type(e.startTime), type(e.duration)) for e in pickled.events],
+                         [(type(e.startTime), type(e.duration)) for e in mixed.events])
+        self.assertEqual(pickled.toJSONDict(), mixed.toJSONDict())
+
+        # origin patterns linked to the pickled pattern's origin are packed too
+        p = patterns[0]
+        for e in p.viewpoints["density"].events:
+            e.originPattern.originPattern = p
+        self.assertTrue('headers' in p.viewpoints["density"].__getstate__()['packedOrigins'])
+        pickled = pickle.loads(pickle.dumps(p))
+        for e in pickled.viewpoints["density"].events:
+            self.assertTrue(e.originPattern.originPattern is pickled)
+
+    def test_DeepcopySharedEvents(self):
+        import copy
+        p = generateSyntheticPatterns(numPatterns=1, duration=16)[0]
+        p.events += [p.events[0]]
+        p.generateViewpoint("perEvent", gsdescriptors.Density(), sliceType="perEvent")
+        copied = copy.deepcopy(p)
+        # same aliasing of events as in the original, with new events
+        self.assertEqual([[a is b for b in copied.events] for a in copied.events],
+                         [[a is b for b in p.events] for a in p.events])
+        self.assertEqual(len(set(id(e) for e in copied.events)), len(p.events) - 1)
+        self.assertFalse(any(e is originEvent for e in copied.events for originEvent in p.events))
+        self.checkPatternEquals(p, copied, checkViewpoints=True)
+        for e in copied.viewpoints["perEvent"].events:
+            for subEvent in e.originPattern.events:
+                self.assertTrue(any(subEvent is originEvent for originEvent in copied.events))
+        self.assertTrue(copy.copy(p).events is p.events)
+
+
 if __name__ == '__main__':
     runTest(profile=False, getStat=False)
@@ -51,6 +51,466 @@ class MarkovPatternTest(GSTestBase):
         # self.markovChain.plotMatrixAtStep(2)
         # self.markovChain.plotGlobalMatrix()
 
+    def testMarkovTableSynthetic(self):
+        import json
+        self.patternList = generateSyntheticPatterns(numPatterns=16)
+        self.markovChain = gsstyles.PatternMarkov(order=2, numSteps=16, loopDuration=4)
+        self.markovChain.generateTransitionTableFromPatternList(self.patternList)
+        self.assertTrue(self.markovChain.isBuilt())
+        for step in range(self.markovChain.numSteps):
+            matrix, statesIn, statesOut = self.markovChain.getMatrixAtStep(step)
+            self.assertEqual(matrix.shape, (len(statesIn), len(statesOut)))
+            for row in matrix:
+                self.assertAlmostEqual(sum(row), 1)
+        # probabilities are the transition frequencies (brute force count, contexts wrap around the loop)
+        counts = [{} for step in range(16)]
+        for p in self.patternList:
+            states = [tuple(sorted(set(e.tag for e in p.getStartingEventsAtTime(step * 0.25)))) or ('silence',)
+                      for step in range(16)]
+            for step in range(16):
+                context = (states[step - 2], states[step - 1])
+                nextCounts = counts[step].setdefault(context, {})
+                nextCounts[states[step]] = nextCounts.get(states[step], 0) + 1
+        for step in range(16):
+            self.assertEqual(sorted(self.markovChain.transitionTable[step].keys()), sorted(counts[step].keys()))
+            for context, nextCounts in counts[step].items():
+                probabilities = self.markovChain.transitionTable[step][context]
+                self.assertEqual(sorted(probabilities.keys()), sorted(nextCounts.keys()))
+                for state, count in nextCounts.items():
+                    self.assertAlmostEqual(probabilities[state], count / sum(nextCounts.values()))
+        # matrices hold the probabilities of the table at the positions of their state labels
+        for step in range(self.markovChain.numSteps):
+            matrix, statesIn, statesOut = self.markovChain.getMatrixAtStep(step)
+            expected = np.zeros(matrix.shape)
+            for context, probabilities in self.markovChain.transitionTable[step].items():
+                for state, probability in probabilities.items():
+                    expected[statesIn.index(context), statesOut.index(state)] = probability
+            self.assertTrue(np.allclose(matrix, expected))
+        # states and contexts are interned once, rows are sorted (step, context) pairs in CSR arrays
+        table = self.markovChain.table
+        self.assertEqual(len(set(table.states)), len(table.states))
+        self.assertEqual(len(set(table.contexts)), len(table.contexts))
+        rowKeys = list(zip(table.rowSteps.tolist(), table.rowContexts.tolist()))
+        self.assertEqual(rowKeys, sorted(set(rowKeys)))
+        self.assertEqual((table.rowPtr[0], table.rowPtr[-1]), (0, len(table.nextStates)))
+        self.assertTrue((np.diff(table.rowPtr) > 0).all())
+        self.assertEqual(table.counts.sum(), len(self.patternList) * 16)
+        # the same tag set is one state whatever the order of its events
+        swapped = gspattern.Pattern(duration=4, name="swapped", events=[e.copy() for e in self.patternList[0].events])
+        swapped.events.sort(key=lambda e: (e.startTime, -e.pitch))
+        markovChain = gsstyles.PatternMarkov(order=2, numSteps=16, loopDuration=4)
+        markovChain.generateTransitionTableFromPatternList([self.patternList[0], swapped])
+        doubled = gsstyles.PatternMarkov(order=2, numSteps=16, loopDuration=4)
+        doubled.generateTransitionTableFromPatternList(self.patternList[:1] * 2)
+        self.assertEqual(markovChain.table.states, doubled.table.states)
+        self.assertTrue((markovChain.table.counts == doubled.table.counts).all())
+
+        # internal state is JSON serializable
+        state = json.loads(json.dumps(self.markovChain.getInternalState()))
+        loaded = gsstyles.PatternMarkov()
+        loaded.setInternalState(state)
+        self.assertEqual(loaded.transitionTable, self.markovChain.transitionTable)
+        # legacy states holding a transitionTable are converted
+        legacy = {"order": 2, "numSteps": 16, "loopDuration": 4,
+                  "transitionTable": [{tuple(context): dict(probabilities) for context, probabilities in d.items()}
+                                      for d in self.markovChain.transitionTable]}
+        loaded = gsstyles.PatternMarkov()
+        loaded.setInternalState(legacy)
+        for step, d in enumerate(loaded.transitionTable):
+            for context, probabilities in d.items():
+                for state, probability in probabilities.items():
+                    self.assertAlmostEqual(probability, self.markovChain.transitionTable[step][context][state])
+        self.__testMarkov(10)
+
+    def testBinarizePatterns(self):
+        p = gspattern.Pattern(duration=4, name="binarized")
+        p.events = [gspattern.Event(0, 1, 36, 100, "Kick"), gspattern.Event(0.1, 1, 38, 100, "Snare"),
+                    gspattern.Event(1.9, 1, 36, 100, "Kick")]
+        events = [e.copy() for e in p.events]
+        grid, tags = gsstyles.binarizePatterns([p], numSteps=4, loopDuration=4)
+        self.assertEqual(grid.shape, (1, 4, len(tags)))
+        activeTags = [sorted([tags[t] for t in range(len(tags)) if grid[0, step, t]]) for step in range(4)]
+        self.assertEqual(activeTags, [["Kick", "Snare"], ["silence"], ["Kick"], ["silence"]])
+        # patterns are left untouched
+        self.assertEqual(p.events, events)
+
+    def testMarkovSampler(self):
+        markovChain = gsstyles.PatternMarkov(order=1, numSteps=16, loopDuration=4)
+        markovChain.generateTransitionTableFromPatternList(generateSyntheticPatterns(numPatterns=16))
+        table = markovChain.table
+        sampler = table.getSampler()
+        for row in range(len(table)):
+            start, end = table.rowPtr[row], table.rowPtr[row + 1]
+            self.assertEqual(sampler.sample(row, 0), table.nextStates[start])
+            self.assertEqual(sampler.sample(row, 1 - 1e-12), table.nextStates[end - 1])
+            # a uniform sweep of r gives back the row probabilities
+            sweep = [sampler.sample(row, (i + 0.5) / 1000) for i in range(1000)]
+            for i in range(start, end):
+                self.assertAlmostEqual(sweep.count(table.nextStates[i]) / 1000, table.probabilities[i], places=2)
+        self.assertEqual(markovChain.generatePattern(seed=3), markovChain.generatePattern(seed=3))
+
+    def testGeneratePatterns(self):
+        markovChain = gsstyles.PatternMarkov(order=2, numSteps=16, loopDuration=4)
+        markovChain.generateTransitionTableFromPatternList(generateSyntheticPatterns(numPatterns=16))
+        table = markovChain.table
+        sampler = table.getSampler()
+        stateIds = markovChain.generatePatterns(200, seed=1, asArray=True)
+        self.assertEqual(stateIds.shape, (200, 16))
+        self.assertTrue((stateIds == markovChain.generatePatterns(200, seed=1, asArray=True)).all())
+        for chain in stateIds.tolist():
+            for step in range(2, 16):
+                row = sampler.findRow(step, table.contextIds.get(tuple(chain[step - 2:step])))
+                self.assertTrue(row >= 0)
+                self.assertTrue(chain[step] in table.nextStates[table.rowPtr[row]:table.rowPtr[row + 1]])
+        patterns = markovChain.generatePatterns(10, seed=2)
+        self.assertEqual(len(patterns), 10)
+        for pattern in patterns:
+            self.checkPatternValid(pattern)
+            self.assertEqual(pattern.duration, markovChain.loopDuration)
+
+    def testStartContexts(self):
+        patterns = generateSyntheticPatterns(numPatterns=6)
+        # sparse high order tables always find a start hypothesis
+        markovChain = gsstyles.PatternMarkov(order=5, numSteps=16, loopDuration=4)
+        markovChain.generateTransitionTableFromPatternList(patterns)
+        for i in range(50):
+            self.checkPatternValid(markovChain.generatePattern(), checkOverlap=False)
+        # start contexts are drawn according to their frequency
+        markovChain = gsstyles.PatternMarkov(order=1, numSteps=16, loopDuration=4)
+        markovChain.generateTransitionTableFromPatternList(patterns + patterns[:1] * 3)
+        table = markovChain.table
+        sampler = table.getSampler()
+        start, end = table.getRowsAtStep(1)
+        totals = table.getRowTotals()[start:end]
+        sweep = [sampler.sampleStart((i + 0.5) / 1000) for i in range(1000)]
+        for row in range(start, end):
+            self.assertAlmostEqual(sweep.count(row) / 1000, totals[row - start] / totals.sum(), places=2)
+
+    def testBackoff(self):
+        import json
+        patterns = generateSyntheticPatterns(numPatterns=12)
+        markovChain = gsstyles.PatternMarkov(order=6, numSteps=16, loopDuration=4, backoff=True, minContextCount=2)
+        markovChain.generateTransitionTableFromPatternList(patterns)
+        self.assertEqual([table.getOrder() for table in markovChain.backoffTables], list(range(6)))
+        for table in markovChain.backoffTables:
+            self.assertTrue(table.states is markovChain.table.states)
+        # rare contexts are backed off to the longest one seen at least minContextCount times
+        self.assertTrue((markovChain.table.getRowTotals() < 2).any())
+        stateIds = markovChain.generatePatterns(100, seed=1, asArray=True)
+        self.assertEqual(stateIds.shape, (100, 16))
+        tables = markovChain.backoffTables + [markovChain.table]
+
+        def _nextStates(table, step, context, minCount):
+            row = table.getSampler().findRow(step, table.contextIds.get(tuple(context), -1))
+            if row < 0 or table.getRowTotals()[row] < minCount:
+                return None
+            return table.nextStates[table.rowPtr[row]:table.rowPtr[row + 1]].tolist()
+
+        numUnseen = 0
+        for chain in stateIds.tolist():
+            for step in range(6, 16):
+                for k in reversed(range(7)):
+                    nextStates = _nextStates(tables[k], step, chain[step - k:step], 2 if k else 0)
+                    if nextStates is not None:
+                        break
+                self.assertTrue(chain[step] in nextStates)
+                # transitions never seen after the full context come from the backed off ones
+                fullNextStates = _nextStates(markovChain.table, step, chain[step - 6:step], 0)
+                numUnseen += fullNextStates is not None and chain[step] not in fullNextStates
+        self.assertTrue(numUnseen > 0)
+        for i in range(10):
+            self.checkPatternValid(markovChain.generatePattern(), checkOverlap=False)
+
+        loaded = gsstyles.PatternMarkov()
+        loaded.setInternalState(json.loads(json.dumps(markovChain.getInternalState())))
+        self.assertTrue((loaded.generatePatterns(100, seed=1, asArray=True) == stateIds).all())
+        merged = gsstyles.PatternMarkov(order=6, numSteps=16, loopDuration=4, backoff=True, minContextCount=2)
+        for i in range(2):
+            shard = gsstyles.PatternMarkov(order=6, numSteps=16, loopDuration=4, backoff=True)
+            shard.generateTransitionTableFromPatternList(patterns[i::2])
+            merged.merge(shard)
+        for table, mergedTable in zip(markovChain.backoffTables, merged.backoffTables):
+            self.assertEqual(sorted(table.getRowTotals().tolist()), sorted(mergedTable.getRowTotals().tolist()))
+
+    def testCompact(self):
+        patterns = generateSyntheticPatterns(numPatterns=40)
+        markovChain = gsstyles.PatternMarkov(order=2, numSteps=16, loopDuration=4, backoff=True)
+        markovChain.generateTransitionTableFromPatternList(patterns)
+        table = markovChain.table
+        probabilities = table.probabilities.copy()
+        numRows = len(table)
+        report = markovChain.compact(quantize=True)
+        self.assertEqual(report['numTransitions'][0], report['numTransitions'][1])
+        self.assertTrue(np.abs(table.probabilities - probabilities).max() < 1e-4)
+        self.assertEqual(table.toArrayDict()['counts'].dtype, np.uint16)
+
+        transitionTable = markovChain.transitionTable
+        report = markovChain.compact(minProbability=0.3)
+        self.assertTrue(report['numTransitions'][1] < report['numTransitions'][0])
+        self.assertTrue(report['numBytes'][1] < report['numBytes'][0])
+        # rows are kept and renormalized over their probable transitions, or their most probable one
+        self.assertEqual(len(table), numRows)
+        self.assertTrue(np.allclose(np.add.reduceat(table.probabilities, table.rowPtr[:-1]), 1))
+        for step, contexts in enumerate(markovChain.transitionTable):
+            self.assertEqual(sorted(contexts.keys()), sorted(transitionTable[step].keys()))
+            for context, probabilities in contexts.items():
+                before = transitionTable[step][context]
+                kept = [s for s, prob in before.items() if prob >= 0.3]
+                if not kept:
+                    # one of the most probable transitions when all are rare
+                    kept = list(probabilities.keys())
+                    self.assertEqual(len(kept), 1)
+                    self.assertAlmostEqual(before[kept[0]], max(before.values()))
+                self.assertEqual(sorted(probabilities.keys()), sorted(kept))
+                for state in kept:
+                    self.assertAlmostEqual(probabilities[state], before[state] / sum(before[s] for s in kept), places=4)
+        self.assertEqual(markovChain.generatePatterns(50, seed=0, asArray=True).shape, (50, 16))
+
+    def testTrainConfigurations(self):
+        patterns = generateSyntheticPatterns(numPatterns=10, duration=8)
+        chains = gsstyles.trainConfigurations(patterns, orders=[0, 2], numSteps=[8, 16], loopDurations=[2, 4],
+                                              backoff=True)
+        self.assertEqual(len(chains), 8)
+        for (order, numSteps, loopDuration), markovChain in chains.items():
+            slices = []
+            for p in patterns:
+                slices += p.splitInEqualLengthPatterns(loopDuration)
+            reference = gsstyles.PatternMarkov(order=order, numSteps=numSteps, loopDuration=loopDuration, backoff=True)
+            reference.generateTransitionTableFromPatternList(slices)
+            self.assertEqual(markovChain.transitionTable, reference.transitionTable)
+            for table, referenceTable in zip(markovChain.backoffTables, reference.backoffTables):
+                self.assertEqual(table.toJSONDict(), referenceTable.toJSONDict())
+        # pooled grids match direct binarization for on-grid events
+        grid, tags = gsstyles.binarizePatterns(patterns, 32, 8)
+        pooled = gsstyles.poolGrid(grid, tags, 4)
+        self.assertTrue((pooled == gsstyles.binarizePatterns(patterns, 8, 8, tags=list(tags))[0]).all())
+        # but not for off-grid ones, which are rounded twice: those grids are binarized directly
+        offGrid = gspattern.Pattern(duration=2, name="offGrid",
+                                    events=[gspattern.Event(0.0625, 0.25, 36, 100, "Kick")])
+        grid, tags = gsstyles.binarizePatterns([offGrid], 16, 2)
+        self.assertEqual(np.flatnonzero(gsstyles.poolGrid(grid, tags, 2)[0, :, tags.index("Kick")]).tolist(), [1])
+        self.assertEqual(np.flatnonzero(gsstyles.binarizePatterns([offGrid], 8, 2)[0][0, :, 0]).tolist(), [0])
+        chains = gsstyles.trainConfigurations(patterns + [offGrid], orders=[1], numSteps=[8, 16], loopDurations=[2])
+        for (order, numSteps, loopDuration), markovChain in chains.items():
+            slices = []
+            for p in patterns + [offGrid]:
+                slices += p.splitInEqualLengthPatterns(loopDuration)
+            reference = gsstyles.PatternMarkov(order=order, numSteps=numSteps, loopDuration=loopDuration)
+            reference.generateTransitionTableFromPatternList(slices)
+            self.assertEqual(markovChain.transitionTable, reference.transitionTable)
+
+    def testGenerateGrid(self):
+        markovChain = gsstyles.PatternMarkov(order=2, numSteps=16, loopDuration=4)
+        markovChain.generateTransitionTableFromPatternList(generateSyntheticPatterns(numPatterns=20))
+        tags = markovChain.getGridTags()
+        self.assertEqual(sorted(tags), ["ClosedHH", "Kick", "Snare"])
+
+        def _events(p):
+            return sorted((e.startTime, e.duration, e.pitch, e.velocity, e.tag) for e in p.events)
+
+        grid = markovChain.generateGrid(seed=3)
+        self.assertEqual((grid.shape, grid.dtype), ((16, 3), np.dtype(bool)))
+        self.assertEqual(_events(gsstyles.patternFromGrid(grid, tags, 4)), _events(markovChain.generatePattern(seed=3)))
+        masks = markovChain.generateGrid(seed=3, packed=True)
+        self.assertEqual(masks.dtype, np.uint8)
+        self.assertEqual(_events(gsstyles.patternFromGrid(masks, tags, 4)), _events(markovChain.generatePattern(seed=3)))
+        grids = markovChain.generateGrid(10, seed=1, tags=["Kick", "Snare"], velocity=90)
+        self.assertEqual((grids.shape, grids.dtype), ((10, 16, 2), np.dtype(np.uint8)))
+        for p, stateGrid in zip(markovChain.generatePatterns(10, seed=1), grids):
+            velocityPattern = gsstyles.patternFromGrid(stateGrid, ["Kick", "Snare"], 4)
+            self.assertTrue(all(e.velocity == 90 for e in velocityPattern.events))
+            self.assertEqual(sorted((e.startTime, e.tag) for e in velocityPattern.events),
+                             sorted((e.startTime, e.tag) for e in p.events if e.tag != "ClosedHH"))
+
+    def testConstrainedGeneration(self):
+        markovChain = gsstyles.PatternMarkov(order=2, numSteps=8, loopDuration=2)
+        markovChain.generateTransitionTableFromPatternList(generateSyntheticPatterns(numPatterns=40, duration=2))
+        mask = markovChain.getConstraintMask(requiredTags={0: ["Kick"], 4: ["Kick"]}, forbiddenTags={2: ["Snare"]})
+        constrained = markovChain.generateConstrainedPatterns(20000, mask, seed=1, asArray=True)
+        self.assertTrue(mask[np.arange(8)[None, :], constrained].all())
+        self.assertTrue(markovChain.compileConstraints(mask) is markovChain.compileConstraints(mask.copy()))
+        # same distribution as rejecting unconstrained chains
+        generated = markovChain.generatePatterns(100000, seed=2, asArray=True)
+        accepted = generated[mask[np.arange(8)[None, :], generated].all(axis=1)]
+        for step in range(8):
+            for stateId in range(len(markovChain.table.states)):
+                self.assertAlmostEqual((constrained[:, step] == stateId).mean(), (accepted[:, step] == stateId).mean(),
+                                       places=1)
+        for pattern in markovChain.generateConstrainedPatterns(10, mask, seed=3):
+            self.assertTrue("Kick" in [e.tag for e in pattern.getStartingEventsAtTime(1)])
+        with self.assertRaises(ValueError):
+            markovChain.generateConstrainedPatterns(1, markovChain.getConstraintMask(allowedStates={3: [()]}))
+
+    def testMatrixExport(self):
+        markovChain = gsstyles.PatternMarkov(order=1, numSteps=16, loopDuration=4)
+        markovChain.generateTransitionTableFromPatternList(generateSyntheticPatterns(numPatterns=8))
+        possibleStatesIn, possibleStatesOut, inIndexes, outIndexes = markovChain.getStateIndexMaps()
+        summed = np.zeros((len(possibleStatesIn), len(possibleStatesOut)))
+        for step in range(markovChain.numSteps):
+            matrix, statesIn, statesOut = markovChain.getMatrixAtStep(step)
+            self.assertTrue(markovChain.getMatrixAtStep(step)[0] is matrix)
+            self.assertEqual(statesIn, markovChain.getPossibleInStatesAtStep(step))
+            labelled = markovChain.getMatrixAtStep(step, possibleStatesIn=list(reversed(statesIn)),
+                                                   possibleStatesOut=statesOut)[0]
+            self.assertTrue((labelled[::-1] == matrix).all())
+            markovChain.getMatrixAtStep(step, possibleStatesIn=possibleStatesIn, possibleStatesOut=possibleStatesOut,
+                                        matrix=summed)
+        globalMatrix = markovChain.getGlobalMatrix()[0]
+        self.assertTrue(np.allclose(globalMatrix, summed))
+        self.assertEqual(globalMatrix.sum(), len(markovChain.table))
+        # cache is cleared on retraining
+        markovChain.addPatterns(generateSyntheticPatterns(numPatterns=2, seed=1))
+        self.assertFalse(markovChain.getGlobalMatrix()[0] is globalMatrix)
+        # and when a table is loaded in place of the cached one
+        other = gsstyles.PatternMarkov(order=1, numSteps=16, loopDuration=4)
+        other.generateTransitionTableFromPatternList(generateSyntheticPatterns(numPatterns=8, seed=2))
+        loaded = gsstyles.PatternMarkov(order=1, numSteps=16, loopDuration=4)
+        self.assertEqual(loaded.getGlobalMatrix()[0].size, 0)
+        loaded.table.fromJSONDict(other.table.toJSONDict())
+        self.assertEqual(loaded.transitionTable, other.transitionTable)
+        self.assertTrue(np.allclose(loaded.getGlobalMatrix()[0], other.getGlobalMatrix()[0]))
+        try:
+            import scipy.sparse
+        except ImportError:
+            return
+        sparseMatrix = markovChain.getGlobalMatrix(sparse=True)[0]
+        self.assertTrue(scipy.sparse.issparse(sparseMatrix))
+        self.assertTrue(np.allclose(sparseMatrix.toarray(), markovChain.getGlobalMatrix()[0]))
+
+    def testIncrementalTraining(self):
+        patterns = generateSyntheticPatterns(numPatterns=12)
+        for order in [1, 2]:
+            trained = gsstyles.PatternMarkov(order=order, numSteps=16, loopDuration=4)
+            trained.generateTransitionTableFromPatternList(patterns[:8])
+            incremental = gsstyles.PatternMarkov(order=order, numSteps=16, loopDuration=4)
+            incremental.addPatterns(patterns[:4])
+            incremental.transitionTable
+            incremental.addPatterns(p for p in patterns[4:])
+            # in place update of existing transitions only renormalizes their rows
+            incremental.addPatterns(patterns[:2])
+            incremental.removePatterns(patterns[:2] + patterns[8:])
+            self.assertEqual(len(incremental.originPatterns), 8)
+            self.assertEqual(incremental.transitionTable, trained.transitionTable)
+            # unknown patterns leave the counts untouched
+            with self.assertRaises(ValueError):
+                incremental.removePatterns([patterns[0]] + generateSyntheticPatterns(numPatterns=2))
+            self.assertEqual(len(incremental.originPatterns), 8)
+            self.assertEqual(incremental.transitionTable, trained.transitionTable)
+            incremental.removePatterns(patterns[:8])
+            self.assertFalse(incremental.isBuilt())
+
+    def testMergeAndTrainParallel(self):
+        import pickle
+        import shutil
+        import tempfile
+        patterns = generateSyntheticPatterns(numPatterns=12)
+        trained = gsstyles.PatternMarkov(order=2, numSteps=16, loopDuration=4)
+        trained.generateTransitionTableFromPatternList(patterns)
+        shards = []
+        for i in range(3):
+            shard = gsstyles.PatternMarkov(order=2, numSteps=16, loopDuration=4)
+            shard.generateTransitionTableFromPatternList(patterns[i::3])
+            shards += [shard]
+        merged = shards[0] + shards[1] + shards[2]
+        self.assertEqual(merged.transitionTable, trained.transitionTable)
+        self.assertEqual(len(merged.originPatterns), len(patterns))
+        # operands are left untouched
+        self.assertEqual(len(shards[0].originPatterns), 4)
+        tables = [pickle.loads(pickle.dumps(shard.table)) for shard in shards]
+        self.assertEqual(gsstyles.PatternMarkov(order=2, numSteps=16, loopDuration=4).merge(*tables).transitionTable,
+                         trained.transitionTable)
+        with self.assertRaises(ValueError):
+            merged.merge(gsstyles.PatternMarkov(order=1, numSteps=16, loopDuration=4))
+
+        folder = tempfile.mkdtemp()
+        try:
+            paths = []
+            for i in range(4):
+                paths += [os.path.join(folder, "shard%i.jsonl.gz" % i)]
+                gsio.toJSONLinesFile(patterns[i::4], paths[-1])
+            for workers in [1, 2]:
+                parallel = gsstyles.trainParallel(paths, workers=workers, order=2, numSteps=16, loopDuration=4)
+                self.assertEqual(parallel.transitionTable, trained.transitionTable)
+        finally:
+            shutil.rmtree(folder)
+
+    def testBassmineMergeCounts(self):
+        import json
+        models = []
+        for i in range(2):
+            model = bassmine.MarkovModel(16)
+            model.add_temporal([i, 3, 5, 3, 7])
+            model.add_interlocking([1, 2, 3], [i, 4, 5])
+            models += [model]
+        merged = models[0] + models[1]
+        merged.normalize_model()
+        # counts survive normalization
+        self.assertEqual(merged.support_temporal.sum(), 8)
+        merged.normalize_model()
+        for rowSum in merged.get_temporal().sum(axis=1)[[0, 1, 3, 5, 7]]:
+            self.assertAlmostEqual(rowSum, 1)
+        loaded = bassmine.MarkovModel(16).fromJSONDict(json.loads(json.dumps(merged.toJSONDict())))
+        self.assertTrue((loaded.support_interlocking == models[0].support_interlocking +
+                         models[1].support_interlocking).all())
+
+    def testBassmineRhythmModelCache(self):
+        import json
+        model = bassmine.MarkovModel(16)
+        model.add_temporal([8, 3, 5, 3, 7, 8, 8])
+        hmm = model.rhythm_model()
+        self.assertEqual(sorted(hmm[1].keys()), [3, 5, 7, 8])
+        self.assertEqual(hmm[1][3]['pattern'], [5, 7])
+        self.assertTrue(model.rhythm_model() is hmm)
+        bassline = bassmine.generateBassRhythm(model, beat_length=8, rng=0)
+        self.assertEqual(bassline.duration, 8)
+        self.assertTrue(model.rhythm_model() is hmm)
+        # new counts invalidate the compiled model
+        model.add_temporal([3, 3, 3])
+        self.assertFalse(model.rhythm_model() is hmm)
+        self.assertEqual(model.rhythm_model()[1][3]['pattern'], [3, 5, 7])
+        path = model.export_rhythm_model("../output/")
+        with open(path) as f:
+            self.assertEqual(sorted(json.load(f).keys()), ['3', '5', '7', '8'])
+
+    def testBassmineConstrainedModel(self):
+        import itertools
+        rng = np.random.RandomState(0)
+        model = bassmine.MarkovModel(16)
+        for i in range(12):
+            model.add_temporal(rng.choice([0, 2, 8, 10, 12, 15], size=8))
+            model.add_interlocking(rng.choice([0, 8, 10], size=8), rng.choice([0, 2, 8, 10, 12, 15], size=8))
+        kick = gspattern.Pattern(duration=4, events=[gspattern.Event(t, 0.25, 36, 100, "Kick") for t in [0, 1, 3]])
+        init, steps = bassmine.constrainMM(model, kick)
+        # every value left in the domains belongs to a valid bassline (brute force check)
+        interlocking, temporal = model.support_interlocking > 0, model.support_temporal > 0
+        valid = [s for s in itertools.product(range(16), repeat=4) if model.support_initial[s[0]] > 0 and
+                 all(interlocking[k, x] for k, x in zip([8, 8, 0, 8], s)) and
+                 all(temporal[a, b] for a, b in zip(s, s[1:]))]
+        self.assertEqual(init['initial']['pattern'], sorted(set(s[0] for s in valid)))
+        for i in range(3):
+            self.assertEqual(sorted(steps[i].keys()), sorted(set(s[i] for s in valid)))
+            for key, value in steps[i].items():
+                self.assertEqual(value['pattern'], sorted(set(s[i + 1] for s in valid if s[i] == key)))
+                self.assertAlmostEqual(sum(value['probs']), 1)
+        for seed in range(20):
+            bassline = bassmine.generateBassRhythm(model, 8, kick, rng=seed)
+            self.assertEqual(bassline.duration, 4)
+            ids = bassmine.translate_rhythm(bassmine.binaryBeatPattern([e.startTime for e in bassline.events], 4))
+            self.assertTrue(tuple(ids) in valid)
+
+        base = bassmine.generateBassRhythm(model, 8, rng=1)
+        baseIds = bassmine.translate_rhythm(bassmine.binaryBeatPattern([e.startTime for e in base.events], 8))
+        variation = bassmine.generateBassRhythmVariation(model, base, [1, -1, -1, 1, 1, -1, 1, 1, 1], rng=2)
+        ids = bassmine.translate_rhythm(bassmine.binaryBeatPattern([e.startTime for e in variation.events], 8))
+        self.assertEqual([ids[i] for i in [0, 3, 4, 6, 7]], [baseIds[i] for i in [0, 3, 4, 6, 7]])
+        with self.assertRaises(ValueError):
+            bassmine.variationMM(model, [8, 1, -1])
+        self.assertEqual(bassmine.variationMM(model, [8, -1, -1, 10])[0], {'initial': {'prob': 1., 'pattern': 8}})
+        # unknown kicks are relaxed to the metronome pulse
+        offbeatKick = gspattern.Pattern(duration=4, events=[gspattern.Event(3.5, 0.25, 36, 100, "Kick")])
+        with self.assertLogs("gsapi.bassmine", "WARNING"):
+            self.assertEqual(bassmine.generateBassRhythm(model, 4, offbeatKick, rng=0).duration, 4)
+
     def test_Markov_1_32_8(self):
         self.buildMarkov(1, 32, 16)
         # def test_Markov_2_32_4(self):
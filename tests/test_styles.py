@@ -18,6 +18,222 @@ class GSStylesTest(GSTestBase):
         markov.generateStyle(pList)
         self.checkPatternValid(markov.generatePattern())
 
+    def testMarkovStyleDistances(self):
+        import itertools
+        patterns = generateSyntheticPatterns(numPatterns=6, duration=1)
+        queries = generateSyntheticPatterns(numPatterns=4, duration=1, seed=9)
+        markov = gsstyles.MarkovStyle(order=1, numSteps=4, loopDuration=1)
+        markov.generateStyle(patterns)
+        distances = markov.getDistancesFromStyle(patterns + queries)
+        self.assertEqual(distances.shape, (len(patterns) + len(queries),))
+        self.assertAlmostEqual(markov.getDistanceFromStyle(queries[0]), distances[len(patterns)])
+        self.assertTrue(max(distances[:len(patterns)]) < max(distances[len(patterns):]))
+        # distances are normalized like the ones of the other styles
+        self.assertTrue(((distances > 0) & (distances < 1)).all())
+        self.assertEqual(markov.getDistanceFromStyle(queries[0], unseenProbability=0), 1)
+        generated = markov.generatePatterns(10, seed=0)
+        self.assertTrue(np.isfinite(markov.markovChain.getLogLikelihoods(generated)).all())
+
+        # the closest pattern maximizes likelihood minus edit costs (brute force check)
+        states = markov.markovChain.table.states
+
+        def _score(pattern, query):
+            numEdits = 0
+            for step in range(4):
+                queryTags = set([e.tag for e in query.getStartingEventsAtTime(step * 0.25)] or ['silence'])
+                patternTags = set([e.tag for e in pattern.getStartingEventsAtTime(step * 0.25)] or ['silence'])
+                numEdits += len(queryTags ^ patternTags)
+            return markov.markovChain.getLogLikelihoods([pattern])[0] - 0.5 * numEdits
+
+        closest = markov.getClosestPatterns(queries, editCost=0.5)
+        for query, pattern in zip(queries, closest):
+            bestScore = max(_score(gsstyles.patternFromStates([states[s] for s in sequence], 1), query)
+                            for sequence in itertools.product(range(len(states)), repeat=4))
+            self.assertAlmostEqual(_score(pattern, query), bestScore)
+        self.checkPatternEquals(markov.getClosestPattern(queries[0], editCost=0.5), closest[0])
+
+        # transitions to contexts without rows (e.g. in legacy tables) only end chains
+        kick, snare, clap = ('Kick',), ('Snare',), ('Clap',)
+        legacy = gsstyles.MarkovStyle(order=1, numSteps=4, loopDuration=1)
+        legacy.markovChain.table.fromTransitionTable([{(kick,): {snare: 1}}, {(snare,): {clap: 0.9, kick: 0.1}},
+                                                      {(kick,): {kick: 1}, (snare,): {snare: 1}}, {(kick,): {clap: 1}}])
+        self.assertTrue((legacy.markovChain.table.getSampler().entryNextContexts < 0).any())
+        closest = legacy.getClosestPattern(queries[0])
+        self.assertEqual([sorted(e.tag for e in closest.getStartingEventsAtTime(step * 0.25)) for step in range(4)],
+                         [["Snare"], ["Kick"], ["Kick"], ["Clap"]])
+
+    def testDescriptorIndex(self):
+        rng = np.random.RandomState(0)
+        features = rng.normal(size=(2000, 3))
+        features[1000:] = np.round(features[1000:])
+        index = gsstyles.DescriptorIndex(features, leafSize=8)
+        queries = rng.normal(size=(20, 3))
+        indexes, distances = index.query(queries, k=4)
+        bruteForce = np.sqrt(((features[None, :, :] - queries[:, None, :]) ** 2).sum(axis=2))
+        self.assertTrue(np.allclose(distances, np.sort(bruteForce, axis=1)[:, :4]))
+        self.assertTrue(np.allclose(np.take_along_axis(bruteForce, indexes, axis=1), distances))
+
+    def testDatabaseStyle(self):
+        patterns = generateSyntheticPatterns(numPatterns=40)
+        style = gsstyles.DatabaseStyle()
+        style.generateStyle(patterns)
+        self.assertTrue(style.isBuilt())
+        for p in patterns[:5]:
+            self.assertEqual(style.getDistanceFromStyle(p), 0)
+            closest = style.getClosestPattern(p)
+            self.assertTrue((style.getFeatures([closest]) == style.getFeatures([p])).all())
+        indexes, distances = style.getNeighbours(patterns[:3], k=3)
+        self.assertEqual(indexes.shape, (3, 3))
+        self.assertTrue((np.diff(distances, axis=1) >= 0).all())
+        self.assertTrue(style.getInterpolated(patterns[0], patterns[1], 0) in patterns)
+        farPattern = gspattern.Pattern(duration=4, events=[gspattern.Event(i / 8., 0.125, 36, 100, "Kick")
+                                                            for i in range(32)])
+        self.assertTrue(0 < style.getDistanceFromStyle(farPattern) < 1)
+
+    def testSaveToFile(self):
+        patterns = generateSyntheticPatterns(numPatterns=20)
+        for p in patterns[:4]:
+            for e in p.events:
+                e.tag = (e.tag, "accent") if e.velocity > 64 else e.tag
+        markov = gsstyles.MarkovStyle(order=2, numSteps=16, loopDuration=4, backoff=True)
+        markov.generateStyle(patterns)
+        database = gsstyles.DatabaseStyle()
+        database.generateStyle(patterns)
+        markovPath = markov.saveToFile("../output/markov.gsstyle")
+        databasePath = database.saveToFile("../output/database.gsstyle")
+        for mmap in [False, True]:
+            loaded = gsio.fromStyleFile(markovPath, mmap=mmap)
+            self.assertTrue(isinstance(loaded, gsstyles.MarkovStyle))
+            self.assertEqual(loaded.markovChain.table.states, markov.markovChain.table.states)
+            self.assertTrue((loaded.generatePatterns(8, seed=3, asArray=True) ==
+                             markov.generatePatterns(8, seed=3, asArray=True)).all())
+            self.assertTrue(np.allclose(loaded.getDistancesFromStyle(patterns), markov.getDistancesFromStyle(patterns)))
+            # loaded tables can still be trained
+            loaded.addPatterns(patterns[:2])
+            self.checkPatternValid(loaded.generatePattern(seed=0))
+
+            loaded = gsstyles.DatabaseStyle().loadFromFile(databasePath, mmap=mmap)
+            self.assertTrue(loaded.isBuilt())
+            for p, loadedPattern in zip(patterns, loaded.patternList):
+                self.assertEqual(p.name, loadedPattern.name)
+                self.checkPatternEquals(p, loadedPattern)
+            self.checkPatternEquals(loaded.getClosestPattern(patterns[5]), database.getClosestPattern(patterns[5]))
+        with self.assertRaises(ValueError):
+            gsstyles.DatabaseStyle().loadFromFile(markovPath)
+        # compressed style files are read in memory
+        compressedPath = markov.saveToFile("../output/markov.gsstyle", compression='gzip')
+        loaded = gsstyles.MarkovStyle().loadFromFile(compressedPath, compression='gzip')
+        self.assertTrue((loaded.generatePatterns(8, seed=3, asArray=True) ==
+                         markov.generatePatterns(8, seed=3, asArray=True)).all())
+        with self.assertRaises(ValueError):
+            gsio.fromStyleFile(compressedPath, mmap=True)
+        # an index saved with other descriptors is rebuilt
+        with self.assertLogs("gsapi.styles.database_style", "WARNING"):
+            loaded = gsstyles.DatabaseStyle(descriptors={"density": gsdescriptors.Density()}).loadFromFile(databasePath)
+        self.assertEqual(loaded.getNeighbours(patterns[:1], k=1)[1][0, 0], 0)
+
+        markov.saveToPickle("../output/markov.pickle.gz")
+        loaded = gsstyles.MarkovStyle().loadFromPickle("../output/markov.pickle.gz")
+        self.assertEqual(loaded.markovChain.order, 2)
+        self.assertTrue((loaded.generatePatterns(8, seed=3, asArray=True) ==
+                         markov.generatePatterns(8, seed=3, asArray=True)).all())
+
+    def testFactorizedMarkovStyle(self):
+        import json
+        patterns = generateSyntheticPatterns(numPatterns=50, tags=("Kick", "Snare", "ClosedHH", "Tom", "Clap"))
+        for p in patterns:
+            # snares never start with kicks
+            kickTimes = set([e.startTime for e in p.events if e.tag == "Kick"])
+            p.events = [e for e in p.events if e.tag != "Snare" or e.startTime not in kickTimes]
+        style = gsstyles.FactorizedMarkovStyle(order=2, numSteps=16, loopDuration=4, anchorTag="Kick")
+        style.generateStyle(patterns)
+        self.assertTrue(style.isBuilt())
+        self.assertEqual(style.counts.shape, (5, 16, 8, 2))
+        generated = style.generatePatterns(5000, seed=0, asArray=True)
+        self.assertEqual(generated.shape, (5000, 16, 5))
+        grid, tags = gsstyles.binarizePatterns(patterns, 16, 4, tags=list(style.tags))
+        self.assertTrue(np.abs(generated.mean(axis=0) - grid[:, :, :5].mean(axis=0)).max() < 0.05)
+        kick, snare = style.tags.index("Kick"), style.tags.index("Snare")
+        self.assertFalse((generated[:, :, kick] & generated[:, :, snare]).any())
+        self.assertTrue((style.generatePatterns(5, seed=1, asArray=True) ==
+                         style.generatePatterns(5, seed=1, asArray=True)).all())
+        self.checkPatternValid(style.generatePattern())
+
+        distances = style.getDistancesFromStyle(patterns[:5] + generateSyntheticPatterns(numPatterns=5, seed=3))
+        self.assertTrue(max(distances[:5]) < min(distances[5:]))
+        self.assertTrue(((distances > 0) & (distances < 1)).all())
+        cowbell = gspattern.Pattern(duration=4, events=[gspattern.Event(0, 0.25, 56, 100, "Cowbell")])
+        self.assertEqual(style.getDistanceFromStyle(cowbell, unseenProbability=0), 1)
+        loaded = gsstyles.FactorizedMarkovStyle()
+        loaded.setInternalState(json.loads(json.dumps(style.getInternalState())))
+        self.assertTrue(np.allclose(loaded.getDistancesFromStyle(patterns[:5]), distances[:5]))
+        # the binary state keeps the counts as arrays instead of going through lists
+        style.getInternalState = None
+        binaryState = style.getBinaryState()
+        del style.getInternalState
+        self.assertTrue(isinstance(binaryState["counts"], np.ndarray))
+        self.assertTrue((binaryState["counts"] == style.counts).all())
+        loaded = gsstyles.FactorizedMarkovStyle()
+        loaded.setBinaryState(binaryState)
+        self.assertTrue(np.allclose(loaded.getDistancesFromStyle(patterns[:5]), distances[:5]))
+        # untrained styles can be saved like the other styles
+        empty = gsstyles.FactorizedMarkovStyle(order=1, anchorTag="Kick")
+        loaded.setInternalState(json.loads(json.dumps(empty.getInternalState())))
+        self.assertFalse(loaded.isBuilt())
+        loaded = gsio.fromStyleFile(empty.saveToFile("../output/factorized.gsstyle"))
+        self.assertEqual((loaded.order, loaded.anchorTag, loaded.isBuilt()), (1, "Kick", False))
+
+    def testStyleManager(self):
+        patterns = generateSyntheticPatterns(numPatterns=10, duration=16)
+        manager = gsstyles.StyleManager(patterns, maxNumStyles=3)
+        self.assertTrue(manager.getStyle(2, 16, 4, wait=False) is None)
+        manager.waitForStyles()
+        style = manager.getStyle(2, 16, 4, wait=False)
+        self.assertTrue(style.isBuilt())
+        slices = []
+        for p in patterns:
+            slices += p.splitInEqualLengthPatterns(4)
+        reference = gsstyles.MarkovStyle(order=2, numSteps=16, loopDuration=4)
+        reference.generateStyle(slices)
+        self.assertEqual(style.markovChain.transitionTable, reference.markovChain.transitionTable)
+        # patterns are not altered by slicing
+        self.assertEqual(patterns[0].duration, 16)
+
+        for order in [1, 3]:
+            manager.requestStyle(order, 16, 4)
+        manager.waitForStyles()
+        self.assertTrue(manager.getStyle(1, 8, 2) is not None)
+        self.assertEqual(manager.getConfigs(), [(1, 16, 4), (3, 16, 4), (1, 8, 2)])
+        # least recently used styles are evicted
+        manager.getStyle(1, 16, 4)
+        manager.getStyle(2, 8, 2)
+        self.assertEqual(manager.getConfigs(), [(1, 8, 2), (1, 16, 4), (2, 8, 2)])
+
+        # coarser grids are pooled from the cached ones instead of binarizing the slices again
+        binarize = gsstyles.binarizePatterns
+        gsstyles.binarizePatterns = None
+        try:
+            pooled = manager.getGrid(4, 4)
+        finally:
+            gsstyles.binarizePatterns = binarize
+        reference = gsstyles.binarizePatterns(slices, 4, 4)
+        self.assertEqual(pooled[1], reference[1])
+        self.assertTrue((pooled[0] == reference[0]).all())
+
+        # styles are reproducible whichever thread trains them and in whatever order they are requested,
+        # even after being evicted and retrained
+        generated = []
+        for wait, orders in [(True, [1, 2]), (False, [2, 1])]:
+            manager = gsstyles.StyleManager(patterns, maxNumStyles=1, rng=5)
+            for order in orders:
+                manager.getStyle(order, 16, 4, wait=wait)
+            manager.waitForStyles()
+            generated += [[manager.getStyle(order, 16, 4).generatePatterns(4, asArray=True) for order in [1, 2]]]
+            self.assertEqual(manager.getConfigs(), [(2, 16, 4)])
+        for a, b in zip(*generated):
+            self.assertTrue((a == b).all())
+        self.assertFalse((generated[0][0] == generated[0][1]).all())
+
     def testMarkovFromViewpointChords(self):
         loopDuration = 32
         pList = self.cachedDataset.getAllSliceOfDuration(loopDuration)
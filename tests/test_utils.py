@@ -11,6 +11,8 @@ import sys
 import glob
 import random
 
+import numpy as np
+
 from gsapi import *
 
 testLog = logging.getLogger("gsapi.GSTest")
@@ -57,6 +59,26 @@ def getAllDescriptorsClasses():
     return result
 
 
+def generateSyntheticPatterns(numPatterns=8, duration=4, stepSize=0.25, tags=("Kick", "Snare", "ClosedHH"), seed=0):
+    """
+    Return a list of random step sequenced patterns (one event per tag and step at most).
+    Useful for tests that should not depend on the local corpora.
+
+    """
+    rng = random.Random(seed)
+    numSteps = int(duration / stepSize)
+    patterns = []
+    for i in range(numPatterns):
+        p = gspattern.Pattern(duration=duration, name="synthetic_%i" % i)
+        for step in range(numSteps):
+            for pitch, tag in enumerate(tags):
+                if rng.random() < 0.3:
+                    p.events += [gspattern.Event(startTime=step * stepSize, duration=stepSize, pitch=36 + pitch,
+                                                 velocity=rng.randint(1, 127), tag=tag)]
+        patterns += [p]
+    return patterns
+
+
 class GSTestBase(unittest.TestCase):
     """
     Helper function for tests classes.
@@ -89,7 +111,7 @@ class GSTestBase(unittest.TestCase):
             _checkedP = pattern.getPatternWithTags(tagToLookFor=t)
             for e in _checkedP.events:
                 if lastEvent:
-                    self.assertTrue(e.startTime >= lastEvent.getEndTime(),
+                    self.assertTrue(e.startTime >= lastEvent.endTime(),
                                     "%s: event : (%s \noverlaps with %s)" % (msg, e, lastEvent))
                 lastEvent = e
 